@@ -1,27 +1,72 @@
 import argparse
 
+import fleet_search
 import utils
+import vrp_heuristics
 
 
 VEHICLES = 5
 CAPACITY = 40
 
 
-def main(api_key: str) -> None:
-    g_maps_client = utils.get_gmaps_client(api_key)
+def main(
+    api_key: str,
+    offline_network: bool = False,
+    lazy_subtours: bool = False,
+    fleet_search_mode: str = None,
+    heuristic_time_limit: float = None,
+) -> None:
     data_gdf = utils.generate_data_for_vrp()
     print("The number of packages:", data_gdf["customer_demand"].sum())
-    distances = utils.get_origin_destination_cost_matrix(data_gdf, g_maps_client, True)
-    x, vehicles = utils.get_optimal_distances_for_capacitated_vrp(
-        data_gdf, distances, VEHICLES, CAPACITY
-    )
+    if offline_network:
+        distances = utils.get_network_cost_matrix(data_gdf)
+    else:
+        g_maps_client = utils.get_gmaps_client(api_key)
+        distances = utils.get_origin_destination_cost_matrix(
+            data_gdf, g_maps_client, True
+        )
+    if heuristic_time_limit is not None:
+        # savings plus local search for instances too large for the MILP
+        routes, _ = vrp_heuristics.solve_vrp(
+            distances,
+            data_gdf.customer_demand.to_numpy(),
+            CAPACITY,
+            heuristic_time_limit,
+        )
+        utils.plot_vrp_solution(data_gdf, routes)
+        return
+    if fleet_search_mode:
+        x, vehicles, _ = fleet_search.search_fleet_size(
+            distances,
+            VEHICLES,
+            data_gdf,
+            CAPACITY,
+            binary_search=fleet_search_mode == "binary",
+            lazy_subtours=lazy_subtours,
+        )
+    else:
+        x, vehicles = utils.get_optimal_distances_for_capacitated_vrp(
+            data_gdf, distances, VEHICLES, CAPACITY, lazy_subtours
+        )
     routes = utils.get_vrt_routes(x, vehicles)
     utils.plot_vrp_solution(data_gdf, routes)
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument("--api_key", type=str, required=True)
+    parser.add_argument("--api_key", type=str)
+    parser.add_argument("--offline_network", action="store_true")
+    parser.add_argument("--lazy_subtours", action="store_true")
+    parser.add_argument("--fleet_search", choices=["linear", "binary"])
+    parser.add_argument("--heuristic_time_limit", type=float)
 
     args = parser.parse_args()
-    main(args.api_key)
+    if not args.offline_network and not args.api_key:
+        parser.error("--api_key is required unless --offline_network is set")
+    main(
+        args.api_key,
+        args.offline_network,
+        args.lazy_subtours,
+        args.fleet_search,
+        args.heuristic_time_limit,
+    )
@@ -0,0 +1,229 @@
+import math
+import time
+
+import geopandas as gpd
+import numpy as np
+import pulp
+
+import constants
+import utils
+import vrp_heuristics
+
+
+HEURISTIC_SECONDS = 2.0
+
+
+def get_fleet_lower_bound(
+    data_gdf: gpd.GeoDataFrame = None, capacity: int = None
+) -> int:
+    if data_gdf is None or capacity is None:
+        return 1
+    return max(1, math.ceil(data_gdf.customer_demand.sum() / capacity))
+
+
+def build_fleet_model(
+    distances: np.array,
+    max_vehicles: int,
+    data_gdf: gpd.GeoDataFrame = None,
+    capacity: int = None,
+    lazy_subtours: bool = False,
+) -> tuple:
+    # one model for the largest fleet; smaller fleets only switch vehicles off
+    lp_problem = pulp.LpProblem("FleetVRP", pulp.LpMinimize)
+    lp_problem, x = utils.add_problem_variables_and_constraints(
+        lp_problem, distances, max_vehicles, lazy_subtours
+    )
+    if capacity is not None:
+        lp_problem = utils.add_capacity_constraints(
+            lp_problem, data_gdf, max_vehicles, x, capacity
+        )
+    return lp_problem, x
+
+
+def set_fleet_size(
+    lp_problem: pulp.LpProblem, x: list, vehicles: int, max_vehicles: int
+) -> None:
+    for k in range(max_vehicles):
+        active = int(k < vehicles)
+        lp_problem.constraints[f"depart_{k}"].constant = -active
+        lp_problem.constraints[f"return_{k}"].constant = -active
+        for i in range(constants.CUSTOMERS + 1):
+            for j in range(constants.CUSTOMERS + 1):
+                if i != j:
+                    x[i][j][k].upBound = active
+
+
+def get_routes_by_vehicle(x: list, vehicles: int) -> list:
+    return get_routes_from_arcs(utils.get_vrt_routes(x, vehicles), vehicles)
+
+
+def get_routes_from_arcs(arcs: list, vehicles: int) -> list:
+    # (k, i, j) arcs to each vehicle's customers in visiting order
+    successors = {(k, i): j for k, i, j in arcs}
+    routes = []
+    for k in range(vehicles):
+        route = []
+        node = successors.get((k, 0), 0)
+        while node != 0:
+            route.append(node)
+            node = successors[k, node]
+        routes.append(route)
+    return routes
+
+
+def get_route_demand(route: list, data_gdf: gpd.GeoDataFrame) -> int:
+    if data_gdf is None:
+        return 0
+    return int(sum(data_gdf.customer_demand[j] for j in route))
+
+
+def resize_routes(
+    routes: list,
+    vehicles: int,
+    data_gdf: gpd.GeoDataFrame = None,
+    capacity: int = None,
+) -> list:
+    # turn a feasible solution for another fleet size into a start for this
+    # one: split the longest route, or merge the two lightest that still fit
+    routes = [list(route) for route in routes]
+    while len(routes) < vehicles:
+        longest = max(routes, key=len)
+        if len(longest) < 2:
+            return None
+        routes.remove(longest)
+        middle = len(longest) // 2
+        routes += [longest[:middle], longest[middle:]]
+    while len(routes) > vehicles:
+        routes.sort(key=lambda route: get_route_demand(route, data_gdf))
+        merged = routes[0] + routes[1]
+        if capacity is not None and get_route_demand(merged, data_gdf) > capacity:
+            return None
+        routes = [merged] + routes[2:]
+    return routes
+
+
+def get_heuristic_routes(
+    distances: np.array,
+    data_gdf: gpd.GeoDataFrame = None,
+    capacity: int = None,
+    time_limit: float = HEURISTIC_SECONDS,
+) -> list:
+    # a feasible solution before the first probe, so that probe is warm-started
+    # too; without it a linear scan stops at its first, cold, feasible solve
+    demand = None if data_gdf is None else data_gdf.customer_demand.to_numpy()
+    arcs, vehicles = vrp_heuristics.solve_vrp(distances, demand, capacity, time_limit)
+    return get_routes_from_arcs(arcs, vehicles)
+
+
+def set_warm_start(x: list, routes: list, max_vehicles: int) -> None:
+    for k in range(max_vehicles):
+        for i in range(constants.CUSTOMERS + 1):
+            for j in range(constants.CUSTOMERS + 1):
+                if i != j:
+                    x[i][j][k].setInitialValue(0)
+    for k, route in enumerate(routes):
+        for i, j in zip([0] + route, route + [0]):
+            x[i][j][k].setInitialValue(1)
+
+
+def solve_fleet_size(
+    lp_problem: pulp.LpProblem,
+    x: list,
+    vehicles: int,
+    max_vehicles: int,
+    lazy_subtours: bool,
+    warm_start_routes: list = None,
+) -> tuple:
+    start = time.time()
+    set_fleet_size(lp_problem, x, vehicles, max_vehicles)
+    if warm_start_routes is not None:
+        set_warm_start(x, warm_start_routes, max_vehicles)
+    build_seconds = time.time() - start
+    solver = pulp.PULP_CBC_CMD(msg=False, warmStart=warm_start_routes is not None)
+    start = time.time()
+    if lazy_subtours:
+        status = utils.solve_with_lazy_subtours(lp_problem, max_vehicles, x, solver)
+    else:
+        status = lp_problem.solve(solver)
+    solve_seconds = time.time() - start
+    print(
+        f"Fleet size {vehicles}: build {round(build_seconds, 3)} s, "
+        f"solve {round(solve_seconds, 3)} s, "
+        f"{'feasible' if status == 1 else 'infeasible'}"
+        f"{', warm start' if warm_start_routes is not None else ''}"
+    )
+    timing = {
+        "vehicles": vehicles,
+        "build_seconds": build_seconds,
+        "solve_seconds": solve_seconds,
+        "feasible": status == 1,
+    }
+    return status, timing
+
+
+def search_fleet_size(
+    distances: np.array,
+    max_vehicles: int,
+    data_gdf: gpd.GeoDataFrame = None,
+    capacity: int = None,
+    binary_search: bool = False,
+    warm_start: bool = True,
+    lazy_subtours: bool = False,
+    heuristic_seconds: float = HEURISTIC_SECONDS,
+) -> tuple:
+    start = time.time()
+    lp_problem, x = build_fleet_model(
+        distances, max_vehicles, data_gdf, capacity, lazy_subtours
+    )
+    timings = [{"vehicles": None, "build_seconds": time.time() - start}]
+    print(f"Fleet model built once in {round(timings[0]['build_seconds'], 3)} s")
+    low = min(get_fleet_lower_bound(data_gdf, capacity), max_vehicles)
+    high = max_vehicles
+    best = None
+    heuristic_routes = None
+    if warm_start:
+        heuristic_routes = get_heuristic_routes(
+            distances, data_gdf, capacity, heuristic_seconds
+        )
+
+    def try_fleet_size(vehicles: int) -> bool:
+        nonlocal best
+        warm_start_routes = None
+        if warm_start:
+            routes = heuristic_routes if best is None else best[1]
+            warm_start_routes = resize_routes(routes, vehicles, data_gdf, capacity)
+        status, timing = solve_fleet_size(
+            lp_problem, x, vehicles, max_vehicles, lazy_subtours, warm_start_routes
+        )
+        timings.append(timing)
+        if status != 1:
+            return False
+        best = (
+            vehicles,
+            get_routes_by_vehicle(x, vehicles),
+            {variable.name: variable.varValue for variable in lp_problem.variables()},
+            pulp.value(lp_problem.objective),
+        )
+        return True
+
+    if binary_search:
+        # the smallest feasible fleet, probing the midpoint of the bracket
+        while low <= high:
+            middle = (low + high) // 2
+            if try_fleet_size(middle):
+                high = middle - 1
+            else:
+                low = middle + 1
+    else:
+        for vehicles in range(low, max_vehicles + 1):
+            if try_fleet_size(vehicles):
+                break
+    if best is None:
+        return x, None, timings
+    vehicles, _, values, objective = best
+    # the last solve may have been an infeasible probe
+    for variable in lp_problem.variables():
+        variable.varValue = values[variable.name]
+    print("# Required Vehicles:", vehicles)
+    print("Distance:", objective)
+    return x, vehicles, timings
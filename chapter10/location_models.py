@@ -0,0 +1,187 @@
+import argparse
+import hashlib
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pulp
+
+from spopt.locate import LSCP, MCLP, PCenter, PMedian
+
+import lscp
+import network_coverage
+
+
+COST_MATRIX_DIR = "data/washington/cost_matrices"
+RESULTS_PATH = "data/output/washington/location_models.csv"
+MODELS = ["lscp", "mclp", "p-median", "p-center"]
+# p-median and p-center do not use a radius, MCLP and LSCP need one
+RADIUS_MODELS = {"lscp", "mclp"}
+P_MODELS = {"mclp", "p-median", "p-center"}
+RADII = [1000, 2000, 3000, 4000, 5000]
+
+_cost_matrix_cache = {}
+
+
+def get_cost_matrix_path(
+    demand: network_coverage.SnappedPoints,
+    facilities: network_coverage.SnappedPoints,
+    cost_matrix_dir: str = COST_MATRIX_DIR,
+) -> Path:
+    # keyed by where the points are snapped, so a new simulation gets a new file
+    digest = hashlib.sha1()
+    for points in [demand, facilities]:
+        for values in [
+            points.start_vertex,
+            points.end_vertex,
+            points.start_distance,
+            points.end_distance,
+        ]:
+            digest.update(np.ascontiguousarray(values).tobytes())
+    return Path(cost_matrix_dir) / f"costs_{digest.hexdigest()[:12]}.npy"
+
+
+def get_cost_matrix(
+    network: network_coverage.NetworkArrays,
+    demand: network_coverage.SnappedPoints,
+    facilities: network_coverage.SnappedPoints,
+    cost_matrix_dir: str = COST_MATRIX_DIR,
+) -> tuple:
+    # computed once, then memory-mapped by the parent and every worker
+    path = get_cost_matrix_path(demand, facilities, cost_matrix_dir)
+    if not path.is_file():
+        start = time.time()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        np.save(
+            path, network_coverage.get_cost_matrix(network, demand, facilities)
+        )
+        print(f"Cost matrix computed in {round(time.time() - start, 2)} seconds")
+    return np.load(path, mmap_mode="r"), path
+
+
+def get_configurations(
+    models: list, radii: list, p_values: list, n_facilities: int
+) -> list:
+    configurations = []
+    for model in models:
+        model_radii = radii if model in RADIUS_MODELS else [None]
+        model_p_values = p_values if model in P_MODELS else [None]
+        configurations += [
+            (model, radius, p)
+            for radius in model_radii
+            for p in model_p_values
+            if p is None or p <= n_facilities
+        ]
+    return configurations
+
+
+def init_worker(cost_matrix_path: str) -> None:
+    _cost_matrix_cache["costs"] = np.load(cost_matrix_path, mmap_mode="r")
+
+
+def get_model(model: str, costs: np.ndarray, radius: float, p: int):
+    weights = np.ones(costs.shape[0])
+    if model == "lscp":
+        return LSCP.from_cost_matrix(costs, radius)
+    if model == "mclp":
+        return MCLP.from_cost_matrix(costs, weights, radius, p_facilities=p)
+    if model == "p-median":
+        return PMedian.from_cost_matrix(costs, weights, p_facilities=p)
+    return PCenter.from_cost_matrix(costs, p_facilities=p)
+
+
+def get_solution_metrics(costs: np.ndarray, fac2cli: list, radius: float) -> dict:
+    selected = network_coverage.get_selected_sites(fac2cli)
+    if not selected:
+        return {"facilities": 0, "selected_sites": ""}
+    # every client measured to its nearest open site, whatever the objective
+    nearest = np.asarray(costs[:, selected]).min(axis=1)
+    metrics = {
+        "facilities": len(selected),
+        "selected_sites": " ".join(str(site) for site in selected),
+        "mean_distance": float(nearest.mean()),
+        "max_distance": float(nearest.max()),
+    }
+    if radius is not None:
+        metrics["coverage"] = float((nearest <= radius).mean())
+    return metrics
+
+
+def solve_configuration(configuration: tuple) -> dict:
+    model, radius, p = configuration
+    costs = _cost_matrix_cache["costs"]
+    row = {"model": model, "radius": radius, "p": p}
+    start = time.time()
+    location_model = get_model(model, np.asarray(costs), radius, p)
+    build_seconds = time.time() - start
+    try:
+        location_model.solve(pulp.PULP_CBC_CMD(msg=False))
+    except RuntimeError:
+        # spopt raises on a non-optimal status; an infeasible radius is a
+        # point on the curve, anything else is a failed run
+        if location_model.problem.status != pulp.LpStatusInfeasible:
+            raise
+    status = location_model.problem.status
+    if status not in [pulp.LpStatusOptimal, pulp.LpStatusInfeasible]:
+        raise RuntimeError(f"{model} ended with status {pulp.LpStatus[status]}")
+    row.update(
+        status=pulp.LpStatus[status].lower(),
+        build_seconds=build_seconds,
+        solve_seconds=time.time() - start - build_seconds,
+    )
+    if status == pulp.LpStatusInfeasible:
+        return row
+    location_model.facility_client_array()
+    return {**row, **get_solution_metrics(costs, location_model.fac2cli, radius)}
+
+
+def run_location_models(
+    cost_matrix_path: str,
+    configurations: list,
+    max_workers: int = None,
+    results_path: str = RESULTS_PATH,
+) -> pd.DataFrame:
+    start = time.time()
+    with ProcessPoolExecutor(
+        max_workers=max_workers,
+        initializer=init_worker,
+        initargs=(str(cost_matrix_path),),
+    ) as executor:
+        results = pd.DataFrame(
+            executor.map(solve_configuration, configurations)
+        )
+    print(
+        f"{len(configurations)} configurations solved in "
+        f"{round(time.time() - start, 2)} seconds"
+    )
+    Path(results_path).parent.mkdir(parents=True, exist_ok=True)
+    results.to_csv(results_path, index=False)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--models", nargs="+", choices=MODELS, default=MODELS)
+    parser.add_argument("--radii", nargs="+", type=float, default=RADII)
+    parser.add_argument("--p_values", nargs="+", type=int)
+    parser.add_argument("--max_workers", type=int)
+    parser.add_argument("--network_cache", action="store_true")
+    args = parser.parse_args()
+
+    _, gdf_edges = lscp.get_network_data(True, args.network_cache)
+    _, street_buffer, _, ntw = lscp.get_clipped_network(gdf_edges, args.network_cache)
+    lscp.simulate_patients_and_medical_centers(street_buffer, ntw)
+    network = network_coverage.get_network_arrays(ntw)
+    demand = network_coverage.get_snapped_points(ntw, "patients", network)
+    facilities = network_coverage.get_snapped_points(ntw, "medical_centers", network)
+    _, cost_matrix_path = get_cost_matrix(network, demand, facilities)
+    n_facilities = len(facilities.start_vertex)
+    configurations = get_configurations(
+        args.models,
+        args.radii,
+        args.p_values or list(range(1, n_facilities + 1)),
+        n_facilities,
+    )
+    print(run_location_models(cost_matrix_path, configurations, args.max_workers))
@@ -1,3 +1,4 @@
+import argparse
 from pathlib import Path
 
 import contextily as cx
@@ -13,11 +14,17 @@ from matplotlib.patches import Patch
 from spopt.locate.coverage import LSCP
 from spopt.locate.util import simulated_geo_points
 
+import network_cache
+import network_coverage
+
 
 TRACTS = 15
 MEDICAL_CENTERS = 5
 PATIENTS = 150
 SERVICE_AREA = 3000
+PLACE = "Washington, DC"
+NETWORK_TYPE = "drive"
+CENTER_TRACT = 150
 
 
 def plot_data(data: list[dict]) -> None:
@@ -42,13 +49,11 @@ def plot_data(data: list[dict]) -> None:
 
 
 def get_serviced_points_and_selected_sites(lscp_from_cost_matrix) -> tuple[list]:
-    serviced_points = []
-    selected_sites = []
-    for i in range(MEDICAL_CENTERS):
-        if lscp_from_cost_matrix.fac2cli[i]:
-            geom = patient_locs.iloc[lscp_from_cost_matrix.fac2cli[i]]["geometry"]
-            serviced_points.append(geom)
-            selected_sites.append(i)
+    fac2cli = lscp_from_cost_matrix.fac2cli
+    selected_sites = network_coverage.get_selected_sites(fac2cli)
+    serviced_points = [
+        patient_locs.iloc[fac2cli[i]]["geometry"] for i in selected_sites
+    ]
     return serviced_points, selected_sites
 
 
@@ -166,15 +171,23 @@ def plot_optimal_solution(
     plt.show()
 
 
-def get_network_data(use_local_data: bool = False) -> tuple[gpd.GeoDataFrame]:
+def get_network_data(
+    use_local_data: bool = False, use_network_cache: bool = False
+) -> tuple[gpd.GeoDataFrame]:
+    key = network_cache.get_cache_key(PLACE, NETWORK_TYPE)
+    if use_network_cache and (cached := network_cache.load_osm_network(key)):
+        return cached
     nodes_path = "data/washington/network_nodes.geojson"
     edges_path = "data/washington/network_edges.geojson"
     if use_local_data and Path(nodes_path).is_file() and Path(edges_path).is_file():
-        return gpd.read_file(nodes_path), gpd.read_file(edges_path)
-    G = ox.graph_from_place("Washington, DC", network_type="drive")
-    gdf_nodes, gdf_edges = ox.graph_to_gdfs(G)
-    gdf_nodes.to_file(nodes_path, driver="GeoJSON")
-    gdf_edges.to_file(edges_path, driver="GeoJSON")
+        gdf_nodes, gdf_edges = gpd.read_file(nodes_path), gpd.read_file(edges_path)
+    else:
+        G = ox.graph_from_place(PLACE, network_type=NETWORK_TYPE)
+        gdf_nodes, gdf_edges = ox.graph_to_gdfs(G)
+        gdf_nodes.to_file(nodes_path, driver="GeoJSON")
+        gdf_edges.to_file(edges_path, driver="GeoJSON")
+    if use_network_cache:
+        network_cache.save_osm_network(gdf_nodes, gdf_edges, key)
     return gdf_nodes, gdf_edges
 
 
@@ -182,7 +195,7 @@ def get_edges_subset(gdf_edges: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
     gdf_edges.reset_index(inplace=True)
     DC_BGs = gpd.read_file("data/tiger/TIGER2019/tl_2019_11_tract.zip")
     knn = weights.KNN.from_dataframe(DC_BGs, k=TRACTS)
-    neighboring_tracts = [150] + list(knn[150].keys())
+    neighboring_tracts = [CENTER_TRACT] + list(knn[CENTER_TRACT].keys())
     DC_BGs_Sel = DC_BGs.iloc[neighboring_tracts]
     DC_BGs_Sel_D = DC_BGs_Sel.dissolve()
     DC_BGs_Sel_D = DC_BGs_Sel_D.to_crs("EPSG:4326")
@@ -205,6 +218,23 @@ def convert_gpd_to_spaghetti(gdf_edges: gpd.GeoDataFrame) -> tuple:
     return street_buffer, streets_gpd, ntw
 
 
+def get_clipped_network(
+    gdf_edges: gpd.GeoDataFrame, use_network_cache: bool = False
+) -> tuple:
+    # the tract clip, spaghetti network and street buffer are rebuilt only
+    # when the cache has nothing for these edges and tracts
+    key = network_cache.get_cache_key(gdf_edges, TRACTS, CENTER_TRACT)
+    if use_network_cache and (cached := network_cache.load_clipped_network(key)):
+        return cached
+    gdf_edges_clipped_p = get_edges_subset(gdf_edges)
+    street_buffer, streets_gpd, ntw = convert_gpd_to_spaghetti(gdf_edges_clipped_p)
+    if use_network_cache:
+        network_cache.save_clipped_network(
+            gdf_edges_clipped_p, street_buffer, streets_gpd, ntw, key
+        )
+    return gdf_edges_clipped_p, street_buffer, streets_gpd, ntw
+
+
 def simulate_patients_and_medical_centers(
     street_buffer: gpd.GeoDataFrame, ntw: spaghetti.Network
 ) -> tuple[gpd.GeoDataFrame]:
@@ -223,7 +253,19 @@ def simulate_patients_and_medical_centers(
     return patient_locs, medical_center_locs
 
 
-def get_the_serving_locations_for_patients(ntw: spaghetti.Network):
+def get_the_serving_locations_for_patients(
+    ntw: spaghetti.Network, sparse_coverage: bool = False, time_limit: float = None
+):
+    if sparse_coverage:
+        # cut-off Dijkstra from each site instead of the full cost matrix
+        network = network_coverage.get_network_arrays(ntw)
+        coverage = network_coverage.get_coverage_matrix(
+            network,
+            network_coverage.get_snapped_points(ntw, "patients", network),
+            network_coverage.get_snapped_points(ntw, "medical_centers", network),
+            SERVICE_AREA,
+        )
+        return network_coverage.solve_lscp(coverage, time_limit=time_limit)
     cost_matrix = ntw.allneighbordistances(
         sourcepattern=ntw.pointpatterns["patients"],
         destpattern=ntw.pointpatterns["medical_centers"],
@@ -236,7 +278,13 @@ def get_the_serving_locations_for_patients(ntw: spaghetti.Network):
 
 
 if __name__ == "__main__":
-    _, gdf_edges = get_network_data(True)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sparse_coverage", action="store_true")
+    parser.add_argument("--network_cache", action="store_true")
+    parser.add_argument("--time_limit", type=float)
+    args = parser.parse_args()
+
+    _, gdf_edges = get_network_data(True, args.network_cache)
     plot_data(
         [
             {
@@ -248,7 +296,9 @@ if __name__ == "__main__":
             }
         ]
     )
-    gdf_edges_clipped_p = get_edges_subset(gdf_edges)
+    gdf_edges_clipped_p, street_buffer, streets_gpd, ntw = get_clipped_network(
+        gdf_edges, args.network_cache
+    )
     plot_data(
         [
             {
@@ -260,7 +310,6 @@ if __name__ == "__main__":
             }
         ]
     )
-    street_buffer, streets_gpd, ntw = convert_gpd_to_spaghetti(gdf_edges_clipped_p)
     patient_locs, medical_center_locs = simulate_patients_and_medical_centers(
         street_buffer, ntw
     )
@@ -293,7 +342,9 @@ if __name__ == "__main__":
             },
         ]
     )
-    lscp_from_cost_matrix = get_the_serving_locations_for_patients(ntw)
+    lscp_from_cost_matrix = get_the_serving_locations_for_patients(
+        ntw, args.sparse_coverage, args.time_limit
+    )
     serviced_points, selected_sites = get_serviced_points_and_selected_sites(
         lscp_from_cost_matrix
     )
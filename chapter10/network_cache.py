@@ -0,0 +1,285 @@
+import hashlib
+import time
+from collections import OrderedDict, defaultdict
+from pathlib import Path
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+import spaghetti
+
+from libpysal import weights
+
+import road_network
+
+
+NETWORK_CACHE_DIR = "data/washington/network_cache"
+VERTEX_SIG = 11
+CHECK_PATTERN = "cache_check"
+CHECK_OFFSET = 5
+
+
+def get_cache_key(*parts) -> str:
+    # each input set gets its own cache directory, so a different place or
+    # edge set never reads another one's files
+    digest = hashlib.sha1()
+    for part in parts:
+        if isinstance(part, gpd.GeoDataFrame):
+            digest.update(b"".join(part.geometry.to_wkb()))
+        else:
+            digest.update(str(part).encode())
+    return digest.hexdigest()[:12]
+
+
+def get_cache_paths(key: str, cache_dir: str = NETWORK_CACHE_DIR) -> dict:
+    cache_dir = Path(cache_dir) / key
+    return {
+        "nodes": cache_dir / "nodes.parquet",
+        "edges": cache_dir / "edges.parquet",
+        "graph": cache_dir / "graph.npz",
+        "clipped_edges": cache_dir / "clipped_edges.parquet",
+        "streets": cache_dir / "streets.parquet",
+        "street_buffer": cache_dir / "street_buffer.parquet",
+        "spaghetti": cache_dir / "spaghetti.npz",
+    }
+
+
+def get_parquet_safe(gdf: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
+    # osmnx keeps lists for merged ways, which parquet cannot store as objects
+    gdf = gdf.reset_index() if not isinstance(gdf.index, pd.RangeIndex) else gdf
+    gdf = gdf.copy()
+    for column in gdf.columns.drop(gdf.geometry.name):
+        values = gdf[column]
+        if values.dtype == object and values.map(type).isin([list, tuple]).any():
+            # mixed scalars and lists become strings, as in the GeoJSON files
+            gdf[column] = values.where(values.isna(), values.astype(str))
+    return gdf
+
+
+def save_osm_network(
+    gdf_nodes: gpd.GeoDataFrame,
+    gdf_edges: gpd.GeoDataFrame,
+    key: str,
+    cache_dir: str = NETWORK_CACHE_DIR,
+) -> None:
+    paths = get_cache_paths(key, cache_dir)
+    paths["nodes"].parent.mkdir(parents=True, exist_ok=True)
+    gdf_nodes = get_parquet_safe(gdf_nodes)
+    gdf_edges = get_parquet_safe(gdf_edges)
+    gdf_nodes.to_parquet(paths["nodes"])
+    gdf_edges.to_parquet(paths["edges"])
+    # node-indexed CSR of edge lengths, the same layout as road_network
+    node_ids = gdf_nodes["osmid"].to_numpy()
+    node_index = pd.Series(np.arange(len(node_ids)), index=node_ids)
+    edges = road_network.get_edge_weights(gdf_edges)
+    edges["u_index"] = node_index.reindex(edges["u"]).to_numpy()
+    edges["v_index"] = node_index.reindex(edges["v"]).to_numpy()
+    edges = edges.dropna(subset=["u_index", "v_index"]).astype(
+        {"u_index": int, "v_index": int}
+    )
+    lengths = road_network.get_csr(edges, "length", len(node_ids))
+    np.savez(
+        paths["graph"],
+        node_ids=node_ids,
+        indptr=lengths.indptr,
+        indices=lengths.indices,
+        lengths=lengths.data,
+    )
+
+
+def load_osm_network(key: str, cache_dir: str = NETWORK_CACHE_DIR) -> tuple:
+    paths = get_cache_paths(key, cache_dir)
+    if not (paths["nodes"].is_file() and paths["edges"].is_file()):
+        return None
+    return gpd.read_parquet(paths["nodes"]), gpd.read_parquet(paths["edges"])
+
+
+def load_osm_graph(key: str, cache_dir: str = NETWORK_CACHE_DIR) -> tuple:
+    graph = np.load(get_cache_paths(key, cache_dir)["graph"])
+    n = len(graph["node_ids"])
+    lengths = sp.csr_matrix(
+        (graph["lengths"], graph["indices"], graph["indptr"]), shape=(n, n)
+    )
+    return graph["node_ids"], lengths
+
+
+def save_clipped_network(
+    gdf_edges_clipped: gpd.GeoDataFrame,
+    street_buffer: gpd.GeoDataFrame,
+    streets_gpd: gpd.GeoDataFrame,
+    ntw: spaghetti.Network,
+    key: str,
+    cache_dir: str = NETWORK_CACHE_DIR,
+) -> None:
+    paths = get_cache_paths(key, cache_dir)
+    paths["clipped_edges"].parent.mkdir(parents=True, exist_ok=True)
+    get_parquet_safe(gdf_edges_clipped).to_parquet(paths["clipped_edges"])
+    street_buffer.to_parquet(paths["street_buffer"])
+    # arc ids are vertex tuples; kept as two integer columns
+    arcs = np.array(streets_gpd["id"].tolist())
+    streets_gpd.drop(columns="id").assign(
+        arc_start=arcs[:, 0], arc_end=arcs[:, 1]
+    ).to_parquet(paths["streets"])
+    vertex_ids = np.array(list(ntw.vertex_coords))
+    network_arcs = np.array(ntw.arcs)
+    arrays = {
+        "vertex_ids": vertex_ids,
+        "vertex_coords": np.array([ntw.vertex_coords[vertex] for vertex in vertex_ids]),
+        "arcs": network_arcs,
+        "arc_lengths": np.array([ntw.arc_lengths[tuple(arc)] for arc in network_arcs]),
+        # neighbour order decides ties in spaghetti's shortest paths and cannot
+        # be derived from the sorted arcs
+        "adjacency_ids": np.array(list(ntw.adjacencylist)),
+        "adjacency_counts": np.array(
+            [len(neighbours) for neighbours in ntw.adjacencylist.values()]
+        ),
+        "adjacency": np.concatenate(list(ntw.adjacencylist.values())),
+    }
+    # contiguityweights compares every pair of arcs; its neighbours are kept
+    # as positions in the sorted arcs and in the extracted graph edges
+    arrays["network_counts"], arrays["network_neighbours"] = get_neighbour_arrays(
+        ntw.w_network, ntw.arcs
+    )
+    arrays["graph_counts"], arrays["graph_neighbours"] = get_neighbour_arrays(
+        ntw.w_graph, ntw.edges
+    )
+    # a network that would not load back identically is never written
+    check_spaghetti_network(ntw, get_spaghetti_network(**arrays), streets_gpd)
+    np.savez(paths["spaghetti"], **arrays)
+
+
+def get_neighbour_arrays(w: weights.W, links: list) -> tuple:
+    positions = {link: i for i, link in enumerate(links)}
+    neighbours = [[positions[neighbour] for neighbour in w[link]] for link in links]
+    return (
+        np.array([len(row) for row in neighbours], dtype=np.int64),
+        np.array([i for row in neighbours for i in row], dtype=np.int64),
+    )
+
+
+def get_contiguity_weights(
+    links: list, counts: np.ndarray, neighbours: np.ndarray
+) -> weights.W:
+    # the W of spaghetti's contiguityweights, without its pairwise scan
+    rows = np.split(neighbours, np.cumsum(counts)[:-1])
+    return weights.W(
+        OrderedDict(
+            (link, [links[i] for i in row.tolist()]) for link, row in zip(links, rows)
+        )
+    )
+
+
+def get_spaghetti_network(
+    vertex_ids: np.ndarray,
+    vertex_coords: np.ndarray,
+    arcs: np.ndarray,
+    arc_lengths: np.ndarray,
+    adjacency_ids: np.ndarray,
+    adjacency_counts: np.ndarray,
+    adjacency: np.ndarray,
+    network_counts: np.ndarray,
+    network_neighbours: np.ndarray,
+    graph_counts: np.ndarray,
+    graph_neighbours: np.ndarray,
+) -> spaghetti.Network:
+    # the state spaghetti.Network.__init__ derives from the line geometries,
+    # set from the cached arrays, followed by the same component and graph
+    # extraction with the cached contiguity weights
+    ntw = spaghetti.Network.__new__(spaghetti.Network)
+    ntw.in_data = None
+    ntw.vertex_sig = VERTEX_SIG
+    ntw.vertex_atol = None
+    ntw.unique_arcs = True
+    ntw.pointpatterns = {}
+    ntw.vertex_coords = {
+        vertex: tuple(coords)
+        for vertex, coords in zip(vertex_ids.tolist(), vertex_coords.tolist())
+    }
+    ntw.vertices = {coords: vertex for vertex, coords in ntw.vertex_coords.items()}
+    arcs = [tuple(arc) for arc in arcs.tolist()]
+    ntw.arcs = sorted(arcs)
+    ntw.arc_lengths = dict(zip(arcs, arc_lengths.tolist()))
+    ntw.adjacencylist = defaultdict(list)
+    for vertex, neighbours in zip(
+        adjacency_ids.tolist(),
+        np.split(adjacency, np.cumsum(adjacency_counts)[:-1]),
+    ):
+        ntw.adjacencylist[vertex] = neighbours.tolist()
+    ntw.w_network = get_contiguity_weights(ntw.arcs, network_counts, network_neighbours)
+    ntw.identify_components(ntw.w_network, graph=False)
+    ntw.extractgraph()
+    ntw.w_graph = get_contiguity_weights(ntw.edges, graph_counts, graph_neighbours)
+    ntw.identify_components(ntw.w_graph, graph=True)
+    ntw.vertex_list = sorted(ntw.vertices.values())
+    return ntw
+
+
+def get_snapped_observations(ntw: spaghetti.Network, points: gpd.GeoDataFrame) -> tuple:
+    ntw.snapobservations(points, CHECK_PATTERN)
+    pattern = ntw.pointpatterns.pop(CHECK_PATTERN)
+    return pattern.obs_to_arc, pattern.dist_to_vertex, pattern.snapped_coordinates
+
+
+def check_spaghetti_network(
+    ntw: spaghetti.Network, rebuilt: spaghetti.Network, streets_gpd: gpd.GeoDataFrame
+) -> None:
+    # compares the rebuilt network with the one built from the geometries:
+    # arc lengths, adjacency, contiguity, components, graph edges and the
+    # snapping of a point off every arc
+    mismatches = []
+    for name in [
+        "arc_lengths",
+        "adjacencylist",
+        "network_n_components",
+        "network_component_labels",
+        "graph_n_components",
+        "graph_component_labels",
+        "edges",
+        "edge_lengths",
+    ]:
+        expected = pd.Series(getattr(ntw, name)).sort_index()
+        if not expected.equals(pd.Series(getattr(rebuilt, name)).sort_index()):
+            mismatches.append(name)
+    for name in ["w_network", "w_graph"]:
+        if getattr(ntw, name).neighbors != getattr(rebuilt, name).neighbors:
+            mismatches.append(name)
+    points = gpd.GeoDataFrame(
+        geometry=streets_gpd.geometry.interpolate(0.5, normalized=True).translate(
+            CHECK_OFFSET, CHECK_OFFSET
+        ),
+        crs=streets_gpd.crs,
+    )
+    if get_snapped_observations(ntw, points) != get_snapped_observations(
+        rebuilt, points
+    ):
+        mismatches.append("snapobservations")
+    if mismatches:
+        raise ValueError(f"Cached network differs in {', '.join(mismatches)}")
+
+
+def load_clipped_network(key: str, cache_dir: str = NETWORK_CACHE_DIR) -> tuple:
+    start = time.time()
+    paths = get_cache_paths(key, cache_dir)
+    if not all(
+        paths[name].is_file()
+        for name in ["clipped_edges", "street_buffer", "streets", "spaghetti"]
+    ):
+        return None
+    gdf_edges_clipped = gpd.read_parquet(paths["clipped_edges"])
+    street_buffer = gpd.read_parquet(paths["street_buffer"])
+    streets_gpd = gpd.read_parquet(paths["streets"])
+    streets_gpd.insert(
+        0,
+        "id",
+        list(
+            zip(
+                streets_gpd.pop("arc_start").tolist(),
+                streets_gpd.pop("arc_end").tolist(),
+            )
+        ),
+    )
+    arrays = np.load(paths["spaghetti"])
+    ntw = get_spaghetti_network(**arrays)
+    print(f"Clipped network loaded in {round(time.time() - start, 3)} seconds")
+    return gdf_edges_clipped, street_buffer, streets_gpd, ntw
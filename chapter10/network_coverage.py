@@ -0,0 +1,378 @@
+import copy
+import time
+from dataclasses import dataclass
+
+import numpy as np
+import pulp
+import scipy.sparse as sp
+
+from scipy.sparse.csgraph import dijkstra
+
+
+SOURCE_CHUNK_SIZE = 64
+LAGRANGIAN_ITERATIONS = 200
+LAGRANGIAN_PATIENCE = 20
+
+
+@dataclass
+class NetworkArrays:
+    # undirected street graph on vertex indices
+    graph: sp.csr_matrix
+    vertex_ids: list
+
+
+@dataclass
+class SnappedPoints:
+    # every point sits on an arc, at given network distances from its two ends
+    start_vertex: np.ndarray
+    end_vertex: np.ndarray
+    start_distance: np.ndarray
+    end_distance: np.ndarray
+
+
+@dataclass
+class CoverageSolution:
+    selected: np.ndarray
+    fac2cli: list
+    objective: int
+    lower_bound: float
+    uncovered: np.ndarray
+
+
+def get_network_arrays(ntw) -> NetworkArrays:
+    # the spaghetti network as a CSR matrix, without its python dictionaries
+    vertex_ids = list(ntw.vertex_coords)
+    vertex_index = {vertex: index for index, vertex in enumerate(vertex_ids)}
+    arcs = np.array(
+        [
+            (vertex_index[start], vertex_index[end], length)
+            for (start, end), length in ntw.arc_lengths.items()
+        ]
+    )
+    rows = np.concatenate([arcs[:, 0], arcs[:, 1]]).astype(int)
+    columns = np.concatenate([arcs[:, 1], arcs[:, 0]]).astype(int)
+    graph = sp.coo_matrix(
+        (np.concatenate([arcs[:, 2], arcs[:, 2]]), (rows, columns)),
+        shape=(len(vertex_ids), len(vertex_ids)),
+    ).tocsr()
+    return NetworkArrays(graph=graph, vertex_ids=vertex_ids)
+
+
+def get_snapped_points(ntw, pattern_name: str, network: NetworkArrays) -> SnappedPoints:
+    vertex_index = {vertex: index for index, vertex in enumerate(network.vertex_ids)}
+    pattern = ntw.pointpatterns[pattern_name]
+    points = {}
+    for (start, end), observations in pattern.obs_to_arc.items():
+        for point in observations:
+            distances = pattern.dist_to_vertex[point]
+            points[point] = (
+                vertex_index[start],
+                vertex_index[end],
+                distances[start],
+                distances[end],
+            )
+    values = np.array([points[point] for point in sorted(points)])
+    return SnappedPoints(
+        start_vertex=values[:, 0].astype(int),
+        end_vertex=values[:, 1].astype(int),
+        start_distance=values[:, 2],
+        end_distance=values[:, 3],
+    )
+
+
+def get_source_graph(graph: sp.csr_matrix, sources: SnappedPoints) -> sp.csr_matrix:
+    # one virtual vertex per source, joined to the two ends of its arc, so
+    # that scipy's dijkstra can start from points in the middle of arcs
+    n, k = graph.shape[0], len(sources.start_vertex)
+    virtual = np.arange(n, n + k)
+    # explicit zeros would be dropped, a point on a vertex keeps a tiny edge
+    extra = sp.coo_matrix(
+        (
+            np.maximum(
+                np.concatenate([sources.start_distance, sources.end_distance]), 1e-9
+            ),
+            (
+                np.concatenate([virtual, virtual]),
+                np.concatenate([sources.start_vertex, sources.end_vertex]),
+            ),
+        ),
+        shape=(n + k, n + k),
+    )
+    return (sp.block_diag([graph, sp.csr_matrix((k, k))]) + extra).tocsr()
+
+
+def get_point_distances(
+    vertex_distances: np.ndarray, sources: SnappedPoints, targets: SnappedPoints
+) -> np.ndarray:
+    # sources x targets, through either end of each target's arc
+    distances = np.minimum(
+        vertex_distances[:, targets.start_vertex] + targets.start_distance,
+        vertex_distances[:, targets.end_vertex] + targets.end_distance,
+    )
+    # points on the same arc are also connected directly along it
+    same_arc = (sources.start_vertex[:, None] == targets.start_vertex) & (
+        sources.end_vertex[:, None] == targets.end_vertex
+    )
+    direct = np.abs(sources.start_distance[:, None] - targets.start_distance)
+    return np.where(same_arc, np.minimum(distances, direct), distances)
+
+
+def get_chunks(sources: SnappedPoints, chunk_size: int):
+    for start in range(0, len(sources.start_vertex), chunk_size):
+        chunk = slice(start, start + chunk_size)
+        yield start, SnappedPoints(
+            start_vertex=sources.start_vertex[chunk],
+            end_vertex=sources.end_vertex[chunk],
+            start_distance=sources.start_distance[chunk],
+            end_distance=sources.end_distance[chunk],
+        )
+
+
+def get_source_distances(
+    graph: sp.csr_matrix,
+    sources: SnappedPoints,
+    targets: SnappedPoints,
+    limit: float = np.inf,
+) -> np.ndarray:
+    source_graph = get_source_graph(graph, sources)
+    n = graph.shape[0]
+    vertex_distances = dijkstra(
+        source_graph,
+        directed=True,
+        indices=np.arange(n, n + len(sources.start_vertex)),
+        limit=limit,
+    )[:, :n]
+    return get_point_distances(vertex_distances, sources, targets)
+
+
+def get_coverage_matrix(
+    network: NetworkArrays,
+    demand: SnappedPoints,
+    facilities: SnappedPoints,
+    service_area: float,
+    chunk_size: int = SOURCE_CHUNK_SIZE,
+) -> sp.csr_matrix:
+    # demand x facility coverage from a Dijkstra per facility cut off at the
+    # service area; no dense demand x facility matrix is ever held
+    start_time = time.time()
+    rows, columns = [], []
+    for offset, chunk in get_chunks(facilities, chunk_size):
+        distances = get_source_distances(network.graph, chunk, demand, service_area)
+        facility, demand_point = np.nonzero(distances <= service_area)
+        rows.append(demand_point)
+        columns.append(facility + offset)
+    rows, columns = np.concatenate(rows), np.concatenate(columns)
+    coverage = sp.csr_matrix(
+        (np.ones(len(rows), dtype=bool), (rows, columns)),
+        shape=(len(demand.start_vertex), len(facilities.start_vertex)),
+    )
+    print(
+        f"Coverage {coverage.shape[0]}x{coverage.shape[1]} with {coverage.nnz} "
+        f"pairs in {round(time.time() - start_time, 2)} seconds"
+    )
+    return coverage
+
+
+def get_cost_matrix(
+    network: NetworkArrays,
+    demand: SnappedPoints,
+    facilities: SnappedPoints,
+    chunk_size: int = SOURCE_CHUNK_SIZE,
+) -> np.ndarray:
+    # full demand x facility network distances, one chunk of facilities at a time
+    costs = np.empty((len(demand.start_vertex), len(facilities.start_vertex)))
+    for offset, chunk in get_chunks(facilities, chunk_size):
+        costs[:, offset : offset + chunk_size] = get_source_distances(
+            network.graph, chunk, demand
+        ).T
+    return costs
+
+
+def get_selected_sites(fac2cli: list) -> list:
+    # sites with clients in a fac2cli list, from spopt models or solve_lscp
+    return [site for site, clients in enumerate(fac2cli) if len(clients)]
+
+
+def get_clients(coverage: sp.csc_matrix, facility: int) -> np.ndarray:
+    return coverage.indices[coverage.indptr[facility] : coverage.indptr[facility + 1]]
+
+
+def remove_redundant(coverage: sp.csc_matrix, selected: np.ndarray) -> np.ndarray:
+    # drop sites, least coverage first, whose clients are all covered twice
+    selected = selected.copy()
+    counts = coverage @ selected.astype(int)
+    sizes = np.diff(coverage.indptr)
+    for facility in sorted(np.flatnonzero(selected), key=lambda j: sizes[j]):
+        clients = get_clients(coverage, facility)
+        if np.all(counts[clients] >= 2):
+            selected[facility] = False
+            counts[clients] -= 1
+    return selected
+
+
+def get_greedy_cover(
+    coverage: sp.csc_matrix, selected: np.ndarray = None, weights: np.ndarray = None
+) -> np.ndarray:
+    # repeatedly open the site covering the most uncovered demand per unit
+    # weight, starting from an optional partial selection
+    n_facilities = coverage.shape[1]
+    if selected is None:
+        selected = np.zeros(n_facilities, dtype=bool)
+    selected = selected.copy()
+    weights = np.ones(n_facilities) if weights is None else np.maximum(weights, 1e-9)
+    uncovered = (coverage @ selected.astype(int)) == 0
+    while uncovered.any():
+        gains = coverage.T @ uncovered.astype(int)
+        if gains.max() == 0:
+            break
+        facility = int(np.argmax(gains / weights))
+        selected[facility] = True
+        uncovered[get_clients(coverage, facility)] = False
+    return remove_redundant(coverage, selected)
+
+
+def get_lagrangian_cover(
+    coverage: sp.csc_matrix,
+    upper_bound: int,
+    iterations: int = LAGRANGIAN_ITERATIONS,
+) -> tuple:
+    # subgradient optimisation of the relaxed coverage constraints; each
+    # Lagrangian solution is repaired greedily into a cover
+    rows = coverage.tocsr()
+    sizes = np.diff(coverage.indptr)
+    # each client starts at the smallest 1 / |cover| of the sites covering it
+    u = np.zeros(rows.shape[0])
+    np.minimum.reduceat(
+        1 / np.maximum(sizes[rows.indices], 1), rows.indptr[:-1], out=u
+    )
+    best_selected, best_bound = None, 0.0
+    step, stalled = 2.0, 0
+    for _ in range(iterations):
+        reduced_costs = 1 - coverage.T @ u
+        selected = reduced_costs < 0
+        bound = u.sum() + reduced_costs[selected].sum()
+        if bound > best_bound + 1e-9:
+            best_bound, stalled = bound, 0
+        else:
+            stalled += 1
+            if stalled >= LAGRANGIAN_PATIENCE:
+                step, stalled = step / 2, 0
+        repaired = get_greedy_cover(
+            coverage, selected, np.maximum(reduced_costs, 0) + 1e-3
+        )
+        if repaired.sum() < upper_bound:
+            best_selected, upper_bound = repaired, int(repaired.sum())
+        if np.ceil(best_bound - 1e-6) >= upper_bound or step < 1e-4:
+            break
+        subgradient = 1.0 - rows @ selected.astype(int)
+        # multipliers already at zero cannot decrease further
+        subgradient[(u <= 0) & (subgradient < 0)] = 0
+        norm = np.dot(subgradient, subgradient)
+        if norm == 0:
+            break
+        u = np.maximum(0, u + step * (1.05 * upper_bound - bound) / norm * subgradient)
+    return best_selected, float(best_bound)
+
+
+def get_reduced_coverage(coverage: sp.csr_matrix) -> sp.csr_matrix:
+    # clients covered by the same sites give the same constraint, and a
+    # client covered by a superset of another client's sites adds nothing
+    coverage = coverage[np.diff(coverage.indptr) > 0]
+    rows = {
+        tuple(coverage.indices[coverage.indptr[i] : coverage.indptr[i + 1]]): i
+        for i in range(coverage.shape[0])
+    }
+    unique = sp.csr_matrix(coverage[sorted(rows.values())], dtype=np.int32)
+    sizes = np.diff(unique.indptr)
+    shared = (unique @ unique.T).tocoo()
+    dominated = (shared.data == sizes[shared.row]) & (
+        sizes[shared.row] < sizes[shared.col]
+    )
+    keep = np.ones(unique.shape[0], dtype=bool)
+    keep[shared.col[dominated]] = False
+    return sp.csr_matrix(unique[keep], dtype=bool)
+
+
+def get_mip_solver(
+    solver: pulp.LpSolver, warm_start: bool, time_limit: float
+) -> pulp.LpSolver:
+    # a copy of the caller's solver, so its options are left as they were
+    solver = copy.copy(solver) if solver is not None else pulp.PULP_CBC_CMD(msg=False)
+    if warm_start:
+        solver.optionsDict = dict(solver.optionsDict, warmStart=True)
+    if time_limit is not None:
+        solver.timeLimit = time_limit
+    return solver
+
+
+def solve_lscp(
+    coverage: sp.csr_matrix,
+    solver: pulp.LpSolver = None,
+    use_heuristics: bool = True,
+    time_limit: float = None,
+) -> CoverageSolution:
+    start_time = time.time()
+    coverage = sp.csr_matrix(coverage, dtype=bool)
+    uncovered = np.flatnonzero(np.diff(coverage.indptr) == 0)
+    if len(uncovered):
+        print(f"{len(uncovered)} demand points cannot be covered and are ignored")
+    columns = coverage.tocsc()
+    reduced = get_reduced_coverage(coverage)
+    print(f"{reduced.shape[0]} of {coverage.shape[0]} coverage constraints kept")
+    lower_bound = 0.0
+    selected = None
+    if use_heuristics:
+        reduced_columns = reduced.tocsc()
+        selected = get_greedy_cover(reduced_columns)
+        print(f"Greedy cover: {selected.sum()} sites")
+        lagrangian, lower_bound = get_lagrangian_cover(
+            reduced_columns, int(selected.sum())
+        )
+        if lagrangian is not None:
+            selected = lagrangian
+        print(
+            f"Lagrangian cover: {selected.sum()} sites, lower bound "
+            f"{round(lower_bound, 2)}, {round(time.time() - start_time, 2)} seconds"
+        )
+    if selected is None or np.ceil(lower_bound - 1e-6) < selected.sum():
+        # the heuristic cover is the MIP start; skipped when it is proven optimal
+        problem = pulp.LpProblem("lscp", pulp.LpMinimize)
+        y = [pulp.LpVariable(f"y_{j}", cat="Binary") for j in range(coverage.shape[1])]
+        problem += pulp.lpSum(y)
+        for i in range(reduced.shape[0]):
+            facilities = reduced.indices[reduced.indptr[i] : reduced.indptr[i + 1]]
+            problem += pulp.lpSum(y[j] for j in facilities) >= 1
+        if selected is not None:
+            for j, variable in enumerate(y):
+                variable.setInitialValue(int(selected[j]))
+        problem.solve(get_mip_solver(solver, selected is not None, time_limit))
+        solved = np.array([(variable.varValue or 0) > 0.5 for variable in y])
+        if problem.sol_status == pulp.LpSolutionOptimal:
+            selected, lower_bound = solved, float(solved.sum())
+        elif problem.sol_status == pulp.LpSolutionIntegerFeasible:
+            # stopped early, e.g. on the time limit: the heuristic bound stands
+            if selected is None or solved.sum() < selected.sum():
+                selected = solved
+        elif selected is None:
+            raise RuntimeError(
+                f"LSCP solve ended with status {pulp.LpStatus[problem.status]} "
+                "and no cover"
+            )
+        print(
+            f"MIP: {pulp.LpSolution[problem.sol_status]}, {selected.sum()} sites, "
+            f"lower bound {round(lower_bound, 2)}"
+        )
+    print(
+        f"LSCP: {selected.sum()} sites in "
+        f"{round(time.time() - start_time, 2)} seconds"
+    )
+    return CoverageSolution(
+        selected=selected,
+        fac2cli=[
+            get_clients(columns, j).tolist() if selected[j] else []
+            for j in range(coverage.shape[1])
+        ],
+        objective=int(selected.sum()),
+        lower_bound=lower_bound,
+        uncovered=uncovered,
+    )
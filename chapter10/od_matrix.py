@@ -0,0 +1,254 @@
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+
+import numpy as np
+
+
+OD_CACHE_PATH = "data/od_cache.sqlite"
+COORD_PRECISION = 5
+# the distance matrix endpoint accepts at most 25 origins or destinations
+# and 100 elements per request
+MAX_BLOCK_SIDE = 25
+MAX_BLOCK_ELEMENTS = 100
+ELEMENTS_PER_SECOND = 1000
+MAX_WORKERS = 8
+EARTH_RADIUS_M = 6371000.0
+
+
+class RateLimiter:
+    # token bucket shared by the worker threads, counted in matrix elements
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens: float) -> None:
+        tokens = min(tokens, self.capacity)
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity, self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                wait = (tokens - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class StubDistanceMatrixClient:
+    # offline stand-in for googlemaps.Client.distance_matrix: great-circle
+    # distance inflated by a detour factor, with the same response layout
+    def __init__(self, detour_factor: float = 1.3, speed_kmh: float = 40.0):
+        self.detour_factor = detour_factor
+        self.speed_kmh = speed_kmh
+        self.requests = 0
+        self.elements = 0
+        self.lock = threading.Lock()
+
+    def distance_matrix(
+        self, origins: list, destinations: list, mode: str = "driving"
+    ) -> dict:
+        with self.lock:
+            self.requests += 1
+            self.elements += len(origins) * len(destinations)
+        origins = np.radians(np.array(origins, dtype=np.float64).reshape(-1, 2))
+        destinations = np.radians(
+            np.array(destinations, dtype=np.float64).reshape(-1, 2)
+        )
+        d_lat = destinations[None, :, 0] - origins[:, None, 0]
+        d_lon = destinations[None, :, 1] - origins[:, None, 1]
+        a = (
+            np.sin(d_lat / 2) ** 2
+            + np.cos(origins[:, None, 0])
+            * np.cos(destinations[None, :, 0])
+            * np.sin(d_lon / 2) ** 2
+        )
+        meters = 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(a)) * self.detour_factor
+        seconds = meters / (self.speed_kmh / 3.6)
+        return {
+            "status": "OK",
+            "rows": [
+                {
+                    "elements": [
+                        {
+                            "status": "OK",
+                            "distance": {"value": int(round(distance))},
+                            "duration": {"value": int(round(duration))},
+                        }
+                        for distance, duration in zip(distance_row, duration_row)
+                    ]
+                }
+                for distance_row, duration_row in zip(meters, seconds)
+            ],
+        }
+
+
+def get_coord_keys(points: np.ndarray) -> list:
+    return [
+        f"{lat:.{COORD_PRECISION}f},{lon:.{COORD_PRECISION}f}"
+        for lat, lon in np.round(points, COORD_PRECISION)
+    ]
+
+
+def get_cache_connection(cache_path: str) -> sqlite3.Connection:
+    Path(cache_path).parent.mkdir(parents=True, exist_ok=True)
+    connection = sqlite3.connect(cache_path, check_same_thread=False)
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS od_pairs (origin TEXT, destination TEXT, "
+        "mode TEXT, distance INTEGER, duration INTEGER, "
+        "PRIMARY KEY (origin, destination, mode))"
+    )
+    return connection
+
+
+def read_cached_pairs(connection: sqlite3.Connection, keys: list, mode: str) -> dict:
+    unique_keys = sorted(set(keys))
+    key_set = set(keys)
+    cached = {}
+    # sqlite limits the number of bound parameters per statement
+    for start in range(0, len(unique_keys), 400):
+        chunk = unique_keys[start : start + 400]
+        placeholders = ",".join("?" * len(chunk))
+        rows = connection.execute(
+            f"SELECT origin, destination, distance, duration FROM od_pairs "
+            f"WHERE mode = ? AND origin IN ({placeholders})",
+            [mode] + chunk,
+        )
+        for origin, destination, distance, duration in rows:
+            if destination in key_set:
+                cached[origin, destination] = (distance, duration)
+    return cached
+
+
+def save_pairs(connection: sqlite3.Connection, pairs: list) -> None:
+    with connection:
+        connection.executemany(
+            "INSERT OR REPLACE INTO od_pairs VALUES (?, ?, ?, ?, ?)", pairs
+        )
+
+
+def get_blocks(missing: np.ndarray) -> list:
+    # tile the matrix, then shrink each tile to the rows and columns that
+    # still have missing pairs: a new point only costs its row and column
+    n_rows = max(1, min(MAX_BLOCK_SIDE, MAX_BLOCK_ELEMENTS // MAX_BLOCK_SIDE))
+    n_columns = MAX_BLOCK_ELEMENTS // n_rows
+    blocks = []
+    for row_start in range(0, missing.shape[0], n_rows):
+        for column_start in range(0, missing.shape[1], n_columns):
+            tile = missing[
+                row_start : row_start + n_rows, column_start : column_start + n_columns
+            ]
+            rows = np.flatnonzero(tile.any(axis=1)) + row_start
+            columns = np.flatnonzero(tile.any(axis=0)) + column_start
+            if len(rows):
+                blocks.append((rows, columns))
+    return blocks
+
+
+def request_block(
+    client,
+    points: np.ndarray,
+    rows: np.ndarray,
+    columns: np.ndarray,
+    mode: str,
+    limiter: RateLimiter,
+) -> tuple:
+    limiter.acquire(len(rows) * len(columns))
+    response = client.distance_matrix(
+        [tuple(point) for point in points[rows]],
+        [tuple(point) for point in points[columns]],
+        mode=mode,
+    )
+    return rows, columns, response
+
+
+def get_cost_matrices(
+    points: np.ndarray,
+    client,
+    mode: str = "driving",
+    cache_path: str = OD_CACHE_PATH,
+    elements_per_second: float = ELEMENTS_PER_SECOND,
+    max_workers: int = MAX_WORKERS,
+) -> tuple:
+    # points are (lat, lon) rows; returns distance (m) and duration (s)
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    n = len(points)
+    keys = get_coord_keys(points)
+    distances = np.full((n, n), np.nan)
+    durations = np.full((n, n), np.nan)
+    connection = get_cache_connection(cache_path)
+    cached = read_cached_pairs(connection, keys, mode)
+    for i, origin in enumerate(keys):
+        for j, destination in enumerate(keys):
+            if origin == destination:
+                distances[i, j] = durations[i, j] = 0
+            elif (origin, destination) in cached:
+                distances[i, j], durations[i, j] = cached[origin, destination]
+
+    missing = np.isnan(distances)
+    blocks = get_blocks(missing)
+    print(
+        f"OD matrix {n}x{n}: {n * n - missing.sum()} pairs cached or diagonal, "
+        f"{missing.sum()} pairs in {len(blocks)} requests"
+    )
+    limiter = RateLimiter(elements_per_second)
+    failed = []
+    errors = []
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [
+                executor.submit(
+                    request_block, client, points, rows, columns, mode, limiter
+                )
+                for rows, columns in blocks
+            ]
+            # every block is cached as it arrives, so a failed request or an
+            # exhausted quota does not discard the pairs already fetched
+            for future in as_completed(futures):
+                try:
+                    rows, columns, response = future.result()
+                except Exception as error:
+                    errors.append(error)
+                    continue
+                if response.get("status") != "OK":
+                    errors.append(
+                        ValueError(f"Request failed: {response.get('status')}")
+                    )
+                    continue
+                new_pairs = []
+                for i, row in zip(rows, response["rows"]):
+                    for j, element in zip(columns, row["elements"]):
+                        if not missing[i, j]:
+                            continue
+                        if element["status"] != "OK":
+                            failed.append((i, j, element["status"]))
+                            continue
+                        distances[i, j] = element["distance"]["value"]
+                        durations[i, j] = element["duration"]["value"]
+                        new_pairs.append(
+                            (keys[i], keys[j], mode, distances[i, j], durations[i, j])
+                        )
+                save_pairs(connection, new_pairs)
+    finally:
+        connection.close()
+    if errors:
+        print(f"{len(errors)} of {len(blocks)} requests failed, the rest is cached")
+        raise errors[0]
+    if failed:
+        raise ValueError(f"No route for {len(failed)} pairs, e.g. {failed[:5]}")
+    return distances, durations
+
+
+def get_distance_matrix(
+    points: np.ndarray, client, mode: str = "driving", **kwargs
+) -> np.ndarray:
+    distances, _ = get_cost_matrices(points, client, mode, **kwargs)
+    return distances
@@ -9,8 +9,10 @@ import geopandas as gpd
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
-import pulp
 
+import od_matrix
+import q_learning
+import shortest_paths
 import utils
 
 
@@ -134,61 +136,13 @@ def get_intercity_distances(
     file_name = f"data/east_africa/distances_{len(cities_locations_gdf) - 1}.npy"
     if Path(file_name).is_file() and use_saved_distances:
         return np.load(file_name)
-    distances = np.zeros((len(cities_locations_gdf), len(cities_locations_gdf)))
-    cities_locations_gdf["coord"] = (
-        cities_locations_gdf.lat.astype(str)
-        + ","
-        + cities_locations_gdf.lng.astype(str)
+    distances = od_matrix.get_distance_matrix(
+        cities_locations_gdf[["lat", "lng"]].to_numpy(), g_maps_client, mode="driving"
     )
-    for lat in range(len(cities_locations_gdf)):
-        for lon in range(len(cities_locations_gdf)):
-            origin = cities_locations_gdf["Label"][lat]
-            destination = cities_locations_gdf["Label"][lon]
-            print(f"Getting distance for {origin} -> {destination}")
-            maps_api_result = g_maps_client.directions(
-                cities_locations_gdf["coord"].iloc[lat],
-                cities_locations_gdf["coord"].iloc[lon],
-                mode="driving",
-            )
-            distances[lat][lon] = maps_api_result[0]["legs"][0]["distance"]["value"]
     np.save(file_name, distances)
     return distances
 
 
-def select_next_action(
-    distances: np.ndarray, current_city: int, q_table: np.ndarray
-) -> int:
-    possible_actions = (
-        np.where(distances[current_city, :] > 0)[0]  # exploration
-        if np.random.uniform(0, 1) < EPSILON
-        else np.where(
-            q_table[current_city, :] == np.max(q_table[current_city, :])  # exploitation
-        )[0]
-    )
-    if len(possible_actions) == 0:
-        return
-    return np.random.choice(possible_actions)
-
-
-def update_q_table(
-    q_table: np.ndarray,
-    distances: np.ndarray,
-    current_city: int,
-    action: int,
-    next_city: int,
-) -> None:
-    # the reward is negative since the goal is to have minimum distance
-    reward = -distances[current_city, next_city]
-    current_state_action_value = q_table[current_city, action]
-    next_state_action_value = np.max(q_table[next_city, :])
-
-    q_table[current_city, action] = (
-        1 - LEARNING_RATE
-    ) * current_state_action_value + LEARNING_RATE * (
-        reward + DISCOUNT_FACTOR * next_state_action_value
-    )
-
-
 def get_q_learning_cost_table(
     cities_locations_gdf: gpd.GeoDataFrame,
     num_episodes: int,
@@ -196,20 +150,17 @@ def get_q_learning_cost_table(
     end_city_index: str,
     distances: np.ndarray,
 ) -> np.ndarray:
-    q_table = np.zeros((cities_locations_gdf.shape[0], cities_locations_gdf.shape[0]))
-    for _ in range(num_episodes):
-        current_city = start_city_index
-        while current_city != end_city_index:
-            action = select_next_action(distances, current_city, q_table)
-            if action is None:
-                break
-            next_city = action
-            update_q_table(q_table, distances, current_city, action, next_city)
-
-            current_city = next_city
-            if current_city == end_city_index:
-                break
-    return q_table
+    # vectorised episodes with early stopping, warm-started from the tables
+    # learned for earlier origin-destination pairs
+    return q_learning.get_cached_q_table(
+        distances,
+        start_city_index,
+        end_city_index,
+        num_episodes,
+        epsilon=EPSILON,
+        learning_rate=LEARNING_RATE,
+        discount_factor=DISCOUNT_FACTOR,
+    )
 
 
 def get_shortest_path(
@@ -262,43 +213,52 @@ def get_optimal_path(
     return shortest_path, route
 
 
-def get_solution(problem_variables: list):
-    cities_in_path = []
-    for v in problem_variables:
-        if v.varValue == 1:
-            cities_in_path.append(v.name)
+def get_city_index(cities_locations_gdf: gpd.GeoDataFrame, city: str) -> int:
+    return int(
+        cities_locations_gdf[cities_locations_gdf["Label"] == city].index[0]
+    )
 
 
-def shortest_path_using_pulp(
+def get_graph_path(
     cities_locations_gdf: gpd.GeoDataFrame,
     distances: np.ndarray,
     start_city: str,
     end_city: str,
-):
-    prob = pulp.LpProblem("prob", pulp.LpMinimize)
-    N = cities_locations_gdf["Label"].tolist()
-    C = {
-        x: {
-            N[i]: distances[index, i]
-            for i in range(len(N))
-            if i != index and distances[index, i] != float("inf")
-        }
-        for index, x in enumerate(N)
-    }
-    D = {node: 1 if node == start_city else -1 if node == end_city else 0 for node in N}
-    E = [(i, j) for i in N for j in N if i in C.keys() if j in C[i].keys()]
-    x = pulp.LpVariable.dicts("x", E, lowBound=0, upBound=1, cat=pulp.LpInteger)
-
-    prob += pulp.lpSum([C[i][j] * x[i, j] for (i, j) in E])
+    all_pairs: shortest_paths.AllPairsPaths = None,
+) -> tuple:
+    # a predecessor lookup when all pairs are precomputed, otherwise A* with
+    # the great-circle distance in km as the heuristic
+    start = get_city_index(cities_locations_gdf, start_city)
+    end = get_city_index(cities_locations_gdf, end_city)
+    if all_pairs is not None:
+        return shortest_paths.get_path(all_pairs, start, end)
+    return shortest_paths.get_haversine_a_star_path(
+        shortest_paths.get_graph(distances),
+        start,
+        end,
+        cities_locations_gdf[["lat", "lng"]].to_numpy(),
+    )
 
-    for i in N:
-        prob += (
-            pulp.lpSum([x[i, j] for j in N if (i, j) in E])
-            - pulp.lpSum([x[k, i] for k in N if (k, i) in E])
-        ) == D[i]
 
+def shortest_path_using_pulp(
+    cities_locations_gdf: gpd.GeoDataFrame,
+    distances: np.ndarray,
+    start_city: str,
+    end_city: str,
+) -> list:
+    graph = shortest_paths.get_graph(distances)
+    start = get_city_index(cities_locations_gdf, start_city)
+    end = get_city_index(cities_locations_gdf, end_city)
+    prob, x = shortest_paths.get_shortest_path_lp(graph, start, end)
     status = prob.solve()
-    get_solution(prob.variables())
+    path = shortest_paths.get_lp_path(x, start, end)
+    # parity check against the graph search
+    graph_distance, graph_path = shortest_paths.get_bidirectional_path(
+        graph, start, end
+    )
+    if not np.isclose(shortest_paths.get_path_cost(distances, path), graph_distance):
+        print("The LP and the graph search disagree:", path, graph_path)
+    return path
 
 
 def main(api_key: str) -> None:
@@ -325,6 +285,13 @@ def main(api_key: str) -> None:
     print(route)
     plot_cities(cities_locations_gdf, route)
     shortest_path_using_pulp(cities_locations_gdf, distances, "Nairobi", "Kampala")
+    all_pairs = shortest_paths.get_all_pairs_paths(
+        shortest_paths.get_graph(distances), shortest_paths.ALL_PAIRS_DIR
+    )
+    distance, path = get_graph_path(
+        cities_locations_gdf, distances, "Nairobi", "Kampala", all_pairs
+    )
+    print(" -> ".join(cities_locations_gdf["Label"][city] for city in path), distance)
 
 
 if __name__ == "__main__":
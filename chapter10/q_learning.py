@@ -0,0 +1,164 @@
+import hashlib
+import time
+from pathlib import Path
+
+import numpy as np
+
+
+EPSILON = 0.2
+LEARNING_RATE = 0.8
+DISCOUNT_FACTOR = 0.95
+PARALLEL_EPISODES = 64
+CHECK_EVERY = 50
+TOLERANCE = 1e-3
+PATIENCE = 3
+Q_TABLE_DIR = "data/east_africa/q_tables"
+
+
+def get_action_mask(distances: np.ndarray) -> np.ndarray:
+    # missing edges are inf and the diagonal is inf or zero
+    return np.isfinite(distances) & (distances > 0)
+
+
+def get_initial_q_table(mask: np.ndarray, q_table: np.ndarray = None) -> np.ndarray:
+    # invalid actions are -inf so that a plain argmax is always a valid move
+    initial = np.zeros(mask.shape) if q_table is None else np.array(q_table)
+    return np.where(mask, np.nan_to_num(initial, neginf=0.0), -np.inf)
+
+
+def get_greedy_path(q_table: np.ndarray, start: int, end: int) -> list:
+    path = [start]
+    while path[-1] != end and len(path) <= len(q_table):
+        if not np.isfinite(q_table[path[-1]].max()):
+            break
+        path.append(int(np.argmax(q_table[path[-1]])))
+    return path
+
+
+def select_actions(
+    q_table: np.ndarray,
+    mask: np.ndarray,
+    cities: np.ndarray,
+    rng: np.random.Generator,
+    epsilon: float,
+) -> np.ndarray:
+    # epsilon-greedy for every running episode at once, ties broken at random
+    scores = rng.random((len(cities), q_table.shape[1]))
+    rows = q_table[cities]
+    greedy = rows == rows.max(axis=1, keepdims=True)
+    explore = rng.random(len(cities)) < epsilon
+    candidates = np.where(explore[:, None], mask[cities], greedy & mask[cities])
+    return np.where(candidates, scores, -1.0).argmax(axis=1)
+
+
+def get_q_table(
+    distances: np.ndarray,
+    start: int,
+    end: int,
+    max_episodes: int = 1000,
+    q_table: np.ndarray = None,
+    parallel_episodes: int = PARALLEL_EPISODES,
+    epsilon: float = EPSILON,
+    learning_rate: float = LEARNING_RATE,
+    discount_factor: float = DISCOUNT_FACTOR,
+    tolerance: float = TOLERANCE,
+    patience: int = PATIENCE,
+    random_state: int = 32,
+) -> tuple:
+    # episodes run in lockstep; when several of them update the same
+    # state-action pair in one step the last write wins
+    start_time = time.time()
+    rng = np.random.default_rng(random_state)
+    n = len(distances)
+    mask = get_action_mask(distances)
+    has_actions = mask.any(axis=1)
+    q_table = get_initial_q_table(mask, q_table)
+    max_steps = 10 * n
+    cities = np.full(min(parallel_episodes, max_episodes), start)
+    steps = np.zeros(len(cities), dtype=int)
+    if not has_actions[start]:
+        return q_table, 0
+    started, completed = len(cities), 0
+    next_check = CHECK_EVERY
+    previous_path, previous_q, stable_checks = None, q_table.copy(), 0
+    while len(cities):
+        actions = select_actions(q_table, mask, cities, rng, epsilon)
+        rewards = -distances[cities, actions]
+        next_values = np.where(actions == end, 0.0, q_table[actions].max(axis=1))
+        q_table[cities, actions] = (1 - learning_rate) * q_table[
+            cities, actions
+        ] + learning_rate * (rewards + discount_factor * next_values)
+        cities, steps = actions, steps + 1
+        finished = (cities == end) | ~has_actions[cities] | (steps >= max_steps)
+        completed += int(finished.sum())
+        # finished episodes restart from the origin while the budget lasts
+        restart = np.flatnonzero(finished)[: max(0, max_episodes - started)]
+        cities[restart], steps[restart] = start, 0
+        started += len(restart)
+        keep = ~finished
+        keep[restart] = True
+        cities, steps = cities[keep], steps[keep]
+        if completed < next_check:
+            continue
+        next_check += CHECK_EVERY
+        path = get_greedy_path(q_table, start, end)
+        # only the values along the greedy path decide the route
+        arcs = (path[:-1], path[1:])
+        change = np.abs(q_table[arcs] - previous_q[arcs]).max(initial=0.0)
+        scale = max(1.0, np.abs(q_table[arcs]).max(initial=0.0))
+        if path == previous_path and path[-1] == end and change < tolerance * scale:
+            stable_checks += 1
+            if stable_checks >= patience:
+                break
+        else:
+            stable_checks = 0
+        previous_path, previous_q = path, q_table.copy()
+    print(
+        f"Q-learning {start} -> {end}: {completed} episodes, "
+        f"{round(time.time() - start_time, 3)} seconds"
+    )
+    return q_table, completed
+
+
+def get_q_table_path(distances: np.ndarray, end: int, q_table_dir: str) -> Path:
+    key = hashlib.sha1(np.ascontiguousarray(distances).tobytes()).hexdigest()[:12]
+    return Path(q_table_dir) / f"q_table_{key}_{end}.npy"
+
+
+def load_q_table(distances: np.ndarray, end: int, q_table_dir: str) -> np.ndarray:
+    # a table for the same destination is valid for every origin; otherwise
+    # start from the cached destination nearest to this one
+    path = get_q_table_path(distances, end, q_table_dir)
+    if path.is_file():
+        return np.load(path)
+    prefix = path.name.rsplit("_", 1)[0]
+    cached = {
+        int(cached_path.stem.rsplit("_", 1)[1]): cached_path
+        for cached_path in Path(q_table_dir).glob(f"{prefix}_*.npy")
+    }
+    if not cached:
+        return None
+    nearest = min(cached, key=lambda destination: distances[destination, end])
+    return np.load(cached[nearest])
+
+
+def get_cached_q_table(
+    distances: np.ndarray,
+    start: int,
+    end: int,
+    max_episodes: int = 1000,
+    q_table_dir: str = Q_TABLE_DIR,
+    **kwargs,
+) -> np.ndarray:
+    q_table, _ = get_q_table(
+        distances,
+        start,
+        end,
+        max_episodes,
+        load_q_table(distances, end, q_table_dir),
+        **kwargs,
+    )
+    path = get_q_table_path(distances, end, q_table_dir)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    np.save(path, q_table)
+    return q_table
@@ -0,0 +1,412 @@
+import hashlib
+import heapq
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+
+import geopandas as gpd
+import numpy as np
+import osmnx as ox
+import pandas as pd
+import scipy.sparse as sp
+
+from scipy.sparse.csgraph import connected_components, dijkstra
+from scipy.spatial import cKDTree
+
+
+NETWORKS_DIR = "data/road_networks"
+CH_CACHE_DIR = "data/road_networks/contraction_hierarchies"
+EARTH_RADIUS_M = 6371000.0
+# drive network margin around the points, and the farthest a point may be
+# from its snapped node before the matrix is meaningless
+NETWORK_BUFFER_M = 1000.0
+MAX_SNAP_DISTANCE_M = 500.0
+DEFAULT_SPEED_KPH = 40.0
+HIGHWAY_SPEEDS_KPH = {
+    "motorway": 100.0,
+    "trunk": 80.0,
+    "primary": 60.0,
+    "secondary": 50.0,
+    "tertiary": 40.0,
+    "residential": 30.0,
+    "living_street": 10.0,
+}
+MPH_TO_KPH = 1.609344
+WITNESS_SETTLED_LIMIT = 60
+
+_network_cache = {}
+
+
+@dataclass
+class RoadGraph:
+    node_ids: np.ndarray
+    coords: np.ndarray
+    lengths: sp.csr_matrix
+    travel_times: sp.csr_matrix
+    routable: np.ndarray
+
+
+def get_speed_kph(maxspeed, highway) -> float:
+    # osmnx keeps lists for merged ways, serialised as strings in GeoJSON
+    if isinstance(maxspeed, str) and (speeds := re.findall(r"\d+\.?\d*", maxspeed)):
+        speed = float(speeds[0])
+        return speed * MPH_TO_KPH if "mph" in maxspeed else speed
+    for highway_type, speed in HIGHWAY_SPEEDS_KPH.items():
+        if isinstance(highway, str) and highway_type in highway:
+            return speed
+    return DEFAULT_SPEED_KPH
+
+
+def get_edge_weights(gdf_edges: gpd.GeoDataFrame) -> pd.DataFrame:
+    edges = pd.DataFrame(
+        {
+            "u": gdf_edges["u"].to_numpy(),
+            "v": gdf_edges["v"].to_numpy(),
+            "length": gdf_edges["length"].astype(float).to_numpy(),
+        }
+    )
+    if "travel_time" in gdf_edges.columns:
+        edges["travel_time"] = gdf_edges["travel_time"].astype(float).to_numpy()
+    else:
+        speeds = [
+            get_speed_kph(maxspeed, highway)
+            for maxspeed, highway in zip(
+                gdf_edges.get("maxspeed", pd.Series(None, index=gdf_edges.index)),
+                gdf_edges.get("highway", pd.Series(None, index=gdf_edges.index)),
+            )
+        ]
+        edges["travel_time"] = edges["length"] / (np.array(speeds) / 3.6)
+    return edges
+
+
+def get_csr(edges: pd.DataFrame, weight: str, n: int) -> sp.csr_matrix:
+    # parallel edges keep their cheapest weight; coo -> csr would sum them
+    edges = edges.groupby(["u_index", "v_index"], sort=False)[weight].min()
+    rows = edges.index.get_level_values(0)
+    columns = edges.index.get_level_values(1)
+    return sp.csr_matrix((edges.to_numpy(), (rows, columns)), shape=(n, n))
+
+
+def load_graph(nodes_path: str, edges_path: str) -> RoadGraph:
+    gdf_nodes = gpd.read_file(nodes_path)
+    gdf_edges = gpd.read_file(edges_path)
+    node_ids = gdf_nodes["osmid"].to_numpy()
+    node_index = pd.Series(np.arange(len(node_ids)), index=node_ids)
+    edges = get_edge_weights(gdf_edges)
+    edges["u_index"] = node_index.reindex(edges["u"]).to_numpy()
+    edges["v_index"] = node_index.reindex(edges["v"]).to_numpy()
+    edges = edges.dropna(subset=["u_index", "v_index"]).astype(
+        {"u_index": int, "v_index": int}
+    )
+    edges = edges[edges["u_index"] != edges["v_index"]]
+    n = len(node_ids)
+    lengths = get_csr(edges, "length", n)
+    # points are only snapped to the largest strongly connected component,
+    # otherwise one-way dead ends leave infinite entries in the matrix
+    _, components = connected_components(lengths, connection="strong")
+    routable = components == np.bincount(components).argmax()
+    return RoadGraph(
+        node_ids=node_ids,
+        coords=np.column_stack([gdf_nodes["x"], gdf_nodes["y"]]),
+        lengths=lengths,
+        travel_times=get_csr(edges, "travel_time", n),
+        routable=routable,
+    )
+
+
+def get_unit_sphere_coords(coords: np.ndarray) -> np.ndarray:
+    lon, lat = np.radians(coords[:, 0]), np.radians(coords[:, 1])
+    return np.column_stack(
+        [np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)]
+    )
+
+
+def get_chord_meters(chord: np.ndarray) -> np.ndarray:
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.minimum(chord / 2, 1))
+
+
+def get_network_paths(
+    points: np.ndarray,
+    networks_dir: str = NETWORKS_DIR,
+    buffer_m: float = NETWORK_BUFFER_M,
+) -> tuple:
+    # drive network around the points, (lon, lat) rows, downloaded once per
+    # area and saved in the same GeoJSON layout as lscp's Washington network
+    points = np.asarray(points, dtype=np.float64)
+    center = (points.min(axis=0) + points.max(axis=0)) / 2
+    chord = np.linalg.norm(
+        get_unit_sphere_coords(points) - get_unit_sphere_coords(center[None, :]),
+        axis=1,
+    )
+    radius = float(np.ceil(get_chord_meters(chord).max() + buffer_m))
+    key = hashlib.sha1(np.round(np.append(center, radius), 4).tobytes()).hexdigest()
+    nodes_path = Path(networks_dir) / f"nodes_{key[:12]}.geojson"
+    edges_path = Path(networks_dir) / f"edges_{key[:12]}.geojson"
+    if not (nodes_path.is_file() and edges_path.is_file()):
+        G = ox.graph_from_point(
+            (float(center[1]), float(center[0])), dist=radius, network_type="drive"
+        )
+        gdf_nodes, gdf_edges = ox.graph_to_gdfs(G)
+        nodes_path.parent.mkdir(parents=True, exist_ok=True)
+        gdf_nodes.to_file(nodes_path, driver="GeoJSON")
+        gdf_edges.to_file(edges_path, driver="GeoJSON")
+    return str(nodes_path), str(edges_path)
+
+
+def snap_points(
+    graph: RoadGraph,
+    points: np.ndarray,
+    max_snap_distance: float = MAX_SNAP_DISTANCE_M,
+) -> tuple:
+    # points are (lon, lat) rows; returns node indices and snap distances (m)
+    candidates = np.flatnonzero(graph.routable)
+    tree = cKDTree(get_unit_sphere_coords(graph.coords[candidates]))
+    chord, positions = tree.query(get_unit_sphere_coords(np.asarray(points, float)))
+    snap_distances = get_chord_meters(chord)
+    # a point outside the graph's area snaps to its edge, or another city
+    if snap_distances.max() > max_snap_distance:
+        far = np.flatnonzero(snap_distances > max_snap_distance)
+        raise ValueError(
+            f"{len(far)} points are more than {max_snap_distance} m from the "
+            f"network, up to {round(float(snap_distances.max()))} m, e.g. rows "
+            f"{far[:5].tolist()}; the graph does not cover the points"
+        )
+    return candidates[positions], snap_distances
+
+
+def init_worker(matrix: sp.csr_matrix) -> None:
+    _network_cache["matrix"] = matrix
+
+
+def get_distances_from_sources(
+    sources: np.ndarray, targets: np.ndarray
+) -> np.ndarray:
+    return dijkstra(_network_cache["matrix"], indices=sources)[:, targets]
+
+
+def get_dijkstra_matrix(
+    matrix: sp.csr_matrix, nodes: np.ndarray, n_jobs: int = None
+) -> np.ndarray:
+    unique_nodes, inverse = np.unique(nodes, return_inverse=True)
+    n_jobs = min(n_jobs or os.cpu_count() or 1, len(unique_nodes))
+    chunks = np.array_split(unique_nodes, n_jobs)
+    if n_jobs == 1:
+        init_worker(matrix)
+        rows = [get_distances_from_sources(chunks[0], unique_nodes)]
+    else:
+        with ProcessPoolExecutor(
+            max_workers=n_jobs, initializer=init_worker, initargs=(matrix,)
+        ) as executor:
+            rows = list(
+                executor.map(
+                    get_distances_from_sources, chunks, [unique_nodes] * n_jobs
+                )
+            )
+    return np.vstack(rows)[np.ix_(inverse, inverse)]
+
+
+def get_witness_distances(
+    out_edges: list, source: int, targets: set, skipped: int, limit: float
+) -> dict:
+    # bounded Dijkstra around the node being contracted; tentative
+    # distances are real path lengths, so they are valid witnesses too
+    distances = {source: 0.0}
+    heap = [(0.0, source)]
+    remaining = set(targets)
+    settled = 0
+    while heap and remaining and settled < WITNESS_SETTLED_LIMIT:
+        distance, node = heapq.heappop(heap)
+        if distance > distances[node]:
+            continue
+        if distance > limit:
+            break
+        remaining.discard(node)
+        settled += 1
+        for neighbour, weight in out_edges[node].items():
+            if neighbour == skipped:
+                continue
+            new_distance = distance + weight
+            if new_distance < distances.get(neighbour, np.inf):
+                distances[neighbour] = new_distance
+                heapq.heappush(heap, (new_distance, neighbour))
+    return distances
+
+
+def get_shortcuts(out_edges: list, in_edges: list, node: int) -> list:
+    shortcuts = []
+    for source, in_weight in in_edges[node].items():
+        outgoing = {
+            target: weight
+            for target, weight in out_edges[node].items()
+            if target != source
+        }
+        if not outgoing:
+            continue
+        witnesses = get_witness_distances(
+            out_edges, source, outgoing, node, in_weight + max(outgoing.values())
+        )
+        for target, out_weight in outgoing.items():
+            if witnesses.get(target, np.inf) > in_weight + out_weight:
+                shortcuts.append((source, target, in_weight + out_weight))
+    return shortcuts
+
+
+def get_upward_csr(upward_edges: list) -> tuple:
+    indptr = np.cumsum([0] + [len(edges) for edges in upward_edges])
+    indices = np.array(
+        [target for edges in upward_edges for target in edges], dtype=np.int64
+    )
+    weights = np.array(
+        [weight for edges in upward_edges for weight in edges.values()],
+        dtype=np.float64,
+    )
+    return indptr, indices, weights
+
+
+def build_contraction_hierarchy(
+    matrix: sp.csr_matrix, name: str, cache_dir: str = CH_CACHE_DIR
+) -> dict:
+    cache_path = Path(cache_dir) / f"{name}.npz"
+    input_hash = hashlib.sha1(matrix.indptr.tobytes())
+    input_hash.update(matrix.indices.tobytes())
+    input_hash.update(matrix.data.tobytes())
+    input_hash = input_hash.hexdigest()
+    if cache_path.is_file():
+        hierarchy = dict(np.load(cache_path))
+        if str(hierarchy["input_hash"]) == input_hash:
+            return hierarchy
+    n = matrix.shape[0]
+    coo = matrix.tocoo()
+    out_edges = [{} for _ in range(n)]
+    in_edges = [{} for _ in range(n)]
+    for u, v, weight in zip(coo.row, coo.col, coo.data):
+        out_edges[u][v] = in_edges[v][u] = float(weight)
+    deleted_neighbours = np.zeros(n, dtype=int)
+
+    def get_priority(node: int) -> int:
+        # edge difference plus contracted neighbours keeps the order uniform
+        return (
+            len(get_shortcuts(out_edges, in_edges, node))
+            - len(in_edges[node])
+            - len(out_edges[node])
+            + deleted_neighbours[node]
+        )
+
+    heap = [(get_priority(node), node) for node in range(n)]
+    heapq.heapify(heap)
+    rank = np.full(n, -1, dtype=np.int64)
+    forward_up = [{} for _ in range(n)]
+    backward_up = [{} for _ in range(n)]
+    order = 0
+    while heap:
+        _, node = heapq.heappop(heap)
+        # lazy update: contract only if the node is still the cheapest
+        priority = get_priority(node)
+        if heap and priority > heap[0][0]:
+            heapq.heappush(heap, (priority, node))
+            continue
+        shortcuts = get_shortcuts(out_edges, in_edges, node)
+        rank[node] = order
+        order += 1
+        for source, weight in in_edges[node].items():
+            del out_edges[source][node]
+            deleted_neighbours[source] += 1
+            backward_up[node][source] = weight
+        for target, weight in out_edges[node].items():
+            del in_edges[target][node]
+            deleted_neighbours[target] += 1
+            forward_up[node][target] = weight
+        out_edges[node].clear()
+        in_edges[node].clear()
+        for source, target, weight in shortcuts:
+            if weight < out_edges[source].get(target, np.inf):
+                out_edges[source][target] = in_edges[target][source] = weight
+    forward = get_upward_csr(forward_up)
+    backward = get_upward_csr(backward_up)
+    hierarchy = {
+        "rank": rank,
+        "forward_indptr": forward[0],
+        "forward_indices": forward[1],
+        "forward_weights": forward[2],
+        "backward_indptr": backward[0],
+        "backward_indices": backward[1],
+        "backward_weights": backward[2],
+        "input_hash": np.array(input_hash),
+    }
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    np.savez(cache_path, **hierarchy)
+    return hierarchy
+
+
+def get_upward_distances(
+    indptr: np.ndarray, indices: np.ndarray, weights: np.ndarray, source: int
+) -> dict:
+    distances = {source: 0.0}
+    heap = [(0.0, source)]
+    settled = {}
+    while heap:
+        distance, node = heapq.heappop(heap)
+        if node in settled:
+            continue
+        settled[node] = distance
+        for position in range(indptr[node], indptr[node + 1]):
+            neighbour = indices[position]
+            new_distance = distance + weights[position]
+            if new_distance < distances.get(neighbour, np.inf):
+                distances[neighbour] = new_distance
+                heapq.heappush(heap, (new_distance, neighbour))
+    return settled
+
+
+def get_hierarchy_matrix(hierarchy: dict, nodes: np.ndarray) -> np.ndarray:
+    # many-to-many bucket query: backward upward searches from every target
+    # fill buckets that the forward upward searches from the sources scan
+    unique_nodes, inverse = np.unique(nodes, return_inverse=True)
+    buckets = {}
+    for position, target in enumerate(unique_nodes):
+        for node, distance in get_upward_distances(
+            hierarchy["backward_indptr"],
+            hierarchy["backward_indices"],
+            hierarchy["backward_weights"],
+            target,
+        ).items():
+            buckets.setdefault(node, []).append((position, distance))
+    distances = np.full((len(unique_nodes), len(unique_nodes)), np.inf)
+    for row, source in enumerate(unique_nodes):
+        for node, distance in get_upward_distances(
+            hierarchy["forward_indptr"],
+            hierarchy["forward_indices"],
+            hierarchy["forward_weights"],
+            source,
+        ).items():
+            for column, target_distance in buckets.get(node, []):
+                if distance + target_distance < distances[row, column]:
+                    distances[row, column] = distance + target_distance
+    return distances[np.ix_(inverse, inverse)]
+
+
+def get_od_matrix(
+    graph: RoadGraph,
+    points: np.ndarray,
+    weight: str = "length",
+    use_contraction_hierarchy: bool = False,
+    n_jobs: int = None,
+    max_snap_distance: float = MAX_SNAP_DISTANCE_M,
+) -> np.ndarray:
+    # points are (lon, lat) rows, e.g. the depot followed by the customers;
+    # lengths are in meters and travel times in seconds
+    matrix = graph.lengths if weight == "length" else graph.travel_times
+    nodes, snap_distances = snap_points(graph, points, max_snap_distance)
+    print(
+        f"Snapped {len(nodes)} points to the network, "
+        f"max snap distance {round(float(snap_distances.max()), 1)} m"
+    )
+    if use_contraction_hierarchy:
+        hierarchy = build_contraction_hierarchy(matrix, weight)
+        distances = get_hierarchy_matrix(hierarchy, nodes)
+    else:
+        distances = get_dijkstra_matrix(matrix, nodes, n_jobs)
+    np.fill_diagonal(distances, 0)
+    return distances
@@ -0,0 +1,213 @@
+import hashlib
+import heapq
+from dataclasses import dataclass
+from pathlib import Path
+
+import numpy as np
+import pulp
+import scipy.sparse as sp
+
+from scipy.sparse.csgraph import shortest_path
+
+
+EARTH_RADIUS_KM = 6371.0
+ALL_PAIRS_DIR = "data/east_africa/all_pairs_paths"
+
+
+@dataclass
+class Graph:
+    # forward and reverse adjacency of the finite, non-zero distances
+    forward: sp.csr_matrix
+    backward: sp.csr_matrix
+
+
+@dataclass
+class AllPairsPaths:
+    distances: np.ndarray
+    predecessors: np.ndarray
+
+
+def get_graph(distances: np.ndarray) -> Graph:
+    # missing edges are inf and the diagonal is inf or zero, as in optimum_route
+    valid = np.isfinite(distances) & (distances > 0)
+    rows, columns = np.nonzero(valid)
+    forward = sp.csr_matrix(
+        (distances[rows, columns], (rows, columns)), shape=distances.shape
+    )
+    return Graph(forward=forward, backward=forward.T.tocsr())
+
+
+def get_edges(graph: Graph) -> tuple:
+    forward = graph.forward.tocoo()
+    return forward.row, forward.col, forward.data
+
+
+def get_haversine_km(coords: np.ndarray, target: int) -> np.ndarray:
+    # coords are (lat, lng) rows
+    lat, lon = np.radians(coords[:, 0]), np.radians(coords[:, 1])
+    d_lat, d_lon = lat - lat[target], lon - lon[target]
+    a = (
+        np.sin(d_lat / 2) ** 2
+        + np.cos(lat) * np.cos(lat[target]) * np.sin(d_lon / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+
+
+def get_path_cost(distances: np.ndarray, path: list) -> float:
+    return float(sum(distances[i, j] for i, j in zip(path, path[1:])))
+
+
+def get_path_from_parents(parents: dict, end: int) -> list:
+    path = [end]
+    while parents[path[-1]] is not None:
+        path.append(parents[path[-1]])
+    return path[::-1]
+
+
+def get_a_star_path(
+    graph: Graph, start: int, end: int, heuristic: np.ndarray = None
+) -> tuple:
+    # plain Dijkstra without a heuristic; the heuristic must not overestimate
+    if heuristic is None:
+        heuristic = np.zeros(graph.forward.shape[0])
+    matrix = graph.forward
+    costs = {start: 0.0}
+    parents = {start: None}
+    settled = set()
+    heap = [(heuristic[start], start)]
+    while heap:
+        _, node = heapq.heappop(heap)
+        if node in settled:
+            continue
+        if node == end:
+            return costs[end], get_path_from_parents(parents, end)
+        settled.add(node)
+        for neighbour, weight in zip(
+            matrix.indices[matrix.indptr[node] : matrix.indptr[node + 1]].tolist(),
+            matrix.data[matrix.indptr[node] : matrix.indptr[node + 1]].tolist(),
+        ):
+            cost = costs[node] + weight
+            if cost < costs.get(neighbour, np.inf):
+                costs[neighbour] = cost
+                parents[neighbour] = node
+                heapq.heappush(heap, (cost + heuristic[neighbour], neighbour))
+    return np.inf, []
+
+
+def get_dijkstra_path(graph: Graph, start: int, end: int) -> tuple:
+    return get_a_star_path(graph, start, end)
+
+
+def get_haversine_a_star_path(
+    graph: Graph, start: int, end: int, coords: np.ndarray, units_per_km: float = 1.0
+) -> tuple:
+    # admissible when distances are road distances in units_per_km per km
+    return get_a_star_path(
+        graph, start, end, get_haversine_km(coords, end) * units_per_km
+    )
+
+
+def get_bidirectional_path(graph: Graph, start: int, end: int) -> tuple:
+    # alternate forward and backward searches; stop once the two frontier
+    # minima together can no longer beat the best meeting point
+    if start == end:
+        return 0.0, [start]
+    adjacency = [graph.forward, graph.backward]
+    costs = [{start: 0.0}, {end: 0.0}]
+    parents = [{start: None}, {end: None}]
+    settled = [set(), set()]
+    heaps = [[(0.0, start)], [(0.0, end)]]
+    best, meeting = np.inf, None
+    while heaps[0] and heaps[1]:
+        if heaps[0][0][0] + heaps[1][0][0] >= best:
+            break
+        side = 0 if heaps[0][0][0] <= heaps[1][0][0] else 1
+        cost, node = heapq.heappop(heaps[side])
+        if node in settled[side]:
+            continue
+        settled[side].add(node)
+        matrix = adjacency[side]
+        for neighbour, weight in zip(
+            matrix.indices[matrix.indptr[node] : matrix.indptr[node + 1]].tolist(),
+            matrix.data[matrix.indptr[node] : matrix.indptr[node + 1]].tolist(),
+        ):
+            new_cost = cost + weight
+            if new_cost < costs[side].get(neighbour, np.inf):
+                costs[side][neighbour] = new_cost
+                parents[side][neighbour] = node
+                heapq.heappush(heaps[side], (new_cost, neighbour))
+            if neighbour in costs[1 - side]:
+                total = costs[side][neighbour] + costs[1 - side][neighbour]
+                if total < best:
+                    best, meeting = total, neighbour
+    if meeting is None:
+        return np.inf, []
+    forward_path = get_path_from_parents(parents[0], meeting)
+    backward_path = get_path_from_parents(parents[1], meeting)
+    return best, forward_path + backward_path[::-1][1:]
+
+
+def get_all_pairs_path(graph: Graph, cache_dir: str) -> Path:
+    # keyed by the edges, so changed cities or distances get a new file
+    digest = hashlib.sha1(np.array(graph.forward.shape).tobytes())
+    for values in [graph.forward.indptr, graph.forward.indices, graph.forward.data]:
+        digest.update(np.ascontiguousarray(values).tobytes())
+    return Path(cache_dir) / f"all_pairs_{digest.hexdigest()[:12]}.npz"
+
+
+def get_all_pairs_paths(graph: Graph, cache_dir: str = None) -> AllPairsPaths:
+    # one Dijkstra per origin, kept with the predecessor matrix so that any
+    # origin-destination path is a lookup afterwards
+    cache_path = None if cache_dir is None else get_all_pairs_path(graph, cache_dir)
+    if cache_path is not None and cache_path.is_file():
+        cached = np.load(cache_path)
+        return AllPairsPaths(cached["distances"], cached["predecessors"])
+    distances, predecessors = shortest_path(
+        graph.forward, method="D", directed=True, return_predecessors=True
+    )
+    if cache_path is not None:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        np.savez(cache_path, distances=distances, predecessors=predecessors)
+    return AllPairsPaths(distances, predecessors)
+
+
+def get_path(all_pairs: AllPairsPaths, start: int, end: int) -> tuple:
+    if not np.isfinite(all_pairs.distances[start, end]):
+        return np.inf, []
+    path = [end]
+    while path[-1] != start:
+        path.append(int(all_pairs.predecessors[start, path[-1]]))
+    return float(all_pairs.distances[start, end]), path[::-1]
+
+
+def get_shortest_path_lp(graph: Graph, start: int, end: int) -> tuple:
+    # flow formulation built from edge lists, O(E) instead of membership
+    # tests over a list of all edges for every node
+    rows, columns, weights = get_edges(graph)
+    n = graph.forward.shape[0]
+    prob = pulp.LpProblem("shortest_path", pulp.LpMinimize)
+    x = pulp.LpVariable.dicts(
+        "x",
+        zip(rows.tolist(), columns.tolist()),
+        lowBound=0,
+        upBound=1,
+        cat=pulp.LpInteger,
+    )
+    prob += pulp.lpSum(weight * x[i, j] for i, j, weight in zip(rows, columns, weights))
+    outgoing = [[] for _ in range(n)]
+    incoming = [[] for _ in range(n)]
+    for i, j in x:
+        outgoing[i].append(x[i, j])
+        incoming[j].append(x[i, j])
+    for i in range(n):
+        supply = 1 if i == start else -1 if i == end else 0
+        prob += pulp.lpSum(outgoing[i]) - pulp.lpSum(incoming[i]) == supply
+    return prob, x
+
+
+def get_lp_path(x: dict, start: int, end: int) -> list:
+    successors = {i: j for (i, j), variable in x.items() if variable.varValue > 0.5}
+    path = [start]
+    while path[-1] != end:
+        path.append(successors[path[-1]])
+    return path
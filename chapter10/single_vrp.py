@@ -3,19 +3,30 @@ import argparse
 import utils
 
 
-def main(api_key: str) -> None:
-    g_maps_client = utils.get_gmaps_client(api_key)
+def main(
+    api_key: str, offline_network: bool = False, lazy_subtours: bool = False
+) -> None:
     data_gdf = utils.generate_data_for_vrp()
     print("The number of packages:", data_gdf["customer_demand"].sum())
-    distances = utils.get_origin_destination_cost_matrix(data_gdf, g_maps_client, True)
-    x, vehicles = utils.get_optimal_distances_for_vrp(1, distances)
+    if offline_network:
+        distances = utils.get_network_cost_matrix(data_gdf)
+    else:
+        g_maps_client = utils.get_gmaps_client(api_key)
+        distances = utils.get_origin_destination_cost_matrix(
+            data_gdf, g_maps_client, True
+        )
+    x, vehicles = utils.get_optimal_distances_for_vrp(1, distances, lazy_subtours)
     routes = utils.get_vrt_routes(x, vehicles)
     utils.plot_vrp_solution(data_gdf, routes)
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument("--api_key", type=str, required=True)
+    parser.add_argument("--api_key", type=str)
+    parser.add_argument("--offline_network", action="store_true")
+    parser.add_argument("--lazy_subtours", action="store_true")
 
     args = parser.parse_args()
-    main(args.api_key)
+    if not args.offline_network and not args.api_key:
+        parser.error("--api_key is required unless --offline_network is set")
+    main(args.api_key, args.offline_network, args.lazy_subtours)
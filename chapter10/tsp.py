@@ -1,4 +1,5 @@
 import argparse
+import time
 
 import contextily as cx
 import geopandas as gpd
@@ -6,73 +7,191 @@ import matplotlib.pyplot as plt
 import numpy as np
 import pulp
 
-import constants
 import utils
+import vrp_heuristics
 
 
-def get_optimal_distances(distances: np.array):
+def get_nearest_neighbour_tour(distances: np.ndarray) -> list:
+    n = len(distances)
+    visited = np.zeros(n, dtype=bool)
+    visited[0] = True
+    tour = [0]
+    for _ in range(n - 1):
+        costs = np.where(visited, np.inf, distances[tour[-1]])
+        tour.append(int(costs.argmin()))
+        visited[tour[-1]] = True
+    return tour + [0]
+
+
+def get_greedy_edge_tour(distances: np.ndarray) -> list:
+    # cheapest arcs first, skipping those that close a cycle too early
+    n = len(distances)
+    costs = np.array(distances, dtype=np.float64)
+    np.fill_diagonal(costs, np.inf)
+    successor = np.full(n, -1)
+    has_predecessor = np.zeros(n, dtype=bool)
+    fragment = list(range(n))
+
+    def find(i: int) -> int:
+        while fragment[i] != i:
+            fragment[i] = fragment[fragment[i]]
+            i = fragment[i]
+        return i
+
+    arcs = 0
+    for arc in np.argsort(costs, axis=None, kind="stable"):
+        i, j = divmod(int(arc), n)
+        if successor[i] >= 0 or has_predecessor[j] or find(i) == find(j):
+            continue
+        successor[i] = j
+        has_predecessor[j] = True
+        fragment[find(i)] = find(j)
+        arcs += 1
+        if arcs == n - 1:
+            break
+    # the remaining path runs from the node without a predecessor to the
+    # node without a successor
+    node = int(np.flatnonzero(~has_predecessor)[0])
+    path = [node]
+    while successor[node] >= 0:
+        node = int(successor[node])
+        path.append(node)
+    depot = path.index(0)
+    return path[depot:] + path[:depot] + [0]
+
+
+def get_heuristic_tour(
+    distances: np.ndarray,
+    construction: str = "greedy_edge",
+    time_limit: float = 10.0,
+    n_neighbours: int = vrp_heuristics.N_NEIGHBOURS,
+) -> list:
+    # construction, then 2-opt and Or-opt restricted to neighbour lists
+    start = time.time()
+    distances = np.asarray(distances, dtype=np.float64)
+    if construction == "nearest_neighbour":
+        tour = get_nearest_neighbour_tour(distances)
+    else:
+        tour = get_greedy_edge_tour(distances)
+    route_set = vrp_heuristics.RouteSet(
+        [tour], distances, np.zeros(len(distances)), np.inf
+    )
+    print(f"{construction} tour: {round(route_set.get_cost())}")
+    vrp_heuristics.run_local_search(
+        route_set,
+        vrp_heuristics.get_neighbour_lists(distances, n_neighbours),
+        start + time_limit,
+        np.random.default_rng(0),
+    )
+    print(
+        f"Improved tour: {round(route_set.get_cost())}, "
+        f"{round(time.time() - start, 2)} s"
+    )
+    return route_set.routes[0]
+
+
+def get_tour_routes(tour: list) -> list:
+    return sorted(zip(tour, tour[1:]))
+
+
+def set_warm_start(x: dict, u: dict, tour: list) -> None:
+    for variable in x.values():
+        variable.setInitialValue(0)
+    for i, j in zip(tour, tour[1:]):
+        x[i, j].setInitialValue(1)
+    for position, i in enumerate(tour[1:-1], start=2):
+        u[i].setInitialValue(position)
+
+
+def get_optimal_distances(
+    distances: np.array,
+    initial_tour: list = None,
+    time_limit: float = None,
+    gap: float = None,
+):
+    n = len(distances)
+    nodes = range(n)
     tsp_problem = pulp.LpProblem("tsp_mip", pulp.LpMinimize)
+    # no x[i, i] variables instead of fixing them to zero
     x = pulp.LpVariable.dicts(
         "x",
-        (
-            (i, j)
-            for i in range(constants.CUSTOMERS + 1)
-            for j in range(constants.CUSTOMERS + 1)
-        ),
+        ((i, j) for i in nodes for j in nodes if i != j),
         lowBound=0,
         upBound=1,
         cat="Binary",
     )
     u = pulp.LpVariable.dicts(
         "u",
-        (i for i in range(constants.CUSTOMERS + 1)),
+        (i for i in nodes),
         lowBound=1,
-        upBound=(constants.CUSTOMERS + 1),
+        upBound=n,
         cat="Integer",
     )
-    tsp_problem += pulp.lpSum(
-        distances[i][j] * x[i, j]
-        for i in range(constants.CUSTOMERS + 1)
-        for j in range(constants.CUSTOMERS + 1)
+    tsp_problem += pulp.lpSum(distances[i][j] * x[i, j] for i, j in x)
+    for i in nodes:
+        tsp_problem += pulp.lpSum(x[i, j] for j in nodes if j != i) == 1
+        tsp_problem += pulp.lpSum(x[j, i] for j in nodes if j != i) == 1
+    for i, j in x:
+        if i != 0 and j != 0:
+            tsp_problem += u[i] - u[j] <= n * (1 - x[i, j]) - 1
+    if initial_tour is not None:
+        set_warm_start(x, u, initial_tour)
+    solver = pulp.PULP_CBC_CMD(
+        warmStart=initial_tour is not None, timeLimit=time_limit, gapRel=gap
     )
-    for i in range(constants.CUSTOMERS + 1):
-        tsp_problem += x[i, i] == 0
-    for i in range(constants.CUSTOMERS + 1):
-        tsp_problem += pulp.lpSum(x[i, j] for j in range(constants.CUSTOMERS + 1)) == 1
-        tsp_problem += pulp.lpSum(x[j, i] for j in range(constants.CUSTOMERS + 1)) == 1
-    for i in range(constants.CUSTOMERS + 1):
-        for j in range(constants.CUSTOMERS + 1):
-            if i != j and (i != 0 and j != 0):
-                tsp_problem += (
-                    u[i] - u[j] <= (constants.CUSTOMERS + 1) * (1 - x[i, j]) - 1
-                )
-    status = tsp_problem.solve()
+    status = tsp_problem.solve(solver)
     return x
 
 
-def get_routes(x: np.array) -> list:
-    routes = [
-        (i, j)
-        for i in range(constants.CUSTOMERS + 1)
-        for j in range(constants.CUSTOMERS + 1)
-        if pulp.value(x[i, j]) == 1
-    ]
+def get_routes(x: dict) -> list:
+    routes = [(i, j) for (i, j), variable in x.items() if pulp.value(variable) > 0.5]
 
     return routes
 
 
-def main(api_key: str) -> None:
-    g_maps_client = utils.get_gmaps_client(api_key)
+def main(
+    api_key: str,
+    offline_network: bool = False,
+    construction: str = None,
+    heuristic_only: bool = False,
+    time_limit: float = None,
+    gap: float = None,
+) -> None:
     data_gdf = utils.generate_data()
-    distances = utils.get_origin_destination_cost_matrix(data_gdf, g_maps_client)
-    x = get_optimal_distances(distances)
-    routes = get_routes(x)
+    if offline_network:
+        distances = utils.get_network_cost_matrix(data_gdf)
+    else:
+        g_maps_client = utils.get_gmaps_client(api_key)
+        distances = utils.get_origin_destination_cost_matrix(data_gdf, g_maps_client)
+    tour = None
+    if construction or heuristic_only:
+        tour = get_heuristic_tour(distances, construction or "greedy_edge")
+    if heuristic_only:
+        routes = get_tour_routes(tour)
+    else:
+        # the heuristic tour is the MIP start for the exact model
+        x = get_optimal_distances(distances, tour, time_limit, gap)
+        routes = get_routes(x)
     utils.plot_tsp_solution(data_gdf, routes)
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument("--api_key", type=str, required=True)
+    parser.add_argument("--api_key", type=str)
+    parser.add_argument("--offline_network", action="store_true")
+    parser.add_argument("--construction", choices=["nearest_neighbour", "greedy_edge"])
+    parser.add_argument("--heuristic_only", action="store_true")
+    parser.add_argument("--time_limit", type=float)
+    parser.add_argument("--gap", type=float)
 
     args = parser.parse_args()
-    main(args.api_key)
+    if not args.offline_network and not args.api_key:
+        parser.error("--api_key is required unless --offline_network is set")
+    main(
+        args.api_key,
+        args.offline_network,
+        args.construction,
+        args.heuristic_only,
+        args.time_limit,
+        args.gap,
+    )
@@ -12,6 +12,8 @@ import pulp
 from googlemaps import Client
 
 import constants
+import od_matrix
+import road_network
 
 
 np.random.seed(32)
@@ -63,21 +65,34 @@ def get_origin_destination_cost_matrix(
     file_name = f"data/new_york/distances_{len(data_gdf) - 1}.npy"
     if Path(file_name).is_file() and use_saved_distances:
         return np.load(file_name)
-    distances = np.zeros((len(data_gdf), len(data_gdf)))
-    data_gdf["coord"] = (
-        data_gdf.latitude.astype(str) + "," + data_gdf.longitude.astype(str)
+    distances = od_matrix.get_distance_matrix(
+        data_gdf[["latitude", "longitude"]].to_numpy(), g_maps_client, mode="driving"
     )
-    for lat in range(len(data_gdf)):
-        for lon in range(len(data_gdf)):
-            maps_api_result = g_maps_client.directions(
-                data_gdf["coord"].iloc[lat], data_gdf["coord"].iloc[lon], mode="driving"
-            )
-            distances[lat][lon] = maps_api_result[0]["legs"][0]["distance"]["value"]
     distances = distances.astype(int)
     np.save(file_name, distances)
     return distances
 
 
+def get_network_cost_matrix(
+    data_gdf: gpd.GeoDataFrame,
+    weight: str = "length",
+    use_contraction_hierarchy: bool = False,
+    nodes_path: str = None,
+    edges_path: str = None,
+) -> np.array:
+    # offline alternative to the Google matrix from an OSM graph, in the same
+    # layout: depot first, integer meters (or seconds); without paths the
+    # drive network around the points is downloaded and cached
+    points = data_gdf[["longitude", "latitude"]].to_numpy()
+    if nodes_path is None or edges_path is None:
+        nodes_path, edges_path = road_network.get_network_paths(points)
+    graph = road_network.load_graph(nodes_path, edges_path)
+    distances = road_network.get_od_matrix(
+        graph, points, weight, use_contraction_hierarchy
+    )
+    return np.round(distances).astype(int)
+
+
 def get_vrp_problem_variables(vehicles: int) -> list:
     x = [
         [
@@ -108,7 +123,7 @@ def get_objective_function(
 
 
 def add_vrt_constraints(
-    lp_problem: pulp.LpProblem, vehicles: int, x: list
+    lp_problem: pulp.LpProblem, vehicles: int, x: list, lazy_subtours: bool = False
 ) -> pulp.LpProblem:
     for j in range(1, constants.CUSTOMERS + 1):
         lp_problem += (
@@ -119,12 +134,15 @@ def add_vrt_constraints(
             )
             == 1
         )
+    # named so that a fleet-size search can switch vehicles on and off
     for k in range(vehicles):
         lp_problem += (
-            pulp.lpSum(x[0][j][k] for j in range(1, constants.CUSTOMERS + 1)) == 1
+            pulp.lpSum(x[0][j][k] for j in range(1, constants.CUSTOMERS + 1)) == 1,
+            f"depart_{k}",
         )
         lp_problem += (
-            pulp.lpSum(x[i][0][k] for i in range(1, constants.CUSTOMERS + 1)) == 1
+            pulp.lpSum(x[i][0][k] for i in range(1, constants.CUSTOMERS + 1)) == 1,
+            f"return_{k}",
         )
     for k in range(vehicles):
         for j in range(constants.CUSTOMERS + 1):
@@ -136,11 +154,23 @@ def add_vrt_constraints(
                 == 0
             )
 
-    lp_problem = add_subtours_constraint(lp_problem, vehicles, x)
+    if not lazy_subtours:
+        lp_problem = add_subtours_constraint(lp_problem, vehicles, x)
 
     return lp_problem
 
 
+def get_subtour_constraint(s: tuple, vehicles: int, x: list) -> pulp.LpConstraint:
+    return (
+        pulp.lpSum(
+            x[i][j][k] if i != j else 0
+            for i, j in itertools.permutations(s, 2)
+            for k in range(vehicles)
+        )
+        <= len(s) - 1
+    )
+
+
 def add_subtours_constraint(
     lp_problem: pulp.LpProblem, vehicles: int, x: list
 ) -> pulp.LpProblem:
@@ -148,67 +178,130 @@ def add_subtours_constraint(
     for i in range(2, constants.CUSTOMERS + 1):
         subtours += itertools.combinations(range(1, constants.CUSTOMERS + 1), i)
     for s in subtours:
-        lp_problem += (
-            pulp.lpSum(
-                x[i][j][k] if i != j else 0
-                for i, j in itertools.permutations(s, 2)
-                for k in range(vehicles)
-            )
-            <= len(s) - 1
-        )
+        lp_problem += get_subtour_constraint(s, vehicles, x)
 
     return lp_problem
 
 
+def get_subtours(x: list, vehicles: int) -> list:
+    # components of the incumbent's arcs that do not reach the depot
+    parents = list(range(constants.CUSTOMERS + 1))
+
+    def find(i: int) -> int:
+        while parents[i] != i:
+            parents[i] = parents[parents[i]]
+            i = parents[i]
+        return i
+
+    for _, i, j in get_vrt_routes(x, vehicles):
+        parents[find(i)] = find(j)
+    components = {}
+    for i in range(1, constants.CUSTOMERS + 1):
+        components.setdefault(find(i), []).append(i)
+    return [
+        tuple(component)
+        for root, component in components.items()
+        if root != find(0) and len(component) > 1
+    ]
+
+
+def solve_with_lazy_subtours(
+    lp_problem: pulp.LpProblem, vehicles: int, x: list, solver=None
+) -> int:
+    # cutting-plane loop: solve without subtour constraints and add only the
+    # cuts the incumbent violates, until it is connected to the depot
+    cuts = 0
+    while True:
+        status = lp_problem.solve(solver)
+        if status != 1:
+            return status
+        subtours = get_subtours(x, vehicles)
+        if not subtours:
+            print(f"Subtour cuts added: {cuts}")
+            return status
+        for s in subtours:
+            lp_problem += get_subtour_constraint(s, vehicles, x)
+        cuts += len(subtours)
+
+
+def solve_problem(
+    lp_problem: pulp.LpProblem, vehicles: int, x: list, lazy_subtours: bool = False
+) -> int:
+    if lazy_subtours:
+        return solve_with_lazy_subtours(
+            lp_problem, vehicles, x, pulp.PULP_CBC_CMD(msg=False)
+        )
+    return lp_problem.solve()
+
+
 def add_problem_variables_and_constraints(
-    lp_problem: pulp.LpProblem, distances: np.array, vehicles: int
+    lp_problem: pulp.LpProblem,
+    distances: np.array,
+    vehicles: int,
+    lazy_subtours: bool = False,
 ):
     x = get_vrp_problem_variables(vehicles)
     lp_problem += get_objective_function(distances, vehicles, x)
-    lp_problem = add_vrt_constraints(lp_problem, vehicles, x)
+    lp_problem = add_vrt_constraints(lp_problem, vehicles, x, lazy_subtours)
 
     return lp_problem, x
 
 
-def get_optimal_distances_for_vrp(vehicles: int, distances: np.array) -> tuple:
+def get_optimal_distances_for_vrp(
+    vehicles: int, distances: np.array, lazy_subtours: bool = False
+) -> tuple:
     for vehicles in range(1, vehicles + 1):
         lp_problem = pulp.LpProblem("VRP", pulp.LpMinimize)
         lp_problem, x = add_problem_variables_and_constraints(
-            lp_problem, distances, vehicles
+            lp_problem, distances, vehicles, lazy_subtours
         )
         # lp_problem = add_subtours_constraint(lp_problem, vehicles, x)
-        if lp_problem.solve() == 1:
+        if solve_problem(lp_problem, vehicles, x, lazy_subtours) == 1:
             print("# Required Vehicles:", vehicles)
             print("Distance:", pulp.value(lp_problem.objective))
             break
     return x, vehicles
 
 
+def add_capacity_constraints(
+    lp_problem: pulp.LpProblem,
+    data_gdf: gpd.GeoDataFrame,
+    vehicles: int,
+    x: list,
+    capacity: int,
+) -> pulp.LpProblem:
+    for k in range(vehicles):
+        lp_problem += (
+            pulp.lpSum(
+                data_gdf.customer_demand[j] * x[i][j][k] if i != j else 0
+                for i in range(constants.CUSTOMERS + 1)
+                for j in range(1, constants.CUSTOMERS + 1)
+            )
+            <= capacity
+        )
+    return lp_problem
+
+
 def get_optimal_distances_for_capacitated_vrp(
     data_gdf: gpd.GeoDataFrame,
     distances: np.array,
     vehicles: int,
     capacity: int,
+    lazy_subtours: bool = False,
 ) -> tuple:
     for vehicles in range(1, vehicles + 1):
         # Linear Programming Problem
         lp_problem = pulp.LpProblem("CVRP", pulp.LpMinimize)
         lp_problem, x = add_problem_variables_and_constraints(
-            lp_problem, distances, vehicles
+            lp_problem, distances, vehicles, lazy_subtours
         )
 
         # Adding in the capacity constraint
-        for k in range(vehicles):
-            lp_problem += (
-                pulp.lpSum(
-                    data_gdf.customer_demand[j] * x[i][j][k] if i != j else 0
-                    for i in range(constants.CUSTOMERS + 1)
-                    for j in range(1, constants.CUSTOMERS + 1)
-                )
-                <= capacity
-            )
+        lp_problem = add_capacity_constraints(
+            lp_problem, data_gdf, vehicles, x, capacity
+        )
 
-        if lp_problem.solve() == 1:
+        if solve_problem(lp_problem, vehicles, x, lazy_subtours) == 1:
             print("# Required Vehicles:", vehicles)
             print("Distance:", pulp.value(lp_problem.objective))
             break
@@ -0,0 +1,287 @@
+import time
+
+import numpy as np
+
+
+N_NEIGHBOURS = 20
+MAX_SEGMENT_LENGTH = 3
+PERTURBATION_MOVES = 4
+
+
+def get_neighbour_lists(distances: np.ndarray, n_neighbours: int) -> np.ndarray:
+    # nearest customers in either direction, depot excluded
+    symmetric = np.minimum(distances, distances.T).astype(np.float64)
+    np.fill_diagonal(symmetric, np.inf)
+    symmetric[:, 0] = np.inf
+    n_neighbours = min(n_neighbours, len(distances) - 2)
+    neighbours = np.argpartition(symmetric, n_neighbours, axis=1)[:, :n_neighbours]
+    order = np.take_along_axis(symmetric, neighbours, axis=1).argsort(axis=1)
+    return np.take_along_axis(neighbours, order, axis=1)
+
+
+def get_savings_routes(
+    distances: np.ndarray, demand: np.ndarray, capacity: float
+) -> list:
+    # Clarke-Wright: merge the route ending at i with the route starting at j
+    # in decreasing order of d(i, 0) + d(0, j) - d(i, j)
+    n = len(distances)
+    savings = distances[1:, [0]] + distances[[0], 1:] - distances[1:, 1:]
+    np.fill_diagonal(savings, -np.inf)
+    candidates = np.flatnonzero(savings > 0)
+    candidates = candidates[np.argsort(-savings.ravel()[candidates], kind="stable")]
+    routes = {i: [i] for i in range(1, n)}
+    route_of = np.arange(n)
+    loads = {i: demand[i] for i in range(1, n)}
+    for candidate in candidates:
+        i, j = divmod(int(candidate), n - 1)
+        i, j = i + 1, j + 1
+        first, second = route_of[i], route_of[j]
+        if first == second or routes[first][-1] != i or routes[second][0] != j:
+            continue
+        if loads[first] + loads[second] > capacity:
+            continue
+        routes[first] += routes.pop(second)
+        loads[first] += loads.pop(second)
+        route_of[routes[first]] = first
+    return [[0] + route + [0] for route in routes.values()]
+
+
+class RouteSet:
+    # routes are depot-delimited lists; per-route prefix sums of forward and
+    # backward arc costs and of loads make every move delta O(1)
+    def __init__(
+        self, routes: list, distances: np.ndarray, demand: np.ndarray, capacity: float
+    ):
+        self.distances = distances
+        self.demand = demand
+        self.capacity = capacity
+        self.route_of = np.zeros(len(distances), dtype=int)
+        self.position = np.zeros(len(distances), dtype=int)
+        self.set_routes(routes)
+
+    def set_routes(self, routes: list) -> None:
+        self.routes = [list(route) for route in routes if len(route) > 2]
+        self.forward = [None] * len(self.routes)
+        self.backward = [None] * len(self.routes)
+        self.loads = [None] * len(self.routes)
+        for r in range(len(self.routes)):
+            self.update_route(r)
+
+    def update_route(self, r: int) -> None:
+        route = np.array(self.routes[r])
+        self.route_of[route[1:-1]] = r
+        self.position[route[1:-1]] = np.arange(1, len(route) - 1)
+        self.forward[r] = np.concatenate(
+            [[0], np.cumsum(self.distances[route[:-1], route[1:]])]
+        )
+        self.backward[r] = np.concatenate(
+            [[0], np.cumsum(self.distances[route[1:], route[:-1]])]
+        )
+        self.loads[r] = np.cumsum(self.demand[route])
+
+    def update_routes(self, *route_indices: int) -> None:
+        if any(len(self.routes[r]) <= 2 for r in route_indices):
+            self.set_routes(self.routes)
+        else:
+            for r in set(route_indices):
+                self.update_route(r)
+
+    def get_cost(self) -> float:
+        return float(sum(forward[-1] for forward in self.forward))
+
+    def get_load(self, r: int) -> float:
+        return self.loads[r][-1]
+
+    def get_segment_cost(self, r: int, start: int, stop: int, reverse: bool) -> float:
+        prefix = self.backward[r] if reverse else self.forward[r]
+        return prefix[stop] - prefix[start]
+
+    def try_relocate(self, u: int, v: int) -> bool:
+        # Or-opt: move the segment starting at u next to v, in either order
+        d = self.distances
+        r1, p1 = self.route_of[u], self.position[u]
+        r2, p2 = self.route_of[v], self.position[v]
+        route1, route2 = self.routes[r1], self.routes[r2]
+        for length in range(1, MAX_SEGMENT_LENGTH + 1):
+            end = p1 + length - 1
+            if end > len(route1) - 2:
+                break
+            segment_load = self.loads[r1][end] - self.loads[r1][p1 - 1]
+            if r1 != r2 and self.get_load(r2) + segment_load > self.capacity:
+                break
+            first, last = route1[p1], route1[end]
+            prev, next_ = route1[p1 - 1], route1[end + 1]
+            removal = d[prev, next_] - d[prev, first] - d[last, next_]
+            for insert_after in (p2, p2 - 1):
+                if r1 == r2 and p1 - 1 <= insert_after <= end:
+                    continue
+                a, b = route2[insert_after], route2[insert_after + 1]
+                delta = removal + d[a, first] + d[last, b] - d[a, b]
+                if delta < -1e-9:
+                    segment = route1[p1 : end + 1]
+                    if r1 == r2:
+                        remaining = route1[:p1] + route1[end + 1 :]
+                        at = insert_after - (length if insert_after > end else 0)
+                        remaining[at + 1 : at + 1] = segment
+                        self.routes[r1] = remaining
+                    else:
+                        del route1[p1 : end + 1]
+                        route2[insert_after + 1 : insert_after + 1] = segment
+                    self.update_routes(r1, r2)
+                    return True
+        return False
+
+    def try_exchange(self, u: int, v: int) -> bool:
+        d = self.distances
+        r1, p1 = self.route_of[u], self.position[u]
+        r2, p2 = self.route_of[v], self.position[v]
+        if r1 == r2 and abs(p1 - p2) <= 1:
+            return False
+        if r1 != r2 and (
+            self.get_load(r1) - self.demand[u] + self.demand[v] > self.capacity
+            or self.get_load(r2) - self.demand[v] + self.demand[u] > self.capacity
+        ):
+            return False
+        route1, route2 = self.routes[r1], self.routes[r2]
+        a, b = route1[p1 - 1], route1[p1 + 1]
+        c, e = route2[p2 - 1], route2[p2 + 1]
+        delta = (
+            d[a, v] + d[v, b] + d[c, u] + d[u, e]
+            - d[a, u] - d[u, b] - d[c, v] - d[v, e]
+        )
+        if delta < -1e-9:
+            route1[p1], route2[p2] = v, u
+            self.update_routes(r1, r2)
+            return True
+        return False
+
+    def try_two_opt(self, u: int, v: int) -> bool:
+        d = self.distances
+        r1, p1 = self.route_of[u], self.position[u]
+        r2, p2 = self.route_of[v], self.position[v]
+        route1, route2 = self.routes[r1], self.routes[r2]
+        if r1 == r2:
+            # reverse the path between u and v so that they become adjacent
+            p1, p2 = min(p1, p2), max(p1, p2)
+            if p2 - p1 < 2:
+                return False
+            a, b = route1[p1], route1[p1 + 1]
+            c, e = route1[p2], route1[p2 + 1]
+            delta = (
+                d[a, c] + d[b, e] - d[a, b] - d[c, e]
+                + self.get_segment_cost(r1, p1 + 1, p2, True)
+                - self.get_segment_cost(r1, p1 + 1, p2, False)
+            )
+            if delta < -1e-9:
+                route1[p1 + 1 : p2 + 1] = route1[p1 + 1 : p2 + 1][::-1]
+                self.update_routes(r1)
+                return True
+            return False
+        # 2-opt*: exchange the tails after u and after v
+        new_load1 = self.loads[r1][p1] + self.get_load(r2) - self.loads[r2][p2]
+        new_load2 = self.loads[r2][p2] + self.get_load(r1) - self.loads[r1][p1]
+        if max(new_load1, new_load2) > self.capacity:
+            return False
+        b, e = route1[p1 + 1], route2[p2 + 1]
+        delta = d[u, e] + d[v, b] - d[u, b] - d[v, e]
+        if delta < -1e-9:
+            tail1, tail2 = route1[p1 + 1 :], route2[p2 + 1 :]
+            self.routes[r1] = route1[: p1 + 1] + tail2
+            self.routes[r2] = route2[: p2 + 1] + tail1
+            self.update_routes(r1, r2)
+            return True
+        return False
+
+
+def run_local_search(
+    route_set: RouteSet,
+    neighbours: np.ndarray,
+    deadline: float,
+    rng: np.random.Generator,
+) -> None:
+    improved = True
+    while improved and time.time() < deadline:
+        improved = False
+        for u in rng.permutation(np.arange(1, len(neighbours))):
+            for v in neighbours[u]:
+                if (
+                    route_set.try_two_opt(u, v)
+                    or route_set.try_relocate(u, v)
+                    or route_set.try_exchange(u, v)
+                ):
+                    improved = True
+            if time.time() >= deadline:
+                return
+
+
+def perturb(
+    route_set: RouteSet, neighbours: np.ndarray, rng: np.random.Generator
+) -> None:
+    # random capacity-feasible relocations between nearby customers
+    for _ in range(PERTURBATION_MOVES):
+        u = int(rng.integers(1, len(neighbours)))
+        v = int(rng.choice(neighbours[u]))
+        r1, p1 = route_set.route_of[u], route_set.position[u]
+        r2, p2 = route_set.route_of[v], route_set.position[v]
+        if r1 == r2 or (
+            route_set.get_load(r2) + route_set.demand[u] > route_set.capacity
+        ):
+            continue
+        del route_set.routes[r1][p1]
+        route_set.routes[r2].insert(p2 + 1, u)
+        route_set.update_routes(r1, r2)
+
+
+def get_vrp_routes(routes: list) -> list:
+    return [
+        (k, i, j) for k, route in enumerate(routes) for i, j in zip(route, route[1:])
+    ]
+
+
+def solve_vrp(
+    distances: np.ndarray,
+    demand: np.ndarray = None,
+    capacity: float = None,
+    time_limit: float = 10.0,
+    n_neighbours: int = N_NEIGHBOURS,
+    random_state: int = 0,
+) -> tuple:
+    # same inputs as the MILPs (depot first, customer_demand) and routes in
+    # their (k, i, j) format; without a capacity it is a single-vehicle tour
+    start = time.time()
+    deadline = start + time_limit
+    distances = np.asarray(distances, dtype=np.float64)
+    n = len(distances)
+    demand = np.zeros(n) if demand is None else np.asarray(demand, dtype=np.float64)
+    capacity = np.inf if capacity is None else capacity
+    if demand[1:].max() > capacity:
+        raise ValueError("A customer's demand exceeds the vehicle capacity")
+    rng = np.random.default_rng(random_state)
+    neighbours = get_neighbour_lists(distances, n_neighbours)
+    route_set = RouteSet(
+        get_savings_routes(distances, demand, capacity), distances, demand, capacity
+    )
+    print(
+        f"Savings construction: {len(route_set.routes)} routes, "
+        f"cost {round(route_set.get_cost())}, {round(time.time() - start, 2)} s"
+    )
+    run_local_search(route_set, neighbours, deadline, rng)
+    best_routes = [list(route) for route in route_set.routes]
+    best_cost = route_set.get_cost()
+    print(f"Local search: cost {round(best_cost)}, {round(time.time() - start, 2)} s")
+    iterations = 0
+    # iterated local search until the time limit
+    while time.time() < deadline:
+        iterations += 1
+        perturb(route_set, neighbours, rng)
+        run_local_search(route_set, neighbours, deadline, rng)
+        if route_set.get_cost() < best_cost - 1e-9:
+            best_routes = [list(route) for route in route_set.routes]
+            best_cost = route_set.get_cost()
+        else:
+            route_set.set_routes(best_routes)
+    print(
+        f"Best cost {round(best_cost)} with {len(best_routes)} vehicles after "
+        f"{iterations} perturbations, {round(time.time() - start, 2)} s"
+    )
+    return get_vrp_routes(best_routes), len(best_routes)
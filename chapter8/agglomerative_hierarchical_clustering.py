@@ -1,16 +1,25 @@
 import geopandas as gpd
 import numpy as np
+import pandas as pd
 
 from pysal.lib import weights
 from libpysal.weights import Queen, KNN
 from sklearn.cluster import AgglomerativeClustering
 
 import constants
+import hierarchy
+import regionalization
+import run_registry
 import utils
 
 
 np.random.seed(32)
 
+WEIGHTS = {
+    "queen": lambda ny_census: Queen.from_dataframe(ny_census),
+    "knn": lambda ny_census: KNN.from_dataframe(ny_census, k=10),
+}
+
 
 def fit_model(
     ny_census: gpd.GeoDataFrame, label_column_name: str, w: weights.weights = None
@@ -25,15 +34,70 @@ def fit_model(
     return ny_census
 
 
+def fit_regionalization_model(
+    ny_census: gpd.GeoDataFrame,
+    label_column_name: str,
+    w: weights.weights,
+    method: str = "ward",
+    n_clusters: int = 5,
+) -> gpd.GeoDataFrame:
+    features = ny_census[constants.GEO_DEMO_RN].to_numpy()
+    if method == "ward":
+        labels = regionalization.constrained_ward(features, w.sparse, n_clusters)
+    elif method == "skater":
+        labels = regionalization.skater(features, w.sparse, n_clusters)
+    else:
+        raise ValueError(f"Unknown regionalization method: {method}")
+    ny_census[label_column_name] = labels
+    return ny_census
+
+
+def fit_cached_model(
+    ny_census: gpd.GeoDataFrame, label_column_name: str, connectivity: str = None
+) -> tuple:
+    # weights are only built when the cached run is missing or stale
+    def fit() -> np.ndarray:
+        w = WEIGHTS[connectivity](ny_census) if connectivity else None
+        return fit_model(ny_census, label_column_name, w)[label_column_name].to_numpy()
+
+    run = run_registry.get_or_fit_run(
+        ny_census,
+        label_column_name,
+        {"model": "ward", "n_clusters": 5, "connectivity": connectivity},
+        fit,
+    )
+    ny_census[label_column_name] = run["labels"]
+    return ny_census, run
+
+
 def fit_model_and_plot_clusters(
-    ny_census: gpd.GeoDataFrame, label_column_name: str, w: weights.weights = None
+    ny_census: gpd.GeoDataFrame, label_column_name: str, connectivity: str = None
 ) -> None:
-    ny_census = fit_model(ny_census, label_column_name, w)
+    ny_census, run = fit_cached_model(ny_census, label_column_name, connectivity)
     ward5sizes = ny_census.groupby(label_column_name).size()
     utils.plot_clusters_choropleth(ny_census, label_column_name, "Set3")
     utils.plot_radial_plot(
-        ny_census.groupby(label_column_name)[constants.GEO_DEMO_RN].mean()
+        pd.DataFrame(run["centroids"], columns=constants.GEO_DEMO_RN)
+    )
+
+
+def fit_hierarchy_and_plot_clusters(
+    ny_census: gpd.GeoDataFrame,
+    name: str,
+    K: range,
+    w: weights.weights = None,
+) -> gpd.GeoDataFrame:
+    ward_hierarchy = hierarchy.fit_hierarchy(
+        ny_census[constants.GEO_DEMO_RN].to_numpy(), name, w.sparse if w else None
     )
+    for k in K:
+        label_column_name = f"{name}_{k}_label"
+        ny_census[label_column_name] = hierarchy.get_labels(ward_hierarchy, k)
+        utils.plot_clusters_choropleth(ny_census, label_column_name, "Set3")
+        utils.plot_radial_plot(
+            hierarchy.get_cluster_means(ward_hierarchy, k, constants.GEO_DEMO_RN)
+        )
+    return ny_census
 
 
 if __name__ == "__main__":
@@ -41,8 +105,5 @@ if __name__ == "__main__":
     fit_model_and_plot_clusters(ny_census, "ward5_label")
 
     # spatially constrained clustering
-    spatial_w = Queen.from_dataframe(ny_census)
-    fit_model_and_plot_clusters(ny_census, "ward5wgt_label", spatial_w)
-
-    knn_spatial_w = KNN.from_dataframe(ny_census, k=10)
-    fit_model_and_plot_clusters(ny_census, "ward5_knnwgt_label", knn_spatial_w)
+    fit_model_and_plot_clusters(ny_census, "ward5wgt_label", "queen")
+    fit_model_and_plot_clusters(ny_census, "ward5_knnwgt_label", "knn")
@@ -0,0 +1,168 @@
+import numpy as np
+import pandas as pd
+
+
+CHUNK_BYTES = 2**28
+Z_95 = 1.959964
+
+
+def get_cluster_statistics(features: np.ndarray, labels: np.ndarray) -> tuple:
+    n_clusters = labels.max() + 1
+    counts = np.bincount(labels, minlength=n_clusters).astype(np.float64)
+    sums = np.zeros((n_clusters, features.shape[1]))
+    np.add.at(sums, labels, features)
+    squares = np.bincount(
+        labels, weights=np.einsum("ij,ij->i", features, features), minlength=n_clusters
+    )
+    return counts, sums, squares
+
+
+def get_calinski_harabasz_and_davies_bouldin(
+    features: np.ndarray, labels: np.ndarray
+) -> tuple:
+    n = len(features)
+    counts, sums, squares = get_cluster_statistics(features, labels)
+    n_clusters = len(counts)
+    centroids = sums / counts[:, None]
+    within = (squares - np.einsum("ij,ij->i", sums, sums) / counts).sum()
+    total_sum = sums.sum(axis=0)
+    total = squares.sum() - total_sum @ total_sum / n
+    ch_score = (
+        (total - within) * (n - n_clusters) / (within * (n_clusters - 1))
+        if within > 0
+        else 1.0
+    )
+    # DB needs the mean (not squared) distance to the centroid, which sums
+    # and squares cannot provide, so it takes one O(n * d) pass
+    scatter = np.bincount(
+        labels,
+        weights=np.linalg.norm(features - centroids[labels], axis=1),
+        minlength=n_clusters,
+    ) / counts
+    centroid_distances = np.linalg.norm(
+        centroids[:, None, :] - centroids[None, :, :], axis=2
+    )
+    np.fill_diagonal(centroid_distances, np.inf)
+    db_score = np.max(
+        (scatter[:, None] + scatter[None, :]) / centroid_distances, axis=1
+    ).mean()
+    return ch_score, db_score
+
+
+def get_silhouette_values(
+    features: np.ndarray,
+    label_sets: list,
+    rows: np.ndarray,
+    chunk_bytes: int = CHUNK_BYTES,
+) -> np.ndarray:
+    chunk_size = max(1, chunk_bytes // (8 * len(features)))
+    squared_norms = np.einsum("ij,ij->i", features, features)
+    one_hots = []
+    counts = []
+    for labels in label_sets:
+        n_clusters = labels.max() + 1
+        one_hot = np.zeros((len(labels), n_clusters))
+        one_hot[np.arange(len(labels)), labels] = 1
+        one_hots.append(one_hot)
+        counts.append(np.bincount(labels, minlength=n_clusters).astype(np.float64))
+    values = np.zeros((len(label_sets), len(rows)))
+    for start in range(0, len(rows), chunk_size):
+        chunk = rows[start : start + chunk_size]
+        # one distance block per chunk, shared by every label set
+        distances = (
+            squared_norms[chunk, None]
+            - 2 * features[chunk] @ features.T
+            + squared_norms[None, :]
+        )
+        distances = np.sqrt(np.maximum(distances, 0))
+        distances[np.arange(len(chunk)), chunk] = 0
+        for m, labels in enumerate(label_sets):
+            cluster_sums = distances @ one_hots[m]
+            own = labels[chunk]
+            own_counts = counts[m][own]
+            a = cluster_sums[np.arange(len(chunk)), own] / np.maximum(own_counts - 1, 1)
+            means = cluster_sums / counts[m]
+            means[np.arange(len(chunk)), own] = np.inf
+            b = means.min(axis=1)
+            s = (b - a) / np.maximum(a, b)
+            values[m, start : start + len(chunk)] = np.where(own_counts > 1, s, 0)
+    return values
+
+
+def get_stratified_sample(
+    strata: np.ndarray, sample_size: int, random_state: int
+) -> tuple:
+    rng = np.random.default_rng(random_state)
+    stratum_ids, stratum_counts = np.unique(strata, return_counts=True)
+    allocation = np.maximum(
+        np.round(sample_size * stratum_counts / len(strata)).astype(int), 2
+    )
+    allocation = np.minimum(allocation, stratum_counts)
+    rows = [
+        rng.choice(np.flatnonzero(strata == stratum), size, replace=False)
+        for stratum, size in zip(stratum_ids, allocation)
+    ]
+    return rows, stratum_counts / len(strata)
+
+
+def get_sampled_silhouette(
+    features: np.ndarray,
+    label_sets: list,
+    strata: np.ndarray,
+    sample_size: int,
+    random_state: int,
+) -> tuple:
+    stratum_rows, stratum_weights = get_stratified_sample(
+        strata, sample_size, random_state
+    )
+    rows = np.concatenate(stratum_rows)
+    values = get_silhouette_values(features, label_sets, rows)
+    means = np.zeros(len(label_sets))
+    variances = np.zeros(len(label_sets))
+    start = 0
+    for stratum, weight in zip(stratum_rows, stratum_weights):
+        stratum_values = values[:, start : start + len(stratum)]
+        means += weight * stratum_values.mean(axis=1)
+        # a one-row stratum is sampled whole and adds no sampling variance
+        if len(stratum) > 1:
+            variances += (
+                weight**2 * stratum_values.var(axis=1, ddof=1) / len(stratum)
+            )
+        start += len(stratum)
+    half_width = Z_95 * np.sqrt(variances)
+    return means, means - half_width, means + half_width
+
+
+def get_scores(
+    data: pd.DataFrame,
+    feature_columns: list,
+    label_columns: list,
+    sample_size: int = None,
+    strata_column: str = None,
+    random_state: int = 0,
+) -> pd.DataFrame:
+    features = data[feature_columns].to_numpy(dtype=np.float64)
+    label_sets = [
+        pd.factorize(data[column])[0].astype(np.int64) for column in label_columns
+    ]
+    scores = []
+    for column, labels in zip(label_columns, label_sets):
+        ch_score, db_score = get_calinski_harabasz_and_davies_bouldin(features, labels)
+        scores.append({"model": column, "CH score": ch_score, "DB score": db_score})
+    scores_df = pd.DataFrame(scores).set_index("model")
+    if sample_size is None or sample_size >= len(features):
+        values = get_silhouette_values(features, label_sets, np.arange(len(features)))
+        scores_df["Silhouettescore"] = values.mean(axis=1)
+    else:
+        strata = (
+            pd.factorize(data[strata_column])[0]
+            if strata_column
+            else label_sets[0]
+        )
+        means, lower, upper = get_sampled_silhouette(
+            features, label_sets, strata, sample_size, random_state
+        )
+        scores_df["Silhouettescore"] = means
+        scores_df["Silhouette CI lower"] = lower
+        scores_df["Silhouette CI upper"] = upper
+    return scores_df
@@ -0,0 +1,101 @@
+import hashlib
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+from sklearn.cluster import ward_tree
+
+
+HIERARCHY_CACHE_DIR = "data/us_census/hierarchies"
+
+
+def get_input_hash(features: np.ndarray, connectivity: sp.spmatrix = None) -> str:
+    input_hash = hashlib.sha1(np.ascontiguousarray(features).tobytes())
+    if connectivity is not None:
+        connectivity = sp.csr_matrix(connectivity)
+        input_hash.update(connectivity.indptr.tobytes())
+        input_hash.update(connectivity.indices.tobytes())
+    return input_hash.hexdigest()
+
+
+def get_node_statistics(features: np.ndarray, children: np.ndarray) -> tuple:
+    n = len(features)
+    sizes = np.ones(2 * n - 1)
+    sums = np.zeros((2 * n - 1, features.shape[1]))
+    sums[:n] = features
+    for step, (left, right) in enumerate(children):
+        sizes[n + step] = sizes[left] + sizes[right]
+        sums[n + step] = sums[left] + sums[right]
+    return sizes, sums
+
+
+def fit_hierarchy(
+    features: np.ndarray,
+    name: str,
+    connectivity: sp.spmatrix = None,
+    cache_dir: str = HIERARCHY_CACHE_DIR,
+) -> dict:
+    features = np.asarray(features, dtype=np.float64)
+    input_hash = get_input_hash(features, connectivity)
+    cache_path = Path(cache_dir) / f"{name}.npz"
+    if cache_path.is_file():
+        hierarchy = dict(np.load(cache_path))
+        if str(hierarchy["input_hash"]) == input_hash:
+            return hierarchy
+    children, _, n_leaves, _, distances = ward_tree(
+        features, connectivity=connectivity, return_distance=True
+    )
+    sizes, sums = get_node_statistics(features, children)
+    n = len(features)
+    parents = np.full(2 * n - 1, 2 * n - 2)
+    parents[children.ravel()] = np.repeat(np.arange(n, 2 * n - 1), 2)
+    hierarchy = {
+        "children": children,
+        "distances": distances,
+        "parents": parents,
+        "sizes": sizes,
+        "sums": sums,
+        "n_leaves": np.array(n_leaves),
+        "input_hash": np.array(input_hash),
+    }
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    np.savez(cache_path, **hierarchy)
+    return hierarchy
+
+
+def get_cluster_roots(hierarchy: dict, k: int) -> tuple:
+    # after the first n - k merges the clusters are the nodes whose parent
+    # has not been formed yet
+    n = int(hierarchy["n_leaves"])
+    parents = hierarchy["parents"]
+    nodes = np.arange(2 * n - 1)
+    is_root = parents - n >= n - k
+    is_root[nodes >= 2 * n - k] = False
+    if k == 1:
+        is_root[-1] = True
+    return np.flatnonzero(is_root), is_root
+
+
+def get_labels(hierarchy: dict, k: int) -> np.ndarray:
+    n = int(hierarchy["n_leaves"])
+    roots, is_root = get_cluster_roots(hierarchy, k)
+    ancestors = np.where(is_root, np.arange(len(is_root)), hierarchy["parents"])
+    # pointer jumping: O(n log depth) instead of walking every leaf up
+    while True:
+        jumped = np.where(is_root[ancestors], ancestors, ancestors[ancestors])
+        if np.array_equal(jumped, ancestors):
+            break
+        ancestors = jumped
+    return np.searchsorted(roots, ancestors[:n])
+
+
+def get_labels_for_k_range(hierarchy: dict, K: range) -> pd.DataFrame:
+    return pd.DataFrame({k: get_labels(hierarchy, k) for k in K})
+
+
+def get_cluster_means(hierarchy: dict, k: int, columns: list) -> pd.DataFrame:
+    roots, _ = get_cluster_roots(hierarchy, k)
+    means = hierarchy["sums"][roots] / hierarchy["sizes"][roots, None]
+    return pd.DataFrame(means, columns=columns)
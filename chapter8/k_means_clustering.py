@@ -1,3 +1,5 @@
+import argparse
+
 import geopandas as gpd
 import matplotlib.pyplot as plt
 import numpy as np
@@ -7,27 +9,27 @@ import plotly.graph_objects as go
 from sklearn.cluster import KMeans
 
 import constants
+import k_selection
+import run_registry
+import streaming_k_means
 import utils
 
 
 np.random.seed(0)
 
 
-def get_and_plot_distortion(ny_census: gpd.GeoDataFrame) -> None:
-    distortions = []
+def get_and_plot_distortion(ny_census: gpd.GeoDataFrame) -> int:
     K = range(1, 15)
-    ny_census.dropna(inplace=True)
-    for k in K:
-        # Instantiating the model
-        kmeans = KMeans(n_clusters=k)
-        kmeans.fit(ny_census[constants.GEO_DEMO_RN])
-        distortions.append(kmeans.inertia_)
+    features = ny_census[constants.GEO_DEMO_RN].to_numpy()
+    scores, elbow_k = k_selection.sweep_k(features, K, warm_start=True)
     plt.figure(figsize=(16, 10))
-    plt.plot(K, distortions, "bx-")
+    plt.plot(scores["k"], scores["inertia"], "bx-")
+    plt.axvline(elbow_k, color="red", linestyle="--")
     plt.xlabel("k")
     plt.ylabel("Distortion")
     plt.title("Elbow Method for optimal k")
     plt.show()
+    return elbow_k
 
 
 def calculate_tract_average_areas(ny_census: gpd.GeoDataFrame) -> None:
@@ -49,16 +51,48 @@ def fit_model(ny_census: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
     return ny_census
 
 
+def fit_cached_model(ny_census: gpd.GeoDataFrame) -> tuple:
+    run = run_registry.get_or_fit_run(
+        ny_census,
+        "kmeans_5_label",
+        {"model": "kmeans", "n_clusters": 5},
+        lambda: fit_model(ny_census)["kmeans_5_label"].to_numpy(),
+    )
+    ny_census["kmeans_5_label"] = run["labels"]
+    return ny_census, run
+
+
 def get_and_plot_clusters(ny_census: gpd.GeoDataFrame) -> None:
-    ny_census = fit_model(ny_census)
+    ny_census, run = fit_cached_model(ny_census)
     utils.plot_clusters_choropleth(ny_census, "kmeans_5_label", "Set2")
     calculate_tract_average_areas(ny_census)
     utils.plot_radial_plot(
-        ny_census.groupby("kmeans_5_label")[constants.GEO_DEMO_RN].mean()
+        pd.DataFrame(run["centroids"], columns=constants.GEO_DEMO_RN)
+    )
+
+
+def get_and_plot_streaming_clusters(output_path: str) -> None:
+    model = streaming_k_means.get_streaming_clusters(output_path)
+    census = gpd.read_parquet(output_path)
+    census = census[census["kmeans_5_label"] >= 0]
+    utils.plot_clusters_choropleth(census, "kmeans_5_label", "Set2")
+    calculate_tract_average_areas(census)
+    utils.plot_radial_plot(
+        pd.DataFrame(model.cluster_centers_, columns=constants.GEO_DEMO_RN)
     )
 
 
 if __name__ == "__main__":
-    ny_census = gpd.read_file("data/us_census/ny_census_transformed_and_scaled.geojson")
-    get_and_plot_distortion(ny_census)
-    get_and_plot_clusters(ny_census)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--streaming", action="store_true")
+    args = parser.parse_args()
+
+    if args.streaming:
+        get_and_plot_streaming_clusters("data/us_census/kmeans_5_labels.parquet")
+    else:
+        ny_census = gpd.read_file(
+            "data/us_census/ny_census_transformed_and_scaled.geojson"
+        )
+        ny_census.dropna(inplace=True)
+        get_and_plot_distortion(ny_census)
+        get_and_plot_clusters(ny_census)
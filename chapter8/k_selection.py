@@ -0,0 +1,133 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from sklearn.cluster import KMeans
+from sklearn.metrics import calinski_harabasz_score, silhouette_score
+from threadpoolctl import threadpool_limits
+
+
+SILHOUETTE_SAMPLE_SIZE = 10000
+# a warm start only pays off along a run of consecutive k in one worker
+MIN_WARM_START_BLOCK = 4
+
+
+def get_warm_start_centroids(
+    features: np.ndarray, centroids: np.ndarray, random_state: int
+) -> np.ndarray:
+    # add the sample point that is farthest from its nearest k-1 centroid
+    rng = np.random.default_rng(random_state)
+    sample_size = min(len(features), SILHOUETTE_SAMPLE_SIZE)
+    sample = features[rng.choice(len(features), sample_size, replace=False)]
+    distances = (
+        (sample**2).sum(axis=1)[:, None]
+        - 2 * sample @ centroids.T
+        + (centroids**2).sum(axis=1)[None, :]
+    )
+    new_centroid = sample[np.argmax(distances.min(axis=1))]
+    return np.vstack([centroids, new_centroid])
+
+
+def score_k(
+    features: np.ndarray, kmeans: KMeans, silhouette_sample_size: int, random_state: int
+) -> dict:
+    scores = {
+        "k": kmeans.n_clusters,
+        "inertia": kmeans.inertia_,
+        "silhouette": np.nan,
+        "calinski_harabasz": np.nan,
+    }
+    if kmeans.n_clusters > 1:
+        scores["silhouette"] = silhouette_score(
+            features,
+            kmeans.labels_,
+            sample_size=min(len(features), silhouette_sample_size),
+            random_state=random_state,
+        )
+        scores["calinski_harabasz"] = calinski_harabasz_score(features, kmeans.labels_)
+    return scores
+
+
+def fit_k_block(
+    features: np.ndarray,
+    ks: list,
+    warm_start: bool,
+    n_init: int,
+    blas_threads: int,
+    silhouette_sample_size: int,
+    random_state: int,
+) -> list:
+    results = []
+    centroids = None
+    with threadpool_limits(limits=blas_threads):
+        for k in ks:
+            if warm_start and centroids is not None and len(centroids) == k - 1:
+                init = get_warm_start_centroids(features, centroids, random_state)
+                kmeans = KMeans(n_clusters=k, init=init, n_init=1)
+            else:
+                kmeans = KMeans(n_clusters=k, n_init=n_init, random_state=random_state)
+            kmeans.fit(features)
+            centroids = kmeans.cluster_centers_
+            results.append(
+                score_k(features, kmeans, silhouette_sample_size, random_state)
+            )
+    return results
+
+
+def split_k_range(K: range, n_jobs: int, warm_start: bool) -> list:
+    ks = list(K)
+    if warm_start:
+        # contiguous blocks so each worker can reuse its own k-1 centroids; fewer
+        # blocks than workers rather than blocks too short to warm start
+        n_blocks = max(1, min(n_jobs, len(ks) // MIN_WARM_START_BLOCK))
+        return [block.tolist() for block in np.array_split(ks, n_blocks)]
+    return [[k] for k in ks]
+
+
+def get_elbow_k(scores: pd.DataFrame) -> int:
+    k = scores["k"].to_numpy(dtype=float)
+    inertia = scores["inertia"].to_numpy(dtype=float)
+    if len(k) < 3:
+        return int(k[0])
+    k_norm = (k - k.min()) / (k.max() - k.min())
+    inertia_range = inertia.max() - inertia.min()
+    if inertia_range == 0:
+        return int(k[0])
+    inertia_norm = (inertia - inertia.min()) / inertia_range
+    # distance of every point below the chord joining the first and last k
+    chord = inertia_norm[0] + (inertia_norm[-1] - inertia_norm[0]) * k_norm
+    return int(k[np.argmax(chord - inertia_norm)])
+
+
+def sweep_k(
+    features: np.ndarray,
+    K: range = range(1, 15),
+    n_jobs: int = None,
+    blas_threads: int = 1,
+    warm_start: bool = False,
+    n_init: int = 3,
+    silhouette_sample_size: int = SILHOUETTE_SAMPLE_SIZE,
+    random_state: int = 0,
+) -> tuple:
+    features = np.ascontiguousarray(features, dtype=np.float64)
+    n_jobs = n_jobs or max(1, (os.cpu_count() or 1) // blas_threads)
+    blocks = split_k_range(K, min(n_jobs, len(K)), warm_start)
+    with ProcessPoolExecutor(max_workers=min(n_jobs, len(blocks))) as executor:
+        futures = [
+            executor.submit(
+                fit_k_block,
+                features,
+                block,
+                warm_start,
+                n_init,
+                blas_threads,
+                silhouette_sample_size,
+                random_state,
+            )
+            for block in blocks
+        ]
+        results = [result for future in futures for result in future.result()]
+    scores = pd.DataFrame(results).sort_values("k").reset_index(drop=True)
+    return scores, get_elbow_k(scores)
@@ -0,0 +1,177 @@
+import heapq
+
+import numpy as np
+import scipy.sparse as sp
+
+from scipy.sparse.csgraph import (
+    breadth_first_order,
+    connected_components,
+    minimum_spanning_tree,
+)
+
+
+def get_edges(adjacency: sp.spmatrix) -> tuple:
+    # KNN weights are not symmetric, so keep every edge once (i < j)
+    adjacency = sp.csr_matrix(adjacency, dtype=bool)
+    adjacency = sp.triu(adjacency + adjacency.T, k=1).tocoo()
+    return adjacency.row.astype(np.int64), adjacency.col.astype(np.int64)
+
+
+def get_ward_cost(
+    sizes: np.ndarray, sums: np.ndarray, a: int, b: int
+) -> float:
+    difference = sums[a] / sizes[a] - sums[b] / sizes[b]
+    return sizes[a] * sizes[b] / (sizes[a] + sizes[b]) * float(difference @ difference)
+
+
+def relabel(labels: np.ndarray) -> np.ndarray:
+    _, labels = np.unique(labels, return_inverse=True)
+    return labels
+
+
+def constrained_ward(
+    features: np.ndarray, adjacency: sp.spmatrix, n_clusters: int
+) -> np.ndarray:
+    features = np.asarray(features, dtype=np.float64)
+    n = len(features)
+    rows, cols = get_edges(adjacency)
+    sizes = np.ones(n)
+    sums = features.copy()
+    versions = np.zeros(n, dtype=np.int64)
+    parent = np.arange(n)
+    neighbours = [set() for _ in range(n)]
+    for i, j in zip(rows.tolist(), cols.tolist()):
+        neighbours[i].add(j)
+        neighbours[j].add(i)
+    difference = features[rows] - features[cols]
+    costs = 0.5 * np.einsum("ij,ij->i", difference, difference)
+    heap = [
+        (cost, i, j, 0, 0)
+        for cost, i, j in zip(costs.tolist(), rows.tolist(), cols.tolist())
+    ]
+    heapq.heapify(heap)
+
+    n_active = n
+    while n_active > n_clusters and heap:
+        _, a, b, version_a, version_b = heapq.heappop(heap)
+        if versions[a] != version_a or versions[b] != version_b:
+            continue
+        # merge the smaller neighbour set into the larger one
+        if len(neighbours[a]) < len(neighbours[b]):
+            a, b = b, a
+        parent[b] = a
+        sizes[a] += sizes[b]
+        sums[a] += sums[b]
+        versions[a] += 1
+        versions[b] = -1
+        neighbours[a] |= neighbours[b]
+        neighbours[a] -= {a, b}
+        for c in neighbours[b]:
+            neighbours[c].discard(b)
+            if c != a:
+                neighbours[c].add(a)
+        neighbours[b] = set()
+        for c in neighbours[a]:
+            cost = get_ward_cost(sizes, sums, a, c)
+            if a < c:
+                heapq.heappush(heap, (cost, a, c, versions[a], versions[c]))
+            else:
+                heapq.heappush(heap, (cost, c, a, versions[c], versions[a]))
+        n_active -= 1
+
+    # resolve merged clusters to their surviving root
+    while True:
+        grandparent = parent[parent]
+        if np.array_equal(grandparent, parent):
+            break
+        parent = grandparent
+    return relabel(parent)
+
+
+def get_feature_mst(features: np.ndarray, adjacency: sp.spmatrix) -> sp.csr_matrix:
+    n = len(features)
+    rows, cols = get_edges(adjacency)
+    distances = np.linalg.norm(features[rows] - features[cols], axis=1)
+    # zero weights would be dropped as missing edges by csgraph
+    distances = np.maximum(distances, np.finfo(np.float64).tiny)
+    graph = sp.csr_matrix((distances, (rows, cols)), shape=(n, n))
+    mst = minimum_spanning_tree(graph)
+    return (mst + mst.T).tocsr()
+
+
+def get_forest_order(forest: sp.csr_matrix) -> tuple:
+    # a virtual root joined to one node of every tree lets a single BFS
+    # order the whole forest
+    n = forest.shape[0]
+    _, components = connected_components(forest, directed=False)
+    _, roots = np.unique(components, return_index=True)
+    links = sp.csr_matrix(
+        (np.ones(len(roots)), (np.full(len(roots), n), roots)), shape=(n + 1, n + 1)
+    )
+    graph = sp.bmat([[forest, None], [None, sp.csr_matrix((1, 1))]]).tocsr() + links
+    order, predecessors = breadth_first_order(
+        graph, n, directed=False, return_predecessors=True
+    )
+    return order[1:], predecessors[:n], components
+
+
+def get_subtree_statistics(
+    features: np.ndarray, order: np.ndarray, predecessors: np.ndarray
+) -> tuple:
+    n = len(features)
+    depth = np.zeros(n, dtype=np.int64)
+    for node in order:
+        if predecessors[node] < n:
+            depth[node] = depth[predecessors[node]] + 1
+    sizes = np.ones(n)
+    sums = features.copy()
+    squares = np.einsum("ij,ij->i", features, features)
+    for level in range(depth.max(), 0, -1):
+        nodes = np.flatnonzero(depth == level)
+        parents = predecessors[nodes]
+        np.add.at(sizes, parents, sizes[nodes])
+        np.add.at(sums, parents, sums[nodes])
+        np.add.at(squares, parents, squares[nodes])
+    return sizes, sums, squares
+
+
+def get_ssd(sizes: np.ndarray, sums: np.ndarray, squares: np.ndarray) -> np.ndarray:
+    return squares - np.einsum("ij,ij->i", sums, sums) / sizes
+
+
+def skater(
+    features: np.ndarray,
+    adjacency: sp.spmatrix,
+    n_clusters: int,
+    floor: int = 1,
+) -> np.ndarray:
+    features = np.asarray(features, dtype=np.float64)
+    n = len(features)
+    forest = get_feature_mst(features, adjacency).tolil()
+    while True:
+        order, predecessors, components = get_forest_order(forest.tocsr())
+        if components.max() + 1 >= n_clusters:
+            return relabel(components)
+        sizes, sums, squares = get_subtree_statistics(features, order, predecessors)
+        roots = np.flatnonzero(predecessors == n)
+        root_of = roots[components]
+        # every non-root node stands for the edge to its parent
+        nodes = np.flatnonzero(predecessors < n)
+        tree_nodes = root_of[nodes]
+        rest_sizes = sizes[tree_nodes] - sizes[nodes]
+        gain = get_ssd(
+            sizes[tree_nodes], sums[tree_nodes], squares[tree_nodes]
+        ) - (
+            get_ssd(sizes[nodes], sums[nodes], squares[nodes])
+            + get_ssd(
+                np.maximum(rest_sizes, 1),
+                sums[tree_nodes] - sums[nodes],
+                squares[tree_nodes] - squares[nodes],
+            )
+        )
+        gain[(sizes[nodes] < floor) | (rest_sizes < floor)] = -np.inf
+        if len(gain) == 0 or np.isneginf(gain.max()):
+            return relabel(components)
+        cut = nodes[np.argmax(gain)]
+        forest[cut, predecessors[cut]] = 0
+        forest[predecessors[cut], cut] = 0
@@ -0,0 +1,99 @@
+import hashlib
+import json
+import time
+from pathlib import Path
+from typing import Callable
+
+import geopandas as gpd
+import numpy as np
+
+import constants
+
+
+RUNS_DIR = "data/us_census/runs"
+
+
+def get_input_hash(ny_census: gpd.GeoDataFrame) -> str:
+    input_hash = hashlib.sha1(
+        np.ascontiguousarray(
+            ny_census[constants.GEO_DEMO_RN].to_numpy(dtype=np.float64)
+        ).tobytes()
+    )
+    # geometry is part of the input because the spatial weights derive from it
+    for wkb in ny_census.geometry.to_wkb():
+        input_hash.update(wkb)
+    return input_hash.hexdigest()
+
+
+def get_run_path(name: str, runs_dir: str = RUNS_DIR) -> Path:
+    return Path(runs_dir) / f"{name}.npz"
+
+
+def save_run(
+    name: str,
+    labels: np.ndarray,
+    features: np.ndarray,
+    params: dict,
+    input_hash: str,
+    fit_seconds: float,
+    runs_dir: str = RUNS_DIR,
+) -> dict:
+    labels = np.asarray(labels)
+    n_clusters = labels.max() + 1
+    counts = np.bincount(labels, minlength=n_clusters)
+    centroids = np.zeros((n_clusters, features.shape[1]))
+    np.add.at(centroids, labels, features)
+    centroids /= np.maximum(counts, 1)[:, None]
+    run = {
+        "labels": labels.astype(np.min_scalar_type(max(n_clusters - 1, 0))),
+        "centroids": centroids,
+        "params": np.array(json.dumps(params, sort_keys=True)),
+        "input_hash": np.array(input_hash),
+        "fit_seconds": np.array(fit_seconds),
+        "created": np.array(time.time()),
+    }
+    run_path = get_run_path(name, runs_dir)
+    run_path.parent.mkdir(parents=True, exist_ok=True)
+    np.savez_compressed(run_path, **run)
+    return run
+
+
+def load_run(
+    name: str, params: dict, input_hash: str, runs_dir: str = RUNS_DIR
+) -> dict:
+    run_path = get_run_path(name, runs_dir)
+    if not run_path.is_file():
+        return None
+    run = dict(np.load(run_path))
+    if str(run["input_hash"]) != input_hash or str(run["params"]) != json.dumps(
+        params, sort_keys=True
+    ):
+        return None
+    return run
+
+
+def get_or_fit_run(
+    ny_census: gpd.GeoDataFrame,
+    name: str,
+    params: dict,
+    fit: Callable[[], np.ndarray],
+    runs_dir: str = RUNS_DIR,
+) -> dict:
+    input_hash = get_input_hash(ny_census)
+    run = load_run(name, params, input_hash, runs_dir)
+    if run is not None:
+        print(f"Using cached clustering run {name}")
+        return run
+    start = time.time()
+    labels = fit()
+    fit_seconds = time.time() - start
+    print(f"Fitted clustering run {name} in {round(fit_seconds, 2)} seconds")
+    return save_run(
+        name,
+        labels,
+        ny_census[constants.GEO_DEMO_RN].to_numpy(dtype=np.float64),
+        params,
+        input_hash,
+        fit_seconds,
+        runs_dir,
+    )
@@ -0,0 +1,130 @@
+from pathlib import Path
+
+import geopandas as gpd
+import numpy as np
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from sklearn.cluster import KMeans, MiniBatchKMeans
+
+import constants
+
+
+PARTITIONED_CENSUS_PATH = "data/us_census/partitioned"
+BATCH_SIZE = 16384
+INIT_SAMPLE_SIZE = 20000
+
+
+def write_census_partition(
+    census_gdf: gpd.GeoDataFrame,
+    state_fips: str,
+    year: int,
+    dataset_path: str = PARTITIONED_CENSUS_PATH,
+) -> None:
+    partition_path = Path(dataset_path) / f"state={state_fips}" / f"year={year}"
+    partition_path.mkdir(parents=True, exist_ok=True)
+    census_gdf.to_parquet(partition_path / "part-0.parquet")
+
+
+def get_census_dataset(dataset_path: str = PARTITIONED_CENSUS_PATH) -> ds.Dataset:
+    return ds.dataset(dataset_path, format="parquet", partitioning="hive")
+
+
+def get_batch_features(batch: pa.RecordBatch) -> tuple:
+    features = np.column_stack(
+        [
+            batch.column(col).to_numpy(zero_copy_only=False).astype(np.float64)
+            for col in constants.GEO_DEMO_RN
+        ]
+    )
+    valid = ~np.isnan(features).any(axis=1)
+    return features, valid
+
+
+def get_initial_centroids(
+    dataset: ds.Dataset, n_clusters: int, batch_size: int, random_state: int
+) -> np.ndarray:
+    # draw a bounded uniform sample across all partitions so the first
+    # centroids are not biased towards whichever state is read first
+    rng = np.random.default_rng(random_state)
+    sample_rate = min(1.0, INIT_SAMPLE_SIZE / max(dataset.count_rows(), 1))
+    samples = []
+    for batch in dataset.to_batches(
+        columns=constants.GEO_DEMO_RN, batch_size=batch_size
+    ):
+        features, valid = get_batch_features(batch)
+        features = features[valid]
+        samples.append(features[rng.random(len(features)) < sample_rate])
+    sample = np.vstack(samples)
+    kmeans = KMeans(n_clusters=n_clusters, n_init=3, random_state=random_state)
+    return kmeans.fit(sample).cluster_centers_
+
+
+def fit_streaming_model(
+    dataset_path: str = PARTITIONED_CENSUS_PATH,
+    n_clusters: int = 5,
+    n_epochs: int = 3,
+    batch_size: int = BATCH_SIZE,
+    random_state: int = 0,
+) -> MiniBatchKMeans:
+    dataset = get_census_dataset(dataset_path)
+    init = get_initial_centroids(dataset, n_clusters, batch_size, random_state)
+    model = MiniBatchKMeans(
+        n_clusters=n_clusters, init=init, n_init=1, random_state=random_state
+    )
+    for _ in range(n_epochs):
+        for batch in dataset.to_batches(
+            columns=constants.GEO_DEMO_RN, batch_size=batch_size
+        ):
+            features, valid = get_batch_features(batch)
+            if valid.any():
+                model.partial_fit(features[valid])
+    return model
+
+
+def assign_streaming_labels(
+    model: MiniBatchKMeans,
+    output_path: str,
+    label_column_name: str = "kmeans_5_label",
+    dataset_path: str = PARTITIONED_CENSUS_PATH,
+    batch_size: int = BATCH_SIZE,
+) -> None:
+    dataset = get_census_dataset(dataset_path)
+    # keep the geometry (and its GeoParquet metadata) so the labelled output
+    # can be read straight back with gpd.read_parquet for plotting
+    keep_columns = [
+        name for name in dataset.schema.names if name not in constants.GEO_DEMO_RN
+    ]
+    schema = pa.schema(
+        [dataset.schema.field(name) for name in keep_columns]
+        + [pa.field(label_column_name, pa.int32())],
+        metadata=dataset.schema.metadata,
+    )
+    Path(output_path).parent.mkdir(parents=True, exist_ok=True)
+    with pq.ParquetWriter(output_path, schema) as writer:
+        for batch in dataset.to_batches(
+            columns=keep_columns + constants.GEO_DEMO_RN, batch_size=batch_size
+        ):
+            features, valid = get_batch_features(batch)
+            labels = np.full(len(features), -1, dtype=np.int32)
+            if valid.any():
+                labels[valid] = model.predict(features[valid])
+            writer.write_batch(
+                pa.RecordBatch.from_arrays(
+                    [batch.column(name) for name in keep_columns]
+                    + [pa.array(labels)],
+                    schema=schema,
+                )
+            )
+
+
+def get_streaming_clusters(
+    output_path: str,
+    dataset_path: str = PARTITIONED_CENSUS_PATH,
+    label_column_name: str = "kmeans_5_label",
+    n_clusters: int = 5,
+) -> MiniBatchKMeans:
+    model = fit_streaming_model(dataset_path, n_clusters)
+    assign_streaming_labels(model, output_path, label_column_name, dataset_path)
+    return model
@@ -0,0 +1,53 @@
+from dataclasses import dataclass
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+
+
+@dataclass
+class FeatureMatrix:
+    values: np.ndarray
+    columns: list
+    index: np.ndarray
+    y: np.ndarray
+    coords: np.ndarray
+    neighbourhoods: np.ndarray
+    neighbourhood_names: list
+
+    def get(self, columns: list) -> np.ndarray:
+        positions = [self.columns.index(column) for column in columns]
+        return self.values[:, positions]
+
+    def to_frame(self) -> pd.DataFrame:
+        frame = pd.DataFrame(self.values, columns=self.columns)
+        frame.insert(0, "id", self.index)
+        frame["log_price"] = self.y
+        frame["neighbourhood_cleansed"] = np.asarray(self.neighbourhood_names)[
+            self.neighbourhoods
+        ]
+        return frame
+
+
+def build_feature_matrix(
+    listings: gpd.GeoDataFrame,
+    variables: list,
+    target: str = "log_price",
+    regime: str = "neighbourhood_cleansed",
+    id_column: str = "id",
+) -> FeatureMatrix:
+    # one pass over the listings instead of repeated merges on id: every
+    # model variable, the target, the regime and the coordinates together
+    mask = listings[variables + [target, regime]].notna().all(axis=1).to_numpy()
+    mask = mask & np.isfinite(listings[target].to_numpy(dtype=np.float64))
+    listings = listings[mask]
+    neighbourhoods, neighbourhood_names = pd.factorize(listings[regime], sort=True)
+    return FeatureMatrix(
+        values=np.ascontiguousarray(listings[variables].to_numpy(dtype=np.float64)),
+        columns=list(variables),
+        index=listings[id_column].to_numpy(),
+        y=listings[target].to_numpy(dtype=np.float64),
+        coords=np.column_stack([listings.geometry.x, listings.geometry.y]),
+        neighbourhoods=neighbourhoods,
+        neighbourhood_names=list(neighbourhood_names),
+    )
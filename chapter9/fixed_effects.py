@@ -0,0 +1,159 @@
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+
+from scipy import stats
+
+
+@dataclass
+class FixedEffectsResults:
+    name_y: str
+    name_x: list
+    betas: np.ndarray
+    vm: np.ndarray
+    std_err: np.ndarray
+    t_stat: list
+    u: np.ndarray
+    predy: np.ndarray
+    n: int
+    k: int
+    r2: float
+    ar2: float
+    utu: float
+    sig2: float
+    sig2ML: float
+    f_stat: tuple
+    logll: float
+    aic: float
+    schwarz: float
+    mean_y: float
+    std_y: float
+    regimes: list = None
+    summary: str = ""
+
+
+def get_group_means(values: np.ndarray, codes: np.ndarray, counts: np.ndarray):
+    return np.stack(
+        [np.bincount(codes, weights=column) for column in values.T], axis=1
+    ) / counts[:, None]
+
+
+def get_summary(results: FixedEffectsResults) -> str:
+    rows = [
+        "SUMMARY OF OUTPUT: ORDINARY LEAST SQUARES - FIXED EFFECTS (WITHIN)",
+        "-" * 84,
+        f"Dependent Variable  : {results.name_y:>11}"
+        f"                Number of Observations: {results.n:>11}",
+        f"Mean dependent var  : {results.mean_y:>11.4f}"
+        f"                Number of Variables   : {results.k:>11}",
+        f"S.D. dependent var  : {results.std_y:>11.4f}"
+        f"                Degrees of Freedom    : {results.n - results.k:>11}",
+        f"R-squared           : {results.r2:>11.4f}",
+        f"Adjusted R-squared  : {results.ar2:>11.4f}",
+        f"Sum squared residual: {results.utu:>11.3f}"
+        f"                F-statistic           : {results.f_stat[0]:>11.4f}",
+        f"Sigma-square        : {results.sig2:>11.3f}"
+        f"                Prob(F-statistic)     : {results.f_stat[1]:>11.4g}",
+        f"S.E. of regression  : {np.sqrt(results.sig2):>11.3f}"
+        f"                Log likelihood        : {results.logll:>11.3f}",
+        f"Sigma-square ML     : {results.sig2ML:>11.3f}"
+        f"                Akaike info criterion : {results.aic:>11.3f}",
+        f"S.E of regression ML: {np.sqrt(results.sig2ML):>11.4f}"
+        f"                Schwarz criterion     : {results.schwarz:>11.3f}",
+        "",
+        "-" * 84,
+        f"{'Variable':>20}{'Coefficient':>16}{'Std.Error':>16}"
+        f"{'t-Statistic':>16}{'Probability':>16}",
+        "-" * 84,
+    ]
+    for name, beta, std_err, (t_stat, p_value) in zip(
+        results.name_x, results.betas.ravel(), results.std_err, results.t_stat
+    ):
+        rows.append(
+            f"{name:>20}{beta:>16.5f}{std_err:>16.5f}{t_stat:>16.5f}{p_value:>16.5f}"
+        )
+    rows.append("-" * 84)
+    return "\n".join(rows)
+
+
+def fit_fixed_effects(
+    y: np.ndarray,
+    x: np.ndarray,
+    regimes: list,
+    name_y: str = "y",
+    name_x: list = None,
+) -> FixedEffectsResults:
+    y = np.asarray(y, dtype=np.float64).reshape(-1)
+    x = np.asarray(x, dtype=np.float64)
+    n, n_vars = x.shape
+    name_x = name_x or [f"var_{i + 1}" for i in range(n_vars)]
+    codes, regime_names = pd.factorize(pd.Series(regimes), sort=True)
+    # factorize codes missing regimes as -1; dropping them would misalign u
+    if (codes < 0).any():
+        raise ValueError(f"{int((codes < 0).sum())} observations have no regime")
+    counts = np.bincount(codes).astype(np.float64)
+    n_regimes = len(counts)
+
+    # absorb the regime intercepts by demeaning within regimes instead of
+    # building the n x (regimes + k) dummy-expanded design matrix
+    y_means = np.bincount(codes, weights=y) / counts
+    x_means = get_group_means(x, codes, counts)
+    y_within = y - y_means[codes]
+    x_within = x - x_means[codes]
+    xtx_inv = np.linalg.inv(x_within.T @ x_within)
+    slopes = xtx_inv @ (x_within.T @ y_within)
+    intercepts = y_means - x_means @ slopes
+
+    predy = intercepts[codes] + x @ slopes
+    u = y - predy
+    k = n_regimes + n_vars
+    utu = float(u @ u)
+    sig2 = utu / (n - k)
+    sig2ML = utu / n
+    # covariance of [intercepts, slopes] without forming the dummy matrix
+    slope_vm = sig2 * xtx_inv
+    vm = np.zeros((k, k))
+    vm[n_regimes:, n_regimes:] = slope_vm
+    vm[:n_regimes, n_regimes:] = -x_means @ slope_vm
+    vm[n_regimes:, :n_regimes] = vm[:n_regimes, n_regimes:].T
+    vm[:n_regimes, :n_regimes] = x_means @ slope_vm @ x_means.T + np.diag(
+        sig2 / counts
+    )
+    betas = np.concatenate([intercepts, slopes]).reshape(-1, 1)
+    std_err = np.sqrt(np.diag(vm))
+    t_values = betas.ravel() / std_err
+    p_values = 2 * stats.t.sf(np.abs(t_values), n - k)
+
+    y_deviation = y - y.mean()
+    r2 = 1 - utu / float(y_deviation @ y_deviation)
+    ar2 = 1 - (1 - r2) * (n - 1) / (n - k)
+    f_value = (r2 / (k - 1)) / ((1 - r2) / (n - k))
+    logll = -0.5 * n * (np.log(2 * np.pi) + np.log(sig2ML) + 1)
+    results = FixedEffectsResults(
+        name_y=name_y,
+        name_x=[f"{regime}_CONSTANT" for regime in regime_names]
+        + [f"_Global_{name}" for name in name_x],
+        betas=betas,
+        vm=vm,
+        std_err=std_err,
+        t_stat=list(zip(t_values, p_values)),
+        u=u.reshape(-1, 1),
+        predy=predy.reshape(-1, 1),
+        n=n,
+        k=k,
+        r2=r2,
+        ar2=ar2,
+        utu=utu,
+        sig2=sig2,
+        sig2ML=sig2ML,
+        f_stat=(f_value, stats.f.sf(f_value, k - 1, n - k)),
+        logll=logll,
+        aic=-2 * logll + 2 * k,
+        schwarz=-2 * logll + k * np.log(n),
+        mean_y=float(y.mean()),
+        std_y=float(y.std(ddof=1)),
+        regimes=list(regime_names),
+    )
+    results.summary = get_summary(results)
+    return results
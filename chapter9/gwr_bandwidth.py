@@ -0,0 +1,341 @@
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+
+import numpy as np
+
+from scipy.spatial import cKDTree
+
+
+EARTH_RADIUS_KM = 6371.0
+KERNEL_EPS = 1.0000001
+MAX_NEIGHBOURS = 2000
+# distances and indices for every neighbour, as float64 and int64
+MAX_NEIGHBOUR_BYTES = 2 * 1024**3
+CHUNK_SIZE = 512
+# mgwr's golden-section constant, 1 - (sqrt(5) - 1) / 2, and its defaults
+GOLDEN_DELTA = 0.38197
+GOLDEN_TOL = 1e-5
+GOLDEN_MAX_ITER = 200
+
+_neighbour_cache = {}
+
+
+@dataclass
+class GoldenSection:
+    # bracket [a, c] with interior probes b <= d, as in mgwr.search
+    a: float
+    b: float
+    c: float
+    d: float
+    scores: dict = field(default_factory=dict)
+    best: int = None
+    diff: float = 1.0e9
+    iterations: int = 0
+
+
+def get_tree_coords(coords: np.ndarray, spherical: bool) -> np.ndarray:
+    coords = np.asarray(coords, dtype=np.float64)
+    if not spherical:
+        return coords
+    # unit-sphere cartesian coordinates keep the haversine neighbour order
+    lon, lat = np.radians(coords[:, 0]), np.radians(coords[:, 1])
+    return np.column_stack(
+        [np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)]
+    )
+
+
+def get_neighbour_cache(
+    coords: np.ndarray,
+    max_neighbours: int = MAX_NEIGHBOURS,
+    spherical: bool = True,
+    points: np.ndarray = None,
+    tree: cKDTree = None,
+) -> tuple:
+    # a prebuilt tree over get_tree_coords(coords) skips the rebuild
+    tree_coords = tree.data if tree is not None else get_tree_coords(coords, spherical)
+    query_coords = tree_coords if points is None else get_tree_coords(points, spherical)
+    max_neighbours = min(int(max_neighbours), len(tree_coords))
+    tree = tree if tree is not None else cKDTree(tree_coords)
+    distances, indices = tree.query(query_coords, k=max_neighbours)
+    if spherical:
+        distances = 2 * EARTH_RADIUS_KM * np.arcsin(np.minimum(distances / 2, 1))
+    return distances.reshape(len(query_coords), -1), indices.reshape(
+        len(query_coords), -1
+    )
+
+
+def get_max_neighbours(n: int, max_neighbours: int = None) -> int:
+    # the full search of mgwr's Sel_BW when the n x n table fits in memory
+    if max_neighbours is None:
+        max_neighbours = n if 16 * n * n <= MAX_NEIGHBOUR_BYTES else MAX_NEIGHBOURS
+    return min(max_neighbours, n)
+
+
+def check_neighbour_cap(bw: int, max_neighbours: int, n: int) -> None:
+    # an optimum on a cap below n may only be the edge of the search
+    if bw >= max_neighbours and max_neighbours < n:
+        raise ValueError(
+            f"Bandwidth {bw} hit the neighbour cap of {max_neighbours} for "
+            f"{n} observations; raise max_neighbours"
+        )
+
+
+def add_constant(X: np.ndarray) -> np.ndarray:
+    X = np.asarray(X, dtype=np.float64)
+    return np.column_stack([np.ones(len(X)), X])
+
+
+def get_bisquare_weights(distances: np.ndarray, bw: int) -> np.ndarray:
+    # adaptive bisquare as in mgwr: the bandwidth is the distance to the
+    # bw-th nearest neighbour (self included), widened by KERNEL_EPS; mgwr's
+    # Sel_BW returns it as a float
+    bw = int(bw)
+    distances = distances[:, :bw]
+    bandwidth = distances[:, -1:] * KERNEL_EPS
+    bandwidth = np.where(bandwidth > 0, bandwidth, 1.0)
+    z = distances / bandwidth
+    return np.where(z < 1, (1 - z**2) ** 2, 0.0)
+
+
+def solve_local_regressions(
+    X: np.ndarray,
+    y: np.ndarray,
+    indices: np.ndarray,
+    weights: np.ndarray,
+    points_X: np.ndarray,
+    compute_influence: bool = True,
+) -> tuple:
+    X_local = X[indices]
+    weighted_X = X_local * weights[:, :, None]
+    xtwx = np.einsum("ckp,ckq->cpq", weighted_X, X_local)
+    xtwy = np.einsum("ckp,ck->cp", weighted_X, y[indices])
+    right_hand_side = (
+        np.stack([xtwy, points_X], axis=2) if compute_influence else xtwy[:, :, None]
+    )
+    try:
+        solution = np.linalg.solve(xtwx, right_hand_side)
+    except np.linalg.LinAlgError:
+        solution = np.linalg.pinv(xtwx) @ right_hand_side
+    params = solution[:, :, 0]
+    if not compute_influence:
+        return params, None
+    # diagonal of the hat matrix: x_i (X'W_iX)^-1 x_i' w_ii with w_ii = 1
+    influence = np.einsum("cp,cp->c", points_X, solution[:, :, 1])
+    return params, influence
+
+
+def get_aicc(rss: float, tr_s: float, n: int) -> float:
+    # near-interpolating bandwidths leave no residual degrees of freedom
+    if n - tr_s - 2.0 <= 0:
+        return np.inf
+    llf = -0.5 * n * (np.log(2.0 * np.pi * rss / n) + 1.0)
+    return -2.0 * llf + 2.0 * n * (tr_s + 1.0) / (n - tr_s - 2.0)
+
+
+def get_bandwidth_aicc(
+    X: np.ndarray,
+    y: np.ndarray,
+    distances: np.ndarray,
+    indices: np.ndarray,
+    bw: int,
+    chunk_size: int = CHUNK_SIZE,
+) -> float:
+    n = len(X)
+    rss = 0.0
+    tr_s = 0.0
+    for start in range(0, n, chunk_size):
+        rows = slice(start, start + chunk_size)
+        weights = get_bisquare_weights(distances[rows], bw)
+        params, influence = solve_local_regressions(
+            X, y, indices[rows, :bw], weights, X[rows]
+        )
+        residuals = y[rows] - np.einsum("cp,cp->c", X[rows], params)
+        rss += residuals @ residuals
+        tr_s += influence.sum()
+    return get_aicc(rss, tr_s, n)
+
+
+def save_neighbour_table(
+    distances: np.ndarray, indices: np.ndarray, table_dir: str
+) -> None:
+    np.save(Path(table_dir) / "distances.npy", distances)
+    np.save(Path(table_dir) / "indices.npy", indices)
+
+
+def init_worker(X: np.ndarray, y: np.ndarray, table_dir: str) -> None:
+    # the neighbour table is memory-mapped, so workers share one copy of it
+    _neighbour_cache.update(
+        X=X,
+        y=y,
+        distances=np.load(Path(table_dir) / "distances.npy", mmap_mode="r"),
+        indices=np.load(Path(table_dir) / "indices.npy", mmap_mode="r"),
+    )
+
+
+@contextmanager
+def get_worker_pool(
+    X: np.ndarray,
+    y: np.ndarray,
+    distances: np.ndarray,
+    indices: np.ndarray,
+    n_jobs: int,
+):
+    # a single job runs in-process, e.g. when already inside a pool worker,
+    # and yields no pool
+    if n_jobs == 1:
+        _neighbour_cache.update(X=X, y=y, distances=distances, indices=indices)
+        yield None
+        return
+    with tempfile.TemporaryDirectory() as table_dir:
+        save_neighbour_table(distances, indices, table_dir)
+        with ProcessPoolExecutor(
+            max_workers=n_jobs, initializer=init_worker, initargs=(X, y, table_dir)
+        ) as pool:
+            yield pool
+
+
+def get_worker_data() -> tuple:
+    # X, y, distances and indices as set by init_worker in this process
+    return tuple(_neighbour_cache[key] for key in ["X", "y", "distances", "indices"])
+
+
+def evaluate_bandwidth(bw: int) -> float:
+    return get_bandwidth_aicc(*get_worker_data(), bw)
+
+
+def search_bandwidth(
+    X: np.ndarray,
+    y: np.ndarray,
+    distances: np.ndarray,
+    indices: np.ndarray,
+    bw_min: int = 2,
+    bw_max: int = None,
+    n_candidates: int = None,
+    n_jobs: int = None,
+) -> tuple:
+    n_jobs = n_jobs or os.cpu_count() or 1
+    n_candidates = n_candidates or max(n_jobs, 5)
+    # the local design needs at least as many neighbours as parameters
+    bw_min = max(bw_min, X.shape[1] + 1)
+    bw_max = min(bw_max or distances.shape[1], distances.shape[1])
+    bw_min = min(bw_min, bw_max)
+    scores = {}
+    with get_worker_pool(X, y, distances, indices, n_jobs) as pool:
+        evaluate = pool.map if pool is not None else map
+        low, high = bw_min, bw_max
+        while True:
+            candidates = np.unique(
+                np.linspace(low, high, min(n_candidates, high - low + 1)).round()
+            ).astype(int)
+            pending = [int(bw) for bw in candidates if bw not in scores]
+            scores.update(zip(pending, evaluate(evaluate_bandwidth, pending)))
+            best = min(scores, key=scores.get)
+            if high - low + 1 <= n_candidates:
+                return best, scores
+            # shrink the bracket to the scored bandwidths either side of the
+            # best one so far, which may lie outside the last bracket
+            scored = sorted(scores)
+            position = scored.index(best)
+            low = scored[max(position - 1, 0)]
+            high = scored[min(position + 1, len(scored) - 1)]
+
+
+def get_golden_section(low: int, high: int) -> GoldenSection:
+    width = GOLDEN_DELTA * abs(high - low)
+    return GoldenSection(a=low, b=low + width, c=high, d=high - width)
+
+
+def get_golden_section_probes(section: GoldenSection) -> list:
+    # integer probes of the next step that have not been scored yet
+    section.b, section.d = np.round(section.b), np.round(section.d)
+    probes = dict.fromkeys([int(section.b), int(section.d)])
+    return [bw for bw in probes if bw not in section.scores]
+
+
+def advance_golden_section(section: GoldenSection) -> None:
+    # one step of mgwr's golden_section once both probes are scored
+    score_b = section.scores[int(section.b)]
+    score_d = section.scores[int(section.d)]
+    section.iterations += 1
+    if score_b <= score_d:
+        section.best = int(section.b)
+        section.c, section.d = section.d, section.b
+        section.b = section.a + GOLDEN_DELTA * abs(section.c - section.a)
+    else:
+        section.best = int(section.d)
+        section.a, section.b = section.b, section.d
+        section.d = section.c - GOLDEN_DELTA * abs(section.c - section.a)
+    section.diff = score_b - score_d
+
+
+def is_golden_section_done(
+    section: GoldenSection, tol: float = GOLDEN_TOL, max_iter: int = GOLDEN_MAX_ITER
+) -> bool:
+    return abs(section.diff) <= tol or section.iterations >= max_iter
+
+
+def get_spatial_strata(coords: np.ndarray, n_cells: int = 10) -> np.ndarray:
+    coords = np.asarray(coords, dtype=np.float64)
+    cells = []
+    for axis in range(coords.shape[1]):
+        edges = np.quantile(coords[:, axis], np.linspace(0, 1, n_cells + 1)[1:-1])
+        cells.append(np.searchsorted(edges, coords[:, axis]))
+    return cells[0] * n_cells + cells[1]
+
+
+def get_stratified_subsample(
+    strata: np.ndarray, sample_size: int, random_state: int
+) -> np.ndarray:
+    rng = np.random.default_rng(random_state)
+    fraction = sample_size / len(strata)
+    rows = []
+    for stratum in np.unique(strata):
+        members = np.flatnonzero(strata == stratum)
+        size = max(1, int(round(len(members) * fraction)))
+        rows.append(rng.choice(members, min(size, len(members)), replace=False))
+    return np.sort(np.concatenate(rows))
+
+
+def select_bandwidth(
+    coords: list,
+    y: np.ndarray,
+    exp_vars: np.ndarray,
+    bw_min: int = 2,
+    spherical: bool = True,
+    max_neighbours: int = None,
+    sample_size: int = None,
+    strata: np.ndarray = None,
+    refine_width: float = 0.5,
+    n_jobs: int = None,
+    random_state: int = 0,
+) -> int:
+    coords = np.asarray(coords, dtype=np.float64)
+    X = add_constant(exp_vars)
+    y = np.asarray(y, dtype=np.float64).reshape(-1)
+    bw_max = None
+    if sample_size and sample_size < len(X):
+        strata = get_spatial_strata(coords) if strata is None else strata
+        rows = get_stratified_subsample(strata, sample_size, random_state)
+        sample_neighbours = get_max_neighbours(len(rows), max_neighbours)
+        distances, indices = get_neighbour_cache(
+            coords[rows], sample_neighbours, spherical
+        )
+        sample_bw, _ = search_bandwidth(
+            X[rows], y[rows], distances, indices, bw_min, n_jobs=n_jobs
+        )
+        check_neighbour_cap(sample_bw, sample_neighbours, len(rows))
+        # an adaptive bandwidth is a neighbour count, so it grows with density
+        full_bw = sample_bw * len(X) / len(rows)
+        bw_min = max(bw_min, int(full_bw * (1 - refine_width)))
+        bw_max = int(np.ceil(full_bw * (1 + refine_width)))
+    max_neighbours = get_max_neighbours(len(X), max_neighbours)
+    distances, indices = get_neighbour_cache(
+        coords, min(max_neighbours, bw_max or max_neighbours), spherical
+    )
+    bw, _ = search_bandwidth(X, y, distances, indices, bw_min, bw_max, n_jobs=n_jobs)
+    check_neighbour_cap(bw, max_neighbours, len(X))
+    return bw
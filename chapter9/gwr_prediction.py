@@ -0,0 +1,106 @@
+import numpy as np
+
+from scipy.spatial import cKDTree
+
+import gwr_bandwidth
+import mgwr_backfitting
+import sparse_gwr
+
+
+PREDICTION_CHUNK_SIZE = 4096
+
+
+def predict_gwr_params(
+    coords: list,
+    y: np.ndarray,
+    exp_vars: np.ndarray,
+    bw: int,
+    points: np.ndarray,
+    spherical: bool = True,
+    chunk_size: int = PREDICTION_CHUNK_SIZE,
+    tree: cKDTree = None,
+) -> np.ndarray:
+    bw = int(bw)
+    X = gwr_bandwidth.add_constant(exp_vars)
+    y = np.asarray(y, dtype=np.float64).reshape(-1)
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    params = np.zeros((len(points), X.shape[1]))
+    for start in range(0, len(points), chunk_size):
+        rows = slice(start, start + chunk_size)
+        # the calibration kernel at a new location uses its bw nearest
+        # calibration points, exactly as it does at a calibration point
+        distances, indices = gwr_bandwidth.get_neighbour_cache(
+            coords, bw, spherical, points[rows], tree
+        )
+        weights = gwr_bandwidth.get_bisquare_weights(distances, bw)
+        params[rows], _ = gwr_bandwidth.solve_local_regressions(
+            X, y, indices, weights, None, compute_influence=False
+        )
+    return params
+
+
+def predict_fitted_gwr_params(
+    coords: list,
+    y: np.ndarray,
+    exp_vars: np.ndarray,
+    gwr_results: sparse_gwr.SparseGWRResults,
+    points: np.ndarray,
+    chunk_size: int = PREDICTION_CHUNK_SIZE,
+) -> np.ndarray:
+    # the bandwidth and distance of the fit, so calibration points get its params
+    return predict_gwr_params(
+        coords,
+        y,
+        exp_vars,
+        gwr_results.bw,
+        points,
+        gwr_results.spherical,
+        chunk_size,
+    )
+
+
+def predict_mgwr_params(
+    coords: list,
+    exp_vars: np.ndarray,
+    mgwr_results: mgwr_backfitting.MGWRResults,
+    points: np.ndarray,
+    chunk_size: int = PREDICTION_CHUNK_SIZE,
+) -> np.ndarray:
+    X = gwr_bandwidth.add_constant(exp_vars)
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    bws = np.asarray(mgwr_results.bws, dtype=int)
+    # each covariate is smoothed against its own converged partial residual
+    partials = mgwr_results.params * X + mgwr_results.resid_response[:, None]
+    params = np.zeros((len(points), X.shape[1]))
+    for start in range(0, len(points), chunk_size):
+        rows = slice(start, start + chunk_size)
+        distances, indices = gwr_bandwidth.get_neighbour_cache(
+            coords, bws.max(), mgwr_results.spherical, points[rows]
+        )
+        for j, bw in enumerate(bws):
+            weights = gwr_bandwidth.get_bisquare_weights(distances, bw)
+            x_local = X[indices[:, :bw], j]
+            weighted_x = weights * x_local
+            denominator = np.einsum("ik,ik->i", weighted_x, x_local)
+            params[rows, j] = np.einsum(
+                "ik,ik->i", weighted_x, partials[indices[:, :bw], j]
+            ) / np.maximum(denominator, np.finfo(np.float64).tiny)
+    return params
+
+
+def predict(params: np.ndarray, exp_vars: np.ndarray) -> np.ndarray:
+    X = gwr_bandwidth.add_constant(exp_vars)
+    return np.einsum("ip,ip->i", X, params).reshape(-1, 1)
+
+
+def get_grid_points(bounds: tuple, resolution: float) -> tuple:
+    min_x, min_y, max_x, max_y = bounds
+    xs = np.arange(min_x + resolution / 2, max_x, resolution)
+    ys = np.arange(max_y - resolution / 2, min_y, -resolution)
+    grid_x, grid_y = np.meshgrid(xs, ys)
+    return np.column_stack([grid_x.ravel(), grid_y.ravel()]), grid_x.shape
+
+
+def get_coefficient_raster(params: np.ndarray, shape: tuple) -> np.ndarray:
+    # rows run north to south so the raster can go straight to imshow
+    return params.reshape(shape + (params.shape[1],))
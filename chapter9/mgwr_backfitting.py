@@ -0,0 +1,354 @@
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+
+import numpy as np
+
+import gwr_bandwidth
+
+
+BWS_SAME_TIMES = 5
+
+_mgwr_cache = {}
+
+
+@dataclass
+class MGWRResults:
+    bws: np.ndarray
+    params: np.ndarray
+    predy: np.ndarray
+    resid_response: np.ndarray
+    resid_ss: float
+    scores: list
+    bws_history: np.ndarray
+    timings: list
+    init_bw: int = None
+    spherical: bool = True
+    enp_j: np.ndarray = None
+    bse: np.ndarray = None
+    sigma2: float = None
+    aicc: float = None
+
+
+def init_worker(X: np.ndarray, y: np.ndarray, table_dir: str) -> None:
+    # the neighbour table is memory-mapped, so workers share one copy of it
+    _mgwr_cache.update(
+        X=X,
+        y=y,
+        distances=np.load(Path(table_dir) / "distances.npy", mmap_mode="r"),
+        indices=np.load(Path(table_dir) / "indices.npy", mmap_mode="r"),
+    )
+
+
+def get_row_blocks(n: int, n_blocks: int) -> list:
+    bounds = np.linspace(0, n, min(n_blocks, n) + 1).astype(int)
+    return list(zip(bounds[:-1].tolist(), bounds[1:].tolist()))
+
+
+def get_chunk_weights(bw: int, start: int, stop: int) -> tuple:
+    # weights are rebuilt per chunk, so no n x bw matrix is ever kept
+    indices = np.asarray(_mgwr_cache["indices"][start:stop, :bw])
+    distances = np.asarray(_mgwr_cache["distances"][start:stop, :bw])
+    return indices, gwr_bandwidth.get_bisquare_weights(distances, bw)
+
+
+def smooth_covariate(
+    j: int, bw: int, partial: np.ndarray, start: int, stop: int
+) -> tuple:
+    x = _mgwr_cache["X"][:, j]
+    indices, weights = get_chunk_weights(bw, start, stop)
+    x_local = x[indices]
+    weighted_x = weights * x_local
+    denominator = np.einsum("ik,ik->i", weighted_x, x_local)
+    denominator = np.where(denominator > 0, denominator, np.finfo(np.float64).tiny)
+    beta = np.einsum("ik,ik->i", weighted_x, partial[indices]) / denominator
+    # univariate hat diagonal x_i^2 w_ii / sum_k w_k x_k^2 with w_ii = 1
+    influence = x[start:stop] ** 2 / denominator
+    return beta, influence
+
+
+def score_covariate_rows(task: tuple) -> tuple:
+    j, bw, partial, start, stop, chunk_size = task
+    betas, rss, tr_s = [], 0.0, 0.0
+    for chunk_start in range(start, stop, chunk_size):
+        chunk_stop = min(chunk_start + chunk_size, stop)
+        beta, influence = smooth_covariate(j, bw, partial, chunk_start, chunk_stop)
+        residuals = (
+            partial[chunk_start:chunk_stop]
+            - beta * _mgwr_cache["X"][chunk_start:chunk_stop, j]
+        )
+        betas.append(beta)
+        rss += float(residuals @ residuals)
+        tr_s += float(influence.sum())
+    return np.concatenate(betas), rss, tr_s
+
+
+def score_gwr_rows(task: tuple) -> tuple:
+    # the full GWR that mgwr fits to start the backfitting
+    _, bw, _, start, stop, chunk_size = task
+    X, y = _mgwr_cache["X"], _mgwr_cache["y"]
+    params, rss, tr_s = [], 0.0, 0.0
+    for chunk_start in range(start, stop, chunk_size):
+        chunk_stop = min(chunk_start + chunk_size, stop)
+        indices, weights = get_chunk_weights(bw, chunk_start, chunk_stop)
+        chunk_params, influence = gwr_bandwidth.solve_local_regressions(
+            X, y, indices, weights, X[chunk_start:chunk_stop]
+        )
+        residuals = y[chunk_start:chunk_stop] - np.einsum(
+            "cp,cp->c", X[chunk_start:chunk_stop], chunk_params
+        )
+        params.append(chunk_params)
+        rss += float(residuals @ residuals)
+        tr_s += float(influence.sum())
+    return np.vstack(params), rss, tr_s
+
+
+def get_covariate_variance_rows(task: tuple) -> np.ndarray:
+    # sandwich variance of the univariate local estimator, up to sigma2
+    j, bw, start, stop, chunk_size = task
+    x = _mgwr_cache["X"][:, j]
+    variance = []
+    for chunk_start in range(start, stop, chunk_size):
+        chunk_stop = min(chunk_start + chunk_size, stop)
+        indices, weights = get_chunk_weights(bw, chunk_start, chunk_stop)
+        x_local = x[indices]
+        denominator = np.einsum("ik,ik->i", weights * x_local, x_local)
+        numerator = np.einsum("ik,ik->i", weights**2 * x_local, x_local)
+        variance.append(
+            numerator / np.maximum(denominator, np.finfo(np.float64).tiny) ** 2
+        )
+    return np.concatenate(variance)
+
+
+def score_rows(task: tuple) -> tuple:
+    return score_gwr_rows(task) if task[0] is None else score_covariate_rows(task)
+
+
+def score_bandwidths(
+    executor: ProcessPoolExecutor,
+    requests: list,
+    partials: dict,
+    blocks: list,
+    chunk_size: int,
+) -> dict:
+    # every (covariate, bandwidth) request is split over the same row blocks;
+    # covariate None scores the full GWR
+    tasks = [
+        (j, bw, partials.get(j), start, stop, chunk_size)
+        for j, bw in requests
+        for start, stop in blocks
+    ]
+    n = blocks[-1][1]
+    results = iter(executor.map(score_rows, tasks))
+    scores = {}
+    for j, bw in requests:
+        parts = [next(results) for _ in blocks]
+        rss = sum(part[1] for part in parts)
+        tr_s = sum(part[2] for part in parts)
+        values = np.concatenate([part[0] for part in parts])
+        scores[j, bw] = (gwr_bandwidth.get_aicc(rss, tr_s, n), values)
+    return scores
+
+
+def search_bandwidths(
+    executor: ProcessPoolExecutor,
+    brackets: dict,
+    partials: dict,
+    blocks: list,
+    chunk_size: int,
+) -> dict:
+    # mgwr's golden-section search for each covariate, run in lockstep so the
+    # probes of every active search are scored together
+    sections = {
+        j: gwr_bandwidth.get_golden_section(low, high)
+        for j, (low, high) in brackets.items()
+    }
+    values = {}
+    best = {}
+    while sections:
+        requests = [
+            (j, bw)
+            for j, section in sections.items()
+            for bw in gwr_bandwidth.get_golden_section_probes(section)
+        ]
+        scores = score_bandwidths(executor, requests, partials, blocks, chunk_size)
+        for (j, bw), (aicc, fitted) in scores.items():
+            sections[j].scores[bw] = aicc
+            values[j, bw] = fitted
+        for j in list(sections):
+            gwr_bandwidth.advance_golden_section(sections[j])
+            if gwr_bandwidth.is_golden_section_done(sections[j]):
+                best[j] = (sections[j].best, values[j, sections[j].best])
+                del sections[j]
+    return best
+
+
+def get_soc(new_XB: np.ndarray, XB: np.ndarray) -> float:
+    num = np.sum((new_XB - XB) ** 2) / len(XB)
+    den = np.sum(np.sum(new_XB, axis=1) ** 2)
+    return (num / den) ** 0.5
+
+
+def fit_mgwr(
+    coords: list,
+    y: np.ndarray,
+    exp_vars: np.ndarray,
+    init_bw: int = None,
+    bw_min: int = 2,
+    bw_max: int = None,
+    spherical: bool = True,
+    max_iter: int = 200,
+    tol: float = 1e-5,
+    jacobi: bool = False,
+    approximate_covariance: bool = False,
+    n_jobs: int = None,
+    chunk_size: int = gwr_bandwidth.CHUNK_SIZE,
+    verbose: bool = True,
+) -> MGWRResults:
+    start_time = time.time()
+    X = gwr_bandwidth.add_constant(exp_vars)
+    y = np.asarray(y, dtype=np.float64).reshape(-1)
+    n, k = X.shape
+    n_jobs = n_jobs or os.cpu_count() or 1
+    # mgwr searches every covariate up to n; the table is capped only when
+    # n x n does not fit in memory
+    max_neighbours = gwr_bandwidth.get_max_neighbours(n, bw_max)
+    bw_min = min(max(bw_min, 2), max_neighbours)
+    blocks = get_row_blocks(n, n_jobs)
+
+    with tempfile.TemporaryDirectory() as table_dir:
+        gwr_bandwidth.save_neighbour_table(
+            *gwr_bandwidth.get_neighbour_cache(coords, max_neighbours, spherical),
+            table_dir,
+        )
+        with ProcessPoolExecutor(
+            max_workers=n_jobs, initializer=init_worker, initargs=(X, y, table_dir)
+        ) as executor:
+            # a GWR fit starts the backfitting, at mgwr's initial bandwidth
+            # search bounds of 40 + 2k neighbours up to n
+            init_low = min(40 + 2 * k, max_neighbours)
+            init_bracket = (
+                (init_bw, init_bw) if init_bw else (init_low, max_neighbours)
+            )
+            init_bw, params = search_bandwidths(
+                executor, {None: init_bracket}, {}, blocks, chunk_size
+            )[None]
+            if bw_max is None:
+                gwr_bandwidth.check_neighbour_cap(init_bw, max_neighbours, n)
+            if verbose:
+                print(f"Initial GWR bandwidth {init_bw}")
+            XB = params * X
+            err = y - XB.sum(axis=1)
+            bws = np.zeros(k, dtype=int)
+            bws_history = []
+            scores = []
+            timings = []
+            bw_stable_counter = 0
+
+            for iteration in range(1, max_iter + 1):
+                iteration_start = time.time()
+                new_XB = np.zeros_like(X)
+                # once the bandwidths have settled only the smoothers are refitted
+                if bw_stable_counter >= BWS_SAME_TIMES:
+                    brackets = {j: (int(bws[j]), int(bws[j])) for j in range(k)}
+                else:
+                    brackets = {j: (bw_min, max_neighbours) for j in range(k)}
+                if jacobi:
+                    # every covariate sees the same residual, so all of them
+                    # are searched concurrently
+                    partials = {j: XB[:, j] + err for j in range(k)}
+                    best = search_bandwidths(
+                        executor, brackets, partials, blocks, chunk_size
+                    )
+                    for j in range(k):
+                        bws[j], params[:, j] = best[j]
+                        new_XB[:, j] = params[:, j] * X[:, j]
+                    err = y - new_XB.sum(axis=1)
+                else:
+                    for j in range(k):
+                        partials = {j: XB[:, j] + err}
+                        bws[j], params[:, j] = search_bandwidths(
+                            executor, {j: brackets[j]}, partials, blocks, chunk_size
+                        )[j]
+                        new_XB[:, j] = params[:, j] * X[:, j]
+                        err = partials[j] - new_XB[:, j]
+                if bw_max is None:
+                    gwr_bandwidth.check_neighbour_cap(bws.max(), max_neighbours, n)
+
+                if bws_history and np.array_equal(bws_history[-1], bws):
+                    bw_stable_counter += 1
+                else:
+                    bw_stable_counter = 0
+                score = get_soc(new_XB, XB)
+                XB = new_XB
+                scores.append(score)
+                bws_history.append(bws.copy())
+                timings.append(time.time() - iteration_start)
+                if verbose:
+                    print(
+                        f"Backfitting iteration {iteration}: SOC {score:.7f}, "
+                        f"bandwidths {bws.tolist()}, "
+                        f"{round(timings[-1], 2)} seconds"
+                    )
+                if score < tol:
+                    break
+
+            results = MGWRResults(
+                bws=bws,
+                params=params,
+                predy=XB.sum(axis=1).reshape(-1, 1),
+                resid_response=err,
+                resid_ss=float(err @ err),
+                scores=scores,
+                bws_history=np.array(bws_history),
+                timings=timings,
+                init_bw=init_bw,
+                spherical=spherical,
+            )
+            if approximate_covariance:
+                add_approximate_covariance(results, executor, blocks, chunk_size)
+    if verbose:
+        print(f"MGWR fitted in {round(time.time() - start_time, 2)} seconds")
+    return results
+
+
+def add_approximate_covariance(
+    results: MGWRResults,
+    executor: ProcessPoolExecutor,
+    blocks: list,
+    chunk_size: int,
+) -> None:
+    # the exact MGWR covariance needs k dense n x n operator matrices; this
+    # treats each covariate's final smoother as an independent local fit
+    n, k = results.params.shape
+    partials = {j: np.zeros(n) for j in range(k)}
+    requests = [(j, int(bw)) for j, bw in enumerate(results.bws)]
+    tasks = [
+        (j, bw, partials[j], start, stop, chunk_size)
+        for j, bw in requests
+        for start, stop in blocks
+    ]
+    tr_parts = [tr_s for _, _, tr_s in executor.map(score_covariate_rows, tasks)]
+    enp_j = np.array(tr_parts).reshape(k, len(blocks)).sum(axis=1)
+    tr_s = enp_j.sum()
+    sigma2 = results.resid_ss / (n - tr_s)
+    variance = np.column_stack(
+        [
+            np.concatenate(
+                list(
+                    executor.map(
+                        get_covariate_variance_rows,
+                        [(j, bw, start, stop, chunk_size) for start, stop in blocks],
+                    )
+                )
+            )
+            for j, bw in requests
+        ]
+    )
+    results.enp_j = enp_j
+    results.sigma2 = sigma2
+    results.bse = np.sqrt(variance * sigma2)
+    results.aicc = gwr_bandwidth.get_aicc(results.resid_ss, tr_s, n)
@@ -7,11 +7,17 @@ import numpy as np
 import pandas as pd
 import plotly.express as px
 
-from libpysal import weights
 from mgwr.gwr import GWR, MGWR
 from mgwr.sel_bw import Sel_BW
 from pysal.model import spreg
 
+import feature_matrix
+import fixed_effects
+import gwr_bandwidth
+import mgwr_backfitting
+import spatial_cv
+import spatial_models
+import sparse_gwr
 
 warnings.filterwarnings("ignore")
 
@@ -36,6 +42,7 @@ G_VARS = [
     "Charging Bull",
 ]
 G_M_VARS = G_VARS + M_VARS
+GWR_VARS = ["accommodates", "bedrooms", "beds", "review_scores_rating"]
 
 
 def one_hot_encode_room_types(
@@ -69,11 +76,9 @@ def format_price(manhattan_listings_subset: gpd.GeoDataFrame) -> gpd.GeoDataFram
 def drop_missing_values(
     manhattan_listings_subset: gpd.GeoDataFrame, columns: list
 ) -> gpd.GeoDataFrame:
-    for column in columns:
-        manhattan_listings_subset = manhattan_listings_subset[
-            manhattan_listings_subset[column].notna()
-        ]
-    return manhattan_listings_subset
+    return manhattan_listings_subset[
+        manhattan_listings_subset[columns].notna().all(axis=1)
+    ]
 
 
 def get_train_data() -> gpd.GeoDataFrame:
@@ -99,9 +104,90 @@ def get_train_data() -> gpd.GeoDataFrame:
     return manhattan_listings, manhattan_listings_subset
 
 
+def get_feature_matrix(
+    manhattan_listings: gpd.GeoDataFrame,
+) -> feature_matrix.FeatureMatrix:
+    manhattan_listings = one_hot_encode_room_types(manhattan_listings.copy())
+    manhattan_listings = format_price(manhattan_listings)
+    manhattan_listings["log_price"] = np.log(manhattan_listings["price"])
+    return feature_matrix.build_feature_matrix(manhattan_listings, G_M_VARS)
+
+
+def run_spatial_cross_validation(
+    features: feature_matrix.FeatureMatrix, use_h3_folds: bool = False
+) -> pd.DataFrame:
+    folds = (
+        spatial_cv.get_h3_folds(features)
+        if use_h3_folds
+        else spatial_cv.get_neighbourhood_folds(features)
+    )
+    scores, fold_scores = spatial_cv.run_spatial_cv(
+        features,
+        folds,
+        {
+            "ols": {"columns": G_M_VARS},
+            "regimes": {"columns": G_M_VARS},
+            "gwr": {"columns": GWR_VARS},
+        },
+    )
+    print(fold_scores)
+    print(scores)
+    return scores
+
+
+def build_spatial_regression_models(
+    features: feature_matrix.FeatureMatrix,
+    variables: list,
+    logdet_method: str = "mc",
+    k: int = 5,
+) -> tuple:
+    # same rows and KNN weights as the OLS residual diagnostics
+    knn = spatial_models.get_knn_weights(features.coords, k)
+    ols_m = build_ols_model(features.to_frame(), variables)
+    print(f"Moran's I of OLS residuals: {spatial_models.get_morans_i(ols_m.u, knn)}")
+    lag_m = spatial_models.fit_spatial_lag(
+        features.y,
+        features.get(variables),
+        knn,
+        logdet_method,
+        name_y="log_price",
+        name_x=variables,
+    )
+    print(lag_m.summary)
+    error_m = spatial_models.fit_spatial_error(
+        features.y,
+        features.get(variables),
+        knn,
+        logdet_method,
+        name_y="log_price",
+        name_x=variables,
+    )
+    print(error_m.summary)
+    print(
+        pd.DataFrame(
+            {
+                "logll": [ols_m.logll, lag_m.logll, error_m.logll],
+                "aic": [ols_m.aic, lag_m.aic, error_m.aic],
+            },
+            index=["ols", "lag", "error"],
+        )
+    )
+    return lag_m, error_m
+
+
 def build_spatially_fixed_effects_regression_model(
-    manhattan_listings: gpd.GeoDataFrame, variables: str
+    manhattan_listings: gpd.GeoDataFrame, variables: str, absorb: bool = False
 ) -> spreg.OLS_Regimes:
+    if absorb:
+        # within estimator: same coefficients and residuals without the
+        # dense regime-expanded design matrix
+        return fixed_effects.fit_fixed_effects(
+            manhattan_listings[["log_price"]].values,
+            manhattan_listings[variables].values,
+            manhattan_listings["neighbourhood_cleansed"].tolist(),
+            name_y="log_price",
+            name_x=variables,
+        )
     sfe_m = spreg.OLS_Regimes(
         manhattan_listings[["log_price"]].values,
         manhattan_listings[variables].values,
@@ -184,16 +270,22 @@ def plot_residuals_choropleth(nyc_neighborhoods_residuals: gpd.GeoDataFrame) ->
 
 
 def plot_spatial_lag(
-    residuals_neighborhood: pd.DataFrame,
-    manhattan_listings: gpd.GeoDataFrame,
-    model_residuals: spreg.OLS,
+    residuals_neighborhood: pd.DataFrame, manhattan_listings: gpd.GeoDataFrame
 ) -> None:
     if "geometry" not in residuals_neighborhood.columns:
         residuals_neighborhood = residuals_neighborhood.merge(
             manhattan_listings[["id", "geometry"]], how="left", on="id"
         )
-    knn = weights.KNN.from_dataframe(residuals_neighborhood, k=5)
-    lag_residual = weights.spatial_lag.lag_spatial(knn, model_residuals)
+    residuals_neighborhood = gpd.GeoDataFrame(residuals_neighborhood)
+    knn = spatial_models.get_knn_weights(
+        np.column_stack(
+            [residuals_neighborhood.geometry.x, residuals_neighborhood.geometry.y]
+        )
+    )
+    # residuals are taken from the sorted frame, in the same row order as the
+    # weights; the lag is row-standardised, the mean of the 5 nearest residuals
+    model_residuals = residuals_neighborhood["model_residual"].to_numpy()
+    lag_residual = knn @ model_residuals
     fig = px.scatter(
         x=model_residuals.flatten(),
         y=lag_residual.flatten(),
@@ -202,7 +294,8 @@ def plot_spatial_lag(
         height=800,
     )
     fig.update_layout(
-        xaxis_title="Airbnb Residuals", yaxis_title="Spatially Lagged Residuals"
+        xaxis_title="Airbnb Residuals",
+        yaxis_title="Spatially Lagged Residuals (mean of 5 nearest)",
     )
     fig.show()
 
@@ -212,10 +305,11 @@ def build_model_and_plot(
     manhattan_listings: gpd.GeoDataFrame,
     variables: str,
     spatial_fixed_model: bool = False,
+    absorb_fixed_effects: bool = False,
 ) -> None:
     model = (
         build_spatially_fixed_effects_regression_model(
-            manhattan_listings_subset, variables
+            manhattan_listings_subset, variables, absorb_fixed_effects
         )
         if spatial_fixed_model
         else build_ols_model(manhattan_listings_subset, variables)
@@ -231,17 +325,15 @@ def build_model_and_plot(
     ) = get_average_neighborhood_residual(manhattan_listings_subset, model.u)
     plot_residuals_neighborhood(residuals_neighborhood)
     plot_residuals_choropleth(nyc_neighborhoods_residuals)
-    plot_spatial_lag(residuals_neighborhood, manhattan_listings, model.u)
+    plot_spatial_lag(residuals_neighborhood, manhattan_listings)
 
 
 def get_data_for_gwr(manhattan_listings: gpd.GeoDataFrame) -> tuple:
     manhattan_listings = drop_missing_values(
         manhattan_listings,
-        ["accommodates", "bedrooms", "beds", "review_scores_rating", "price"],
+        GWR_VARS + ["price"],
     )
-    exp_vars = manhattan_listings[
-        ["accommodates", "bedrooms", "beds", "review_scores_rating"]
-    ].values
+    exp_vars = manhattan_listings[GWR_VARS].values
     manhattan_listings = format_price(manhattan_listings)
     manhattan_listings["log_price"] = np.log(manhattan_listings["price"])
     y = (manhattan_listings["log_price"].values).reshape((-1, 1))
@@ -255,10 +347,22 @@ def build_geographical_weigted_regression_model(
     exp_vars: np.array,
     y: np.array,
     coords: list,
+    parallel_bw_search: bool = False,
+    bw_sample_size: int = None,
+    sparse_fit: bool = False,
 ) -> None:
-    gwr_selector = Sel_BW(coords, y, exp_vars, spherical=True)
-    gwr_bw = gwr_selector.search(bw_min=2)
-    gwr_results = GWR(coords, y, exp_vars, gwr_bw).fit()
+    if parallel_bw_search:
+        gwr_bw = gwr_bandwidth.select_bandwidth(
+            coords, y, exp_vars, bw_min=2, sample_size=bw_sample_size
+        )
+    else:
+        gwr_selector = Sel_BW(coords, y, exp_vars, spherical=True)
+        gwr_bw = gwr_selector.search(bw_min=2)
+    gwr_results = (
+        sparse_gwr.fit_gwr(coords, y, exp_vars, gwr_bw)
+        if sparse_fit
+        else GWR(coords, y, exp_vars, gwr_bw).fit()
+    )
     (
         residuals_neighborhood,
         nyc_neighborhoods_residuals,
@@ -267,58 +371,61 @@ def build_geographical_weigted_regression_model(
     )
     plot_residuals_neighborhood(residuals_neighborhood)
     plot_residuals_choropleth(nyc_neighborhoods_residuals)
-    plot_spatial_lag(
-        residuals_neighborhood, manhattan_listings, gwr_results.resid_response
-    )
+    plot_spatial_lag(residuals_neighborhood, manhattan_listings)
 
 
 def build_geographical_multi_weigted_regression_model(
     exp_vars: np.array,
     y: np.array,
     coords: list,
+    parallel_backfitting: bool = False,
+    max_iter: int = 200,
+    tol: float = 1e-5,
 ) -> None:
-    selector = Sel_BW(coords, y, exp_vars, multi=True, spherical=True)
-    selector.search(multi_bw_min=[4])
-    mgwr_results = MGWR(coords, y, exp_vars, selector, sigma2_v1=True).fit()
+    if parallel_backfitting:
+        mgwr_results = mgwr_backfitting.fit_mgwr(
+            coords,
+            y,
+            exp_vars,
+            bw_min=4,
+            max_iter=max_iter,
+            tol=tol,
+            approximate_covariance=True,
+        )
+    else:
+        selector = Sel_BW(coords, y, exp_vars, multi=True, spherical=True)
+        selector.search(multi_bw_min=[4])
+        mgwr_results = MGWR(coords, y, exp_vars, selector, sigma2_v1=True).fit()
 
 
 if __name__ == "__main__":
     manhattan_listings, manhattan_listings_subset = get_train_data()
+    # the M_VARS model keeps its own rows; the feature matrix also drops rows
+    # missing any of G_M_VARS or a neighbourhood
     build_model_and_plot(manhattan_listings_subset.copy(), manhattan_listings, M_VARS)
-
-    manhattan_listings_subset = manhattan_listings_subset.merge(
-        manhattan_listings[
-            [
-                "id",
-                "Central Park",
-                "Central Park Zoo",
-                "Empire State Building",
-                "Statue of Liberty",
-                "Rockeffeller Center",
-                "Chrysler Building",
-                "Times Square",
-                "MoMa",
-                "Charging Bull",
-            ]
-        ],
-        how="left",
-        on="id",
-    )
-    build_model_and_plot(manhattan_listings_subset.copy(), manhattan_listings, G_M_VARS)
-
-    manhattan_listings_subset = manhattan_listings_subset.merge(
-        manhattan_listings[["id", "neighbourhood_cleansed"]], how="left", on="id"
-    )
+    features = get_feature_matrix(manhattan_listings)
+    model_frame = features.to_frame()
+    build_model_and_plot(model_frame.copy(), manhattan_listings, G_M_VARS)
     build_model_and_plot(
-        manhattan_listings_subset.copy(), manhattan_listings, G_M_VARS, True
+        model_frame.copy(), manhattan_listings, G_M_VARS, True, True
     )
+    run_spatial_cross_validation(features, use_h3_folds=True)
+    build_spatial_regression_models(features, G_M_VARS)
 
     manhattan_listings_subset, exp_vars, y, coords = get_data_for_gwr(
         manhattan_listings.copy()
     )
 
     build_geographical_weigted_regression_model(
-        manhattan_listings, manhattan_listings_subset, exp_vars, y, coords
+        manhattan_listings,
+        manhattan_listings_subset,
+        exp_vars,
+        y,
+        coords,
+        parallel_bw_search=True,
+        sparse_fit=True,
     )
 
-    # build_geographical_multi_weigted_regression_model(exp_vars, y, coords)
+    build_geographical_multi_weigted_regression_model(
+        exp_vars, y, coords, parallel_backfitting=True
+    )
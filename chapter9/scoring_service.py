@@ -0,0 +1,328 @@
+import argparse
+import json
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyproj
+
+from scipy.spatial import cKDTree
+
+import feature_matrix
+import fixed_effects
+import gwr_bandwidth
+import gwr_prediction
+
+
+MODELS_PATH = "data/output/new_york/price_models.npz"
+ATTRACTIONS_PATH = "data/new_york/nyc_attactions.csv"
+PROJECTED_CRS = "EPSG:2263"
+FEET_PER_KM = 3280.84
+ROOM_TYPES = {
+    "rt_entire_home_apartment": "Entire home/apt",
+    "rt_private_room": "Private room",
+    "rt_shared_room": "Shared room",
+}
+MAX_BATCH_SIZE = 256
+MAX_BATCH_WAIT = 0.002
+LATENCY_WINDOW = 10000
+PERCENTILES = [50, 90, 95, 99]
+
+
+def fit_and_save_models(
+    features: feature_matrix.FeatureMatrix,
+    variables: list,
+    gwr_variables: list,
+    path: str = MODELS_PATH,
+    bw: int = None,
+) -> dict:
+    x = features.get(variables)
+    ols_betas = np.linalg.lstsq(
+        gwr_bandwidth.add_constant(x), features.y, rcond=None
+    )[0]
+    regimes_m = fixed_effects.fit_fixed_effects(
+        features.y, x, np.asarray(features.neighbourhood_names)[features.neighbourhoods]
+    )
+    n_regimes = len(regimes_m.regimes)
+    counts = np.bincount(features.neighbourhoods, minlength=n_regimes)
+    gwr_x = features.get(gwr_variables)
+    if bw is None:
+        bw = gwr_bandwidth.select_bandwidth(
+            features.coords, features.y, gwr_x, sample_size=min(len(gwr_x), 5000)
+        )
+    models = {
+        "variables": np.array(variables),
+        "gwr_variables": np.array(gwr_variables),
+        "ols_betas": ols_betas,
+        "regime_names": np.array(regimes_m.regimes),
+        "regime_intercepts": regimes_m.betas[:n_regimes, 0],
+        # neighbourhoods without training listings get the weighted mean
+        "default_intercept": np.array(
+            np.average(regimes_m.betas[:n_regimes, 0], weights=counts)
+        ),
+        "regime_slopes": regimes_m.betas[n_regimes:, 0],
+        "gwr_bw": np.array(bw),
+        "gwr_coords": features.coords,
+        "gwr_x": gwr_x,
+        "gwr_y": features.y,
+    }
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    np.savez(path, **models)
+    return models
+
+
+def load_models(path: str = MODELS_PATH) -> dict:
+    models = dict(np.load(path))
+    for name in ["variables", "gwr_variables", "regime_names"]:
+        models[name] = models[name].tolist()
+    models["regime_positions"] = {
+        name: position for position, name in enumerate(models["regime_names"])
+    }
+    # the GWR calibration tree is built once, not per request
+    models["gwr_tree"] = cKDTree(
+        gwr_bandwidth.get_tree_coords(models["gwr_coords"], True)
+    )
+    return models
+
+
+def get_attraction_index(path: str = ATTRACTIONS_PATH) -> dict:
+    attractions = pd.read_csv(path)
+    transformer = pyproj.Transformer.from_crs(
+        "EPSG:4326", PROJECTED_CRS, always_xy=True
+    )
+    x, y = transformer.transform(
+        attractions["longitude"].to_numpy(), attractions["latitude"].to_numpy()
+    )
+    names, positions = np.unique(attractions["attaction"], return_inverse=True)
+    return {
+        "names": names.tolist(),
+        "positions": positions,
+        "tree": cKDTree(np.column_stack([x, y])),
+        "transformer": transformer,
+    }
+
+
+def get_proximity_features(points: np.ndarray, attraction_index: dict) -> pd.DataFrame:
+    # distances in km to every attraction, as in chapter 7, from one query
+    x, y = attraction_index["transformer"].transform(points[:, 0], points[:, 1])
+    tree = attraction_index["tree"]
+    distances, indices = tree.query(np.column_stack([x, y]), k=tree.n)
+    distances = distances.reshape(len(points), -1) / FEET_PER_KM
+    indices = indices.reshape(len(points), -1)
+    proximity = np.full((len(points), len(attraction_index["names"])), np.inf)
+    rows = np.repeat(np.arange(len(points)), indices.shape[1])
+    np.minimum.at(
+        proximity,
+        (rows, attraction_index["positions"][indices.ravel()]),
+        distances.ravel(),
+    )
+    return pd.DataFrame(proximity, columns=attraction_index["names"])
+
+
+def get_request_frame(records: list, attraction_index: dict) -> pd.DataFrame:
+    frame = pd.DataFrame.from_records(records)
+    for column, room_type in ROOM_TYPES.items():
+        frame[column] = (frame["room_type"] == room_type).astype(float)
+    points = frame[["longitude", "latitude"]].to_numpy(dtype=np.float64)
+    return pd.concat(
+        [
+            frame.reset_index(drop=True),
+            get_proximity_features(points, attraction_index),
+        ],
+        axis=1,
+    )
+
+
+def score_records(records: list, models: dict, attraction_index: dict) -> list:
+    frame = get_request_frame(records, attraction_index)
+    x = frame[models["variables"]].to_numpy(dtype=np.float64)
+    ols = gwr_bandwidth.add_constant(x) @ models["ols_betas"]
+    positions = frame.get("neighbourhood", pd.Series([None] * len(frame))).map(
+        models["regime_positions"]
+    )
+    intercepts = np.where(
+        positions.notna(),
+        models["regime_intercepts"][positions.fillna(0).astype(int)],
+        models["default_intercept"],
+    )
+    regimes = intercepts + x @ models["regime_slopes"]
+    gwr_x = frame[models["gwr_variables"]].to_numpy(dtype=np.float64)
+    gwr_params = gwr_prediction.predict_gwr_params(
+        models["gwr_coords"],
+        models["gwr_y"],
+        models["gwr_x"],
+        int(models["gwr_bw"]),
+        frame[["longitude", "latitude"]].to_numpy(dtype=np.float64),
+        tree=models["gwr_tree"],
+    )
+    gwr = gwr_prediction.predict(gwr_params, gwr_x).ravel()
+    # the models are fitted on log price
+    return [
+        {"ols": float(o), "regimes": float(r), "gwr": float(g)}
+        for o, r, g in zip(np.exp(ols), np.exp(regimes), np.exp(gwr))
+    ]
+
+
+class MicroBatcher:
+    # concurrent requests are queued and scored together, so the per-call
+    # numpy and tree overhead is paid once per batch instead of per listing
+    def __init__(
+        self,
+        models: dict,
+        attraction_index: dict,
+        max_batch_size: int = MAX_BATCH_SIZE,
+        max_batch_wait: float = MAX_BATCH_WAIT,
+    ):
+        self.models = models
+        self.attraction_index = attraction_index
+        self.max_batch_size = max_batch_size
+        self.max_batch_wait = max_batch_wait
+        self.requests = queue.Queue()
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.batch_sizes = deque(maxlen=LATENCY_WINDOW)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, records: list) -> Future:
+        future = Future()
+        self.requests.put((records, future))
+        return future
+
+    def get_batch(self) -> list:
+        batch = [self.requests.get()]
+        size = len(batch[0][0])
+        deadline = time.perf_counter() + self.max_batch_wait
+        while size < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.requests.get(timeout=timeout))
+            except queue.Empty:
+                break
+            size += len(batch[-1][0])
+        return batch
+
+    def run(self) -> None:
+        while True:
+            batch = self.get_batch()
+            records = [
+                record for request_records, _ in batch for record in request_records
+            ]
+            try:
+                scores = score_records(records, self.models, self.attraction_index)
+            except Exception:
+                # isolate the malformed request instead of failing the batch
+                for request_records, future in batch:
+                    try:
+                        future.set_result(
+                            score_records(
+                                request_records, self.models, self.attraction_index
+                            )
+                        )
+                    except Exception as error:
+                        future.set_exception(error)
+                continue
+            self.batch_sizes.append(len(records))
+            start = 0
+            for request_records, future in batch:
+                future.set_result(scores[start : start + len(request_records)])
+                start += len(request_records)
+
+    def get_stats(self) -> dict:
+        latencies = np.array(self.latencies) * 1000
+        if len(latencies) == 0:
+            return {"requests": 0}
+        return {
+            "requests": len(latencies),
+            "mean_batch_size": float(np.mean(self.batch_sizes)),
+            **{
+                f"p{percentile}_ms": float(np.percentile(latencies, percentile))
+                for percentile in PERCENTILES
+            },
+        }
+
+
+def get_handler(batcher: MicroBatcher) -> type:
+    class ScoringHandler(BaseHTTPRequestHandler):
+        def send_json(self, status: int, body) -> None:
+            payload = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_GET(self) -> None:
+            if self.path == "/stats":
+                self.send_json(200, batcher.get_stats())
+            else:
+                self.send_json(404, {"error": "not found"})
+
+        def do_POST(self) -> None:
+            if self.path != "/score":
+                self.send_json(404, {"error": "not found"})
+                return
+            start = time.perf_counter()
+            try:
+                body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                records = body if isinstance(body, list) else [body]
+                scores = batcher.submit(records).result()
+            except Exception as error:
+                self.send_json(400, {"error": str(error)})
+                return
+            batcher.latencies.append(time.perf_counter() - start)
+            self.send_json(200, scores if isinstance(body, list) else scores[0])
+
+        def log_message(self, format: str, *args) -> None:
+            pass
+
+    return ScoringHandler
+
+
+def serve(
+    host: str = "127.0.0.1",
+    port: int = 8000,
+    models_path: str = MODELS_PATH,
+    attractions_path: str = ATTRACTIONS_PATH,
+) -> None:
+    start = time.time()
+    batcher = MicroBatcher(
+        load_models(models_path), get_attraction_index(attractions_path)
+    )
+    server = ThreadingHTTPServer((host, port), get_handler(batcher))
+    print(
+        f"Scoring service loaded in {round(time.time() - start, 2)} seconds, "
+        f"listening on http://{host}:{port}/score"
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(batcher.get_stats())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--fit", action="store_true")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    args = parser.parse_args()
+    if args.fit:
+        import regression_model
+
+        manhattan_listings, _ = regression_model.get_train_data()
+        fit_and_save_models(
+            regression_model.get_feature_matrix(manhattan_listings),
+            regression_model.G_M_VARS,
+            regression_model.GWR_VARS,
+        )
+    serve(args.host, args.port)
@@ -0,0 +1,131 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import h3
+import numpy as np
+import pandas as pd
+
+import feature_matrix
+import fixed_effects
+import gwr_bandwidth
+import gwr_prediction
+
+
+H3_RESOLUTION = 8
+
+_cv_data = {}
+
+
+def assign_groups_to_folds(groups: np.ndarray, n_folds: int) -> np.ndarray:
+    # largest blocks first, each into the currently smallest fold
+    group_ids, group_sizes = np.unique(groups, return_counts=True)
+    fold_sizes = np.zeros(n_folds, dtype=int)
+    group_folds = np.zeros(len(group_ids), dtype=int)
+    for position in np.argsort(-group_sizes, kind="stable"):
+        fold = int(np.argmin(fold_sizes))
+        group_folds[position] = fold
+        fold_sizes[fold] += group_sizes[position]
+    return group_folds[np.searchsorted(group_ids, groups)]
+
+
+def get_neighbourhood_folds(
+    features: feature_matrix.FeatureMatrix, n_folds: int = 5
+) -> np.ndarray:
+    return assign_groups_to_folds(features.neighbourhoods, n_folds)
+
+
+def get_h3_folds(
+    features: feature_matrix.FeatureMatrix,
+    n_folds: int = 5,
+    resolution: int = H3_RESOLUTION,
+) -> np.ndarray:
+    cells = [
+        h3.latlng_to_cell(lat, lon, resolution) for lon, lat in features.coords
+    ]
+    return assign_groups_to_folds(pd.factorize(pd.Series(cells))[0], n_folds)
+
+
+def predict_ols(train: np.ndarray, test: np.ndarray, columns: list) -> np.ndarray:
+    X = gwr_bandwidth.add_constant(_cv_data["features"].get(columns))
+    betas = np.linalg.lstsq(X[train], _cv_data["features"].y[train], rcond=None)[0]
+    return X[test] @ betas
+
+
+def predict_regimes(train: np.ndarray, test: np.ndarray, columns: list) -> np.ndarray:
+    features = _cv_data["features"]
+    x = features.get(columns)
+    model = fixed_effects.fit_fixed_effects(
+        features.y[train], x[train], features.neighbourhoods[train]
+    )
+    n_regimes = len(model.regimes)
+    intercepts = dict(zip(model.regimes, model.betas[:n_regimes, 0]))
+    # neighbourhoods held out entirely get the size-weighted mean intercept
+    train_regimes = features.neighbourhoods[train]
+    default = np.mean([intercepts[regime] for regime in train_regimes])
+    test_intercepts = np.array(
+        [intercepts.get(regime, default) for regime in features.neighbourhoods[test]]
+    )
+    return test_intercepts + x[test] @ model.betas[n_regimes:, 0]
+
+
+def predict_gwr(
+    train: np.ndarray, test: np.ndarray, columns: list, bw: int = None
+) -> np.ndarray:
+    features = _cv_data["features"]
+    x = features.get(columns)
+    if bw is None:
+        bw = gwr_bandwidth.select_bandwidth(
+            features.coords[train], features.y[train], x[train], n_jobs=1
+        )
+    params = gwr_prediction.predict_gwr_params(
+        features.coords[train],
+        features.y[train],
+        x[train],
+        bw,
+        features.coords[test],
+    )
+    return gwr_prediction.predict(params, x[test]).ravel()
+
+
+MODELS = {"ols": predict_ols, "regimes": predict_regimes, "gwr": predict_gwr}
+
+
+def init_worker(features: feature_matrix.FeatureMatrix) -> None:
+    _cv_data["features"] = features
+
+
+def run_fold(model: str, fold: int, folds: np.ndarray, model_kwargs: dict) -> dict:
+    train = np.flatnonzero(folds != fold)
+    test = np.flatnonzero(folds == fold)
+    predictions = MODELS[model](train, test, **model_kwargs)
+    residuals = _cv_data["features"].y[test] - predictions
+    return {
+        "model": model,
+        "fold": fold,
+        "n_test": len(test),
+        "rmse": float(np.sqrt(np.mean(residuals**2))),
+    }
+
+
+def run_spatial_cv(
+    features: feature_matrix.FeatureMatrix,
+    folds: np.ndarray,
+    models: dict,
+    n_jobs: int = None,
+) -> tuple:
+    with ProcessPoolExecutor(
+        max_workers=n_jobs or os.cpu_count() or 1,
+        initializer=init_worker,
+        initargs=(features,),
+    ) as executor:
+        futures = [
+            executor.submit(run_fold, model, int(fold), folds, model_kwargs)
+            for model, model_kwargs in models.items()
+            for fold in np.unique(folds)
+        ]
+        fold_scores = pd.DataFrame([future.result() for future in futures])
+    # pooled RMSE over every held-out listing
+    fold_scores["sse"] = fold_scores["rmse"] ** 2 * fold_scores["n_test"]
+    grouped = fold_scores.groupby("model")
+    scores = np.sqrt(grouped["sse"].sum() / grouped["n_test"].sum()).to_frame("rmse")
+    return scores, fold_scores.drop(columns="sse")
@@ -0,0 +1,421 @@
+import hashlib
+from dataclasses import dataclass
+from pathlib import Path
+
+import numpy as np
+import scipy.sparse as sp
+
+from scipy import stats
+from scipy.optimize import minimize_scalar
+from scipy.sparse.linalg import splu
+from scipy.spatial import cKDTree
+
+
+WEIGHTS_CACHE_DIR = "data/new_york/weights"
+LOGDET_ORDER = 50
+N_PROBES = 30
+EPSILON = 1e-7
+
+_weights_cache = {}
+
+
+@dataclass
+class SpatialRegressionResults:
+    name_y: str
+    name_x: list
+    betas: np.ndarray
+    vm: np.ndarray
+    std_err: np.ndarray
+    z_stat: list
+    u: np.ndarray
+    predy: np.ndarray
+    predy_e: np.ndarray
+    n: int
+    k: int
+    sig2: float
+    logll: float
+    aic: float
+    schwarz: float
+    pr2: float
+    logdet_method: str
+    rho: float = None
+    lam: float = None
+    summary: str = ""
+
+
+def get_coords_hash(coords: np.ndarray, k: int) -> str:
+    input_hash = hashlib.sha1(np.ascontiguousarray(coords).tobytes())
+    input_hash.update(str(k).encode())
+    return input_hash.hexdigest()
+
+
+def build_knn_weights(coords: np.ndarray, k: int) -> sp.csr_matrix:
+    n = len(coords)
+    _, indices = cKDTree(coords).query(coords, k=k + 1)
+    # drop each point itself; with duplicated locations it may not come first
+    keep = indices != np.arange(n)[:, None]
+    keep[keep.all(axis=1), -1] = False
+    neighbours = indices[keep].reshape(n, k)
+    return sp.csr_matrix(
+        (np.full(n * k, 1.0 / k), neighbours.ravel(), np.arange(0, n * k + 1, k)),
+        shape=(n, n),
+    )
+
+
+def get_knn_weights(
+    coords: np.ndarray, k: int = 5, cache_dir: str = WEIGHTS_CACHE_DIR
+) -> sp.csr_matrix:
+    # row-standardised KNN weights, kept in memory and on disk by input hash
+    coords = np.asarray(coords, dtype=np.float64)
+    input_hash = get_coords_hash(coords, k)
+    if input_hash in _weights_cache:
+        return _weights_cache[input_hash]
+    cache_path = Path(cache_dir) / f"knn_{k}_{input_hash[:16]}.npz"
+    if cache_path.is_file():
+        cached = np.load(cache_path)
+        w = sp.csr_matrix(
+            (cached["data"], cached["indices"], cached["indptr"]),
+            shape=(len(coords), len(coords)),
+        )
+    else:
+        w = build_knn_weights(coords, k)
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        np.savez(cache_path, data=w.data, indices=w.indices, indptr=w.indptr)
+    _weights_cache[input_hash] = w
+    return w
+
+
+def get_probes(n: int, n_probes: int, random_state: int) -> np.ndarray:
+    rng = np.random.default_rng(random_state)
+    return rng.choice([-1.0, 1.0], size=(n, n_probes))
+
+
+def get_power_traces(
+    w: sp.csr_matrix, order: int, n_probes: int, random_state: int
+) -> np.ndarray:
+    # tr(W^j) for j = 1..order: the first two exactly, the rest by Hutchinson
+    # probes, so the cost is order sparse products with an n x n_probes block
+    n = w.shape[0]
+    probes = get_probes(n, n_probes, random_state)
+    traces = np.zeros(order)
+    power = probes
+    for j in range(order):
+        power = w @ power
+        traces[j] = np.einsum("ij,ij->", probes, power) / n_probes
+    traces[0] = w.diagonal().sum()
+    if order > 1:
+        traces[1] = w.multiply(w.T).sum()
+    return traces
+
+
+def get_chebyshev_traces(
+    w: sp.csr_matrix, order: int, n_probes: int, random_state: int
+) -> np.ndarray:
+    # tr(T_j(W)) through the recurrence T_j+1 = 2 W T_j - T_j-1
+    n = w.shape[0]
+    probes = get_probes(n, n_probes, random_state)
+    traces = np.zeros(order + 1)
+    traces[0] = n
+    previous, current = probes, w @ probes
+    traces[1] = w.diagonal().sum()
+    for j in range(2, order + 1):
+        previous, current = current, 2 * (w @ current) - previous
+        traces[j] = np.einsum("ij,ij->", probes, current) / n_probes
+    return traces
+
+
+def get_logdet_function(
+    w: sp.csr_matrix,
+    method: str = "mc",
+    order: int = LOGDET_ORDER,
+    n_probes: int = N_PROBES,
+    random_state: int = 0,
+):
+    # ln|I - rho W| for the concentrated likelihoods; mc and chebyshev do
+    # all the sparse work up front and evaluate each rho in O(order)
+    if method == "lu":
+        identity = sp.identity(w.shape[0], format="csc")
+        w_csc = w.tocsc()
+
+        def logdet(rho: float) -> float:
+            # L has a unit diagonal, so only U contributes
+            return float(
+                np.log(np.abs(splu(identity - rho * w_csc).U.diagonal())).sum()
+            )
+
+        return logdet
+    if method == "mc":
+        traces = get_power_traces(w, order, n_probes, random_state)
+        powers = np.arange(1, order + 1)
+
+        def logdet(rho: float) -> float:
+            return float(-np.sum(rho**powers * traces / powers))
+
+        return logdet
+    if method == "chebyshev":
+        traces = get_chebyshev_traces(w, order, n_probes, random_state)
+        nodes = np.cos(np.pi * (np.arange(1, order + 2) - 0.5) / (order + 1))
+        polynomials = np.cos(np.outer(np.arange(order + 1), np.arccos(nodes)))
+
+        def logdet(rho: float) -> float:
+            coefficients = (2 / (order + 1)) * polynomials @ np.log(1 - rho * nodes)
+            return float(coefficients @ traces - coefficients[0] * traces[0] / 2)
+
+        return logdet
+    raise ValueError(f"Unknown log-determinant method {method}")
+
+
+def get_inverse_solver(w: sp.csr_matrix, rho: float, method: str):
+    # (I - rho W)^-1 applied to a block: one sparse LU for "lu", otherwise
+    # the Neumann series sum rho^j W^j z, which is linear in n per term
+    if method == "lu":
+        lu = splu((sp.identity(w.shape[0], format="csc") - rho * w).tocsc())
+        return lu.solve
+
+    def solve(z: np.ndarray) -> np.ndarray:
+        term = z
+        total = z.copy()
+        while np.abs(term).max() > EPSILON * max(np.abs(total).max(), 1.0):
+            term = rho * (w @ term)
+            total += term
+        return total
+
+    return solve
+
+
+def get_operator_traces(
+    w: sp.csr_matrix, solve, n_probes: int, random_state: int
+) -> tuple:
+    # tr(WA), tr(WA WA) and tr(WA' WA) with A = (I - rho W)^-1
+    probes = get_probes(w.shape[0], n_probes, random_state)
+    wa_probes = w @ solve(probes)
+    wa_wa_probes = w @ solve(wa_probes)
+    return (
+        np.einsum("ij,ij->", probes, wa_probes) / n_probes,
+        np.einsum("ij,ij->", probes, wa_wa_probes) / n_probes,
+        np.einsum("ij,ij->", wa_probes, wa_probes) / n_probes,
+    )
+
+
+def get_summary(results: SpatialRegressionResults, title: str) -> str:
+    rows = [
+        f"SUMMARY OF OUTPUT: {title} (METHOD = {results.logdet_method.upper()})",
+        "-" * 84,
+        f"Dependent Variable  : {results.name_y:>11}"
+        f"                Number of Observations: {results.n:>11}",
+        f"Pseudo R-squared    : {results.pr2:>11.4f}"
+        f"                Number of Variables   : {results.k:>11}",
+        f"Sigma-square ML     : {results.sig2:>11.3f}"
+        f"                Log likelihood        : {results.logll:>11.3f}",
+        f"S.E of regression   : {np.sqrt(results.sig2):>11.3f}"
+        f"                Akaike info criterion : {results.aic:>11.3f}",
+        f"{'':>47}Schwarz criterion     : {results.schwarz:>11.3f}",
+        "",
+        "-" * 84,
+        f"{'Variable':>20}{'Coefficient':>16}{'Std.Error':>16}"
+        f"{'z-Statistic':>16}{'Probability':>16}",
+        "-" * 84,
+    ]
+    for name, beta, std_err, (z_stat, p_value) in zip(
+        results.name_x, results.betas.ravel(), results.std_err, results.z_stat
+    ):
+        rows.append(
+            f"{name:>20}{beta:>16.5f}{std_err:>16.5f}{z_stat:>16.5f}{p_value:>16.5f}"
+        )
+    rows.append("-" * 84)
+    return "\n".join(rows)
+
+
+def get_results(
+    y: np.ndarray,
+    X: np.ndarray,
+    betas: np.ndarray,
+    vm: np.ndarray,
+    u: np.ndarray,
+    predy_e: np.ndarray,
+    sig2: float,
+    logll: float,
+    name_y: str,
+    name_x: list,
+    logdet_method: str,
+) -> SpatialRegressionResults:
+    n = len(y)
+    k = len(betas)
+    std_err = np.sqrt(np.diag(vm))
+    z_values = betas / std_err
+    return SpatialRegressionResults(
+        name_y=name_y,
+        name_x=name_x,
+        betas=betas.reshape(-1, 1),
+        vm=vm,
+        std_err=std_err,
+        z_stat=list(zip(z_values, 2 * stats.norm.sf(np.abs(z_values)))),
+        u=u.reshape(-1, 1),
+        predy=(y - u).reshape(-1, 1),
+        predy_e=predy_e.reshape(-1, 1),
+        n=n,
+        k=k,
+        sig2=sig2,
+        logll=logll,
+        aic=-2 * logll + 2 * k,
+        schwarz=-2 * logll + k * np.log(n),
+        pr2=float(np.corrcoef(y, predy_e)[0, 1] ** 2),
+        logdet_method=logdet_method,
+    )
+
+
+def prepare_inputs(y: np.ndarray, x: np.ndarray, name_x: list) -> tuple:
+    y = np.asarray(y, dtype=np.float64).reshape(-1)
+    X = np.column_stack([np.ones(len(y)), np.asarray(x, dtype=np.float64)])
+    name_x = ["CONSTANT"] + list(
+        name_x or [f"var_{i + 1}" for i in range(X.shape[1] - 1)]
+    )
+    return y, X, name_x
+
+
+def fit_spatial_lag(
+    y: np.ndarray,
+    x: np.ndarray,
+    w: sp.csr_matrix,
+    method: str = "mc",
+    name_y: str = "y",
+    name_x: list = None,
+    n_probes: int = N_PROBES,
+    random_state: int = 0,
+) -> SpatialRegressionResults:
+    y, X, name_x = prepare_inputs(y, x, name_x)
+    n, k = X.shape
+    logdet = get_logdet_function(
+        w, method, n_probes=n_probes, random_state=random_state
+    )
+    wy = w @ y
+    xtx = X.T @ X
+    b0, b1 = np.linalg.solve(xtx, X.T @ np.column_stack([y, wy])).T
+    e0 = y - X @ b0
+    e1 = wy - X @ b1
+
+    def negative_loglik(rho: float) -> float:
+        residuals = e0 - rho * e1
+        return 0.5 * n * np.log(residuals @ residuals / n) - logdet(rho)
+
+    rho = minimize_scalar(
+        negative_loglik,
+        bounds=(-1.0, 1.0),
+        method="bounded",
+        options={"xatol": EPSILON},
+    ).x
+    betas = b0 - rho * b1
+    u = e0 - rho * e1
+    sig2 = float(u @ u) / n
+    logll = -0.5 * n * (np.log(2 * np.pi) + np.log(sig2) + 1) + logdet(rho)
+
+    # information matrix of (beta, rho, sigma2) with stochastic traces
+    solve = get_inverse_solver(w, rho, method)
+    predy_e = solve(X @ betas)
+    tr_wa, tr_wa_wa, tr_wat_wa = get_operator_traces(w, solve, n_probes, random_state)
+    w_predy = w @ predy_e
+    information = np.zeros((k + 2, k + 2))
+    information[:k, :k] = xtx / sig2
+    information[:k, k] = information[k, :k] = X.T @ w_predy / sig2
+    information[k, k] = tr_wa_wa + tr_wat_wa + w_predy @ w_predy / sig2
+    information[k, k + 1] = information[k + 1, k] = tr_wa / sig2
+    information[k + 1, k + 1] = n / (2 * sig2**2)
+    vm = np.linalg.inv(information)[:-1, :-1]
+
+    results = get_results(
+        y,
+        X,
+        np.append(betas, rho),
+        vm,
+        u,
+        predy_e,
+        sig2,
+        logll,
+        name_y,
+        name_x + [f"W_{name_y}"],
+        method,
+    )
+    results.rho = float(rho)
+    results.summary = get_summary(results, "MAXIMUM LIKELIHOOD SPATIAL LAG")
+    return results
+
+
+def fit_spatial_error(
+    y: np.ndarray,
+    x: np.ndarray,
+    w: sp.csr_matrix,
+    method: str = "mc",
+    name_y: str = "y",
+    name_x: list = None,
+    n_probes: int = N_PROBES,
+    random_state: int = 0,
+) -> SpatialRegressionResults:
+    y, X, name_x = prepare_inputs(y, x, name_x)
+    n, k = X.shape
+    logdet = get_logdet_function(
+        w, method, n_probes=n_probes, random_state=random_state
+    )
+    wy = w @ y
+    wX = w @ X
+
+    def get_filtered_fit(lam: float) -> tuple:
+        ys = y - lam * wy
+        Xs = X - lam * wX
+        betas = np.linalg.solve(Xs.T @ Xs, Xs.T @ ys)
+        return betas, ys - Xs @ betas, Xs
+
+    def negative_loglik(lam: float) -> float:
+        _, residuals, _ = get_filtered_fit(lam)
+        return 0.5 * n * np.log(residuals @ residuals / n) - logdet(lam)
+
+    lam = minimize_scalar(
+        negative_loglik,
+        bounds=(-1.0, 1.0),
+        method="bounded",
+        options={"xatol": EPSILON},
+    ).x
+    betas, filtered_residuals, Xs = get_filtered_fit(lam)
+    sig2 = float(filtered_residuals @ filtered_residuals) / n
+    logll = -0.5 * n * (np.log(2 * np.pi) + np.log(sig2) + 1) + logdet(lam)
+    predy_e = X @ betas
+    u = y - predy_e
+
+    solve = get_inverse_solver(w, lam, method)
+    tr_wb, tr_wb_wb, tr_wbt_wb = get_operator_traces(w, solve, n_probes, random_state)
+    lambda_information = np.array(
+        [
+            [tr_wb_wb + tr_wbt_wb, tr_wb / sig2],
+            [tr_wb / sig2, n / (2 * sig2**2)],
+        ]
+    )
+    vm = np.zeros((k + 1, k + 1))
+    vm[:k, :k] = sig2 * np.linalg.inv(Xs.T @ Xs)
+    vm[k, k] = np.linalg.inv(lambda_information)[0, 0]
+
+    results = get_results(
+        y,
+        X,
+        np.append(betas, lam),
+        vm,
+        u,
+        predy_e,
+        sig2,
+        logll,
+        name_y,
+        name_x + ["lambda"],
+        method,
+    )
+    results.lam = float(lam)
+    results.summary = get_summary(results, "MAXIMUM LIKELIHOOD SPATIAL ERROR")
+    return results
+
+
+def get_morans_i(residuals: np.ndarray, w: sp.csr_matrix) -> float:
+    residuals = np.asarray(residuals, dtype=np.float64).reshape(-1)
+    residuals = residuals - residuals.mean()
+    return float(
+        len(residuals)
+        / w.sum()
+        * (residuals @ (w @ residuals))
+        / (residuals @ residuals)
+    )